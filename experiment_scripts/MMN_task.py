@@ -13,7 +13,20 @@ import pandas as pd
 import numpy as np
 import random as rd
 import os
-import serial
+import argparse
+
+from checkpoint import Checkpoint, load_checkpoint
+from clock_service import ClockService, ptb_audio_clock
+from event_table import EventTable
+from image_cache import ImageCache
+from log_sink import LogSink
+from operator_console import OperatorConsole
+from quality_monitor import QualityMonitor, source_from_arg
+from rush_mode import RushMode
+from scheduler import FrameScheduler, Seconds
+from session_replay import SessionRecorder
+from static_screen import hold_static
+from trigger_protocol import PtyLoopback, TriggerPort
 
 #%%%%%%%%%% Path directories %%%%%%%%%%
 _thisDir = os.path.dirname(os.path.abspath(__file__))
@@ -23,8 +36,14 @@ os.chdir(_thisDir)
 
 class Experiment:
 
-    def __init__(self, portname, test, fullscreen, monitor, volume):
+    def __init__(self, portname, test, fullscreen, monitor, volume, quality_source=None, resume=None,
+                 trigger_mode='ascii', baudrate=9600, ack=False, replay=None):
         self.__port_name = portname
+        self.__replay_file = replay
+        self.__session = None
+        self.__trigger_mode = trigger_mode
+        self.__baudrate = baudrate
+        self.__ack = ack
         self.__path = '/Users/emilia/Documents/Dementia task piloting/Lumo'
         self.__win = None
         self.__clock = None
@@ -32,6 +51,12 @@ class Experiment:
         self.__port = None
         self.__blank = None
         self.__fixation_cross = None
+        self.__events = None
+        self.__clocks = None
+        self.__images = None
+        self.__console = None
+        self.__rush = None
+        self.__log = None
         self.__filename_save = None
         self.__experiment_info = None
         self.__this_exp = None
@@ -39,33 +64,58 @@ class Experiment:
         self.__fullscreen = fullscreen
         self.__mode = test
         self.__monitor = monitor
+        self.__quality_source = quality_source
+        self.__quality = None
+        self.__resume_file = resume
+        self.__resume = None
+        self.__checkpoint = None
         self.volume = volume
 
     #%%%%% SETTING UP EXPERIMENT %%%%%
     def __setup(self):
-        print(f"Setting up experiment...")
+        self.__console = OperatorConsole()
+        self.__console.start()
+        self.__console.message(f"Setting up experiment...")
+        self.__clocks = ClockService()
+        self.__clocks.start()
+        # Seeds the random generators (recorded, or taken from the session being replayed)
+        self.__session = SessionRecorder(self.__replay_file)
+        self.__session.start()
         experiment_name = 'Optical Neuroimaging and Cognition (ONAC)'
         self.__experiment_info = {'Participant': ''}
-        if self.__mode:
+        if self.__session.replaying:
+            self.__experiment_info = {'Participant': self.__session.participant}
+        elif self.__resume_file is not None:
+            self.__resume = load_checkpoint(self.__resume_file)
+            self.__experiment_info = {'Participant': self.__resume['experiment_info']['Participant']}
+            self.__console.message('Resuming %s from %s' % (self.__resume['task'], self.__resume_file))
+        elif self.__mode:
             dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
             if not dlg.OK:
-                print("User pressed 'Cancel'!")
+                self.__console.message("User pressed 'Cancel'!")
+                self.__console.stop()
                 core.quit()
         else:
             self.__experiment_info = {'Participant': 'test'}
 
+        self.__session.participant = self.__experiment_info['Participant']
         self.__experiment_info['date'] = data.getDateStr()
         self.__experiment_info['expName'] = experiment_name
         self.__experiment_info['psychopyVersion'] = '2021.2.3'
         self.__endfilename = _thisDir + os.sep + u'data/%s_%s_%s_%s' % (self.__experiment_info['Participant'],
                                                            experiment_name, self.__experiment_info['date'], 'MMN_task')
+        # A resumed session keeps checkpointing to the file it was resumed from, so finishing removes it
+        checkpoint_file = self.__endfilename + '_checkpoint.pkl'
+        if self.__resume is not None:
+            checkpoint_file = self.__resume_file
+        self.__checkpoint = Checkpoint(checkpoint_file, self.__console)
 
         self.__this_exp = data.ExperimentHandler(name=experiment_name, extraInfo=self.__experiment_info,
                                                  originPath='C:/Users/emilia/PycharmProjects/experiment/MMN_task.py',
                                                  savePickle=True, saveWideText=True,
                                                  dataFileName=self.__endfilename)
-        # Setting up a log file
-        log_file = logging.LogFile(self.__endfilename + '.log', level=logging.EXP)
+        # Setting up a log file (buffered and written off the render thread)
+        self.__log = LogSink(self.__endfilename + '_log.jsonl', level=logging.EXP)
         logging.console.setLevel(logging.WARNING)
         self.__filename_save = '/P' + str(self.__experiment_info['Participant'])
 
@@ -74,7 +124,8 @@ class Experiment:
 
         if self.__mode:
             if self.__port_name is not None:
-                self.__port = serial.Serial(self.__port_name, baudrate=9600)
+                self.__port = TriggerPort(self.__port_name, mode=self.__trigger_mode, baudrate=self.__baudrate,
+                                         ack=self.__ack)
 
         if self.__monitor:
             self.__size = (1920, 1080)
@@ -93,15 +144,33 @@ class Experiment:
         else:
             frame_dur = 1.0 / 60.0
 
+        # Images are resampled to their on-screen size and kept within a texture budget
+        self.__images = ImageCache(self.__win, session=self.__session)
+
+        # Count dropped frames for the operator console. Intervals are only recorded while a loop flips every
+        # frame; static holds and key waits would otherwise count as dropped frames
+        self.__win.recordFrameIntervals = False
+        self.__win.refreshThreshold = frame_dur + 0.004
+
+        # Start the online signal-quality monitor
+        if self.__quality_source is not None:
+            self.__quality = QualityMonitor(self.__quality_source)
+            self.__quality.start()
+
         # Hide mouse
         self.__win.mouseVisible = False
 
         # Setting up useful trial components
         self.__clock = core.Clock()
-        self.__kb = keyboard.Keyboard()
+        self.__kb = self.__session.keyboard(keyboard.Keyboard)
         self.__blank = TextStim(self.__win, text='')
+        self.__events = EventTable(self.__win, self.__port, self.__console, self.__clocks, self.__session)
         self.__fixation_cross = TextStim(self.__win, text='+', height=0.1, color=(-1, -1, 1))
 
+        # Real-time scheduling for the trial loops
+        self.__rush = RushMode(self.__console)
+        self.__rush.apply()
+
 #%%%%% SOME USEFUL FUNCTIONS %%%%%
 
     def __check_for_escape(self):
@@ -112,28 +181,35 @@ class Experiment:
     def __baseline(self, duration=30):
         self.__win.color = [0, 0, 0]
         self.__clock.reset()
-        while self.__clock.getTime() < (duration + (rd.random() / 10)):  # Randomise the baseline duration
-            self.__fixation_cross.draw()
-            self.__win.flip()
-            self.__check_for_escape()
+        self.__session.anchor()  # trial boundary for recorded keys
+        duration = duration + (rd.random() / 10)  # Randomise the baseline duration
+        self.__fixation_cross.draw()
+        self.__win.flip()
+        self.__check_for_escape()
+        gc_time = self.__rush.collect()
+        cpu = hold_static(self.__clock, duration, self.__check_for_escape)
+        self.__console.message('Baseline %.2f s, CPU %.1f%%, GC %.1f ms' % (duration, 100 * cpu, 1000 * gc_time))
         self.__win.color = [-1, -1, -1]
 
     def __break(self):
-        print(f'Break time!')
+        self.__console.message(f'Break time!')
+        if self.__quality is not None:
+            self.__console.message(self.__quality.report())
         break_text = (self.__path + '/Instructions/task_finished.png')
         break_stim = ImageStim(self.__win, break_text, units='pix', size=self.__size)
         self.__win.color = [0, 0, 0]
         break_stim.draw()
         self.__win.flip()
         self.__check_for_escape()
-        psychopy.event.waitKeys()
+        self.__rush.collect()
+        self.__session.wait_keys()
 
     def __ready(self):
         ready_text = ImageStim(self.__win, image=(self.__path + '/ready.png'), units='pix', size=self.__size)
         ready_text.draw()
         self.__win.flip()
         self.__check_for_escape()
-        psychopy.event.waitKeys()
+        self.__session.wait_keys()
 
     def __wait(self, duration=2):
         core.wait(duration+rd.random()/10)
@@ -163,13 +239,14 @@ class Experiment:
         """
 
         instructions = pd.read_csv(filepath)
+        self.__images.schedule(instructions['path'], self.__size)
         self.__win.color = [0, 0, 0]
         for j in instructions['path']:
-            instruction_stim = ImageStim(self.__win, j, units='pix', size=self.__size)
+            instruction_stim = self.__images.stim(j, self.__size)
             instruction_stim.draw()
             self.__win.flip()
             self.__check_for_escape()
-            psychopy.event.waitKeys()
+            self.__session.wait_keys()
 
     def __showimage(self, image, duration=None):
         showimg = ImageStim(self.__win, image=(self.__path + image), size=self.__size)
@@ -181,26 +258,75 @@ class Experiment:
             self.__win.flip()
             self.__check_for_escape()
         else:
-            psychopy.event.waitKeys()
+            self.__session.wait_keys()
 
     def __start_trigger(self):
-        self.__win.callOnFlip(self.__port.write, 'Z'.encode())
+        self.__events.on_flip('Z', 'start')
         self.__win.flip()
         self.__check_for_escape()
-        d = datetime.utcnow()
-        self.__this_exp.addData('Time', d)
+        stamp = self.__clocks.stamp()
+        self.__this_exp.addData('Time', datetime.utcfromtimestamp(stamp['wall']))
+        self.__this_exp.addData('Time_mono', stamp['mono'])
+        self.__this_exp.addData('Time_ptb', stamp.get('ptb'))
         self.__this_exp.nextEntry()
 
-    def mismatched_negativity(self):
+    def __tones(self, auditory_stimuli, movie_stim, MMN_data, start_tone=0, checkpoint_every=50):
+        """
+        Frame scheduler stream that plays the tone sequence over the movie, starting again until the movie
+        has finished.
+
+        :param auditory_stimuli: Tone table (fixed_stims.csv) with Trigger, Condition, Sound and Timing columns.
+        :param movie_stim: The movie the tones are played over.
+        :param MMN_data: List the presented tones are appended to.
+        :param start_tone: Tone to start from.
+        :param checkpoint_every: Number of tones between checkpoints.
+        """
+
+        audio_clock = None
+        while movie_stim.status != visual.FINISHED:
+            for k in range(start_tone, len(auditory_stimuli)):
+                if k % checkpoint_every == 0:
+                    self.__checkpoint.save(task='mmn', experiment_info=self.__experiment_info, tone=k,
+                                           movie_time=movie_stim.getCurrentFrameTime(), trial_data=MMN_data)
+                self.__console.progress('mmn', k, len(auditory_stimuli), self.__win.nDroppedFrames)
+                trigger = auditory_stimuli['Trigger'][k]
+                condition = auditory_stimuli['Condition'][k]
+                sound_file = self.__path + '/mismatched_negativity_task/auditory_stimuli/' + \
+                                         auditory_stimuli['Sound'][k] + '.wav'
+                sound_play = sound.Sound(sound_file, secs=1, hamming=True, volume=self.volume)
+                self.__session.asset('sound', sound_file)
+                if audio_clock is None:
+                    audio_clock = ptb_audio_clock(sound_play)
+                    if audio_clock is not None:
+                        self.__clocks.add_clock('audio', audio_clock)
+                if self.__mode:
+                    self.__events.on_flip(trigger, condition, k)
+                sound_play.play(when=self.__win.getFutureFlipTime(clock='ptb'))
+                yield Seconds(auditory_stimuli['Timing'][k])
+                if self.__mode:
+                    self.__events.close()
+
+                df = pd.DataFrame({'condition': [condition], 'sound': auditory_stimuli['Sound'][k]})
+                MMN_data.append(df)
+                self.__this_exp.addData('Condition', [condition])
+                self.__this_exp.addData('Sound', auditory_stimuli['Sound'][k])
+                self.__this_exp.nextEntry()
+            start_tone = 0
+
+    def mismatched_negativity(self, resume=None, checkpoint_every=50):
         '''
         Task 3: mismatched negativity task
         This is based on the mismatched negativity task currently used in Milos with MEG and EEG.
 
+        :param resume: Checkpoint to continue from, skipping the instructions.
+        :param checkpoint_every: Number of tones between checkpoints.
         :return: dataframe of tones presented
 
         '''
 
-        print(f'Running mismatched negativity task...')
+        self.__console.message(f'Running mismatched negativity task...')
+        self.__events.task = 'mmn'
+        self.__session.task_start('mmn', None if resume is None else {'tone': resume['tone']})
         movie_stimulus = self.__path + '/mismatched_negativity_task/video_1.mp4'
         auditory_stimuli = pd.read_csv(self.__path + '/mismatched_negativity_task/fixed_stims.csv')
 
@@ -208,7 +334,7 @@ class Experiment:
         auditory_stimuli = auditory_stimuli.reset_index()
 
         # Instructions
-        if self.__mode:
+        if self.__mode and resume is None:
             self.__present_instructions(self.__path + '/mismatched_negativity_task/mismatched_negativity_instructions.csv')
 
         self.__blank.draw()
@@ -219,45 +345,31 @@ class Experiment:
         self.__wait(duration=2)
 
         MMN_data = []
+        start_tone = 0
 
-        next_flip = self.__win.getFutureFlipTime(clock='ptb')
         movie_stim = MovieStim3(self.__win, movie_stimulus)
-        movie_stim.setAutoDraw(True)
-        while movie_stim.status != visual.FINISHED:
-            for k in range(len(auditory_stimuli)):
-                trigger = auditory_stimuli['Trigger'][k]
-                condition = auditory_stimuli['Condition'][k]
-                sound_file = self.__path + '/mismatched_negativity_task/auditory_stimuli/' + \
-                                         auditory_stimuli['Sound'][k] + '.wav'
-                sound_play = sound.Sound(sound_file, secs=1, hamming=True, volume=self.volume)
-                duration = auditory_stimuli['Timing'][k]
-                trigger_sent = False
-                sound_played = False
-                self.__clock.reset()
-                while self.__clock.getTime() < duration:
-                    if self.__mode and not trigger_sent:
-                        self.__win.callOnFlip(self.__port.write, trigger.encode())
-                        trigger_sent = True
-                    if not sound_played:
-                        sound_play.play(when=next_flip)
-                        sound_played = True
-                    self.__win.flip()
-                    self.__check_for_escape()
+        if resume is not None:
+            MMN_data, start_tone = resume['trial_data'], resume['tone']
+            movie_stim.seek(resume['movie_time'])
 
-                df = pd.DataFrame({'condition': [condition], 'sound': auditory_stimuli['Sound'][k]})
-                MMN_data.append(df)
-                self.__this_exp.addData('Condition', [condition])
-                self.__this_exp.addData('Sound', auditory_stimuli['Sound'][k])
-                self.__this_exp.nextEntry()
+        # The movie draws itself on every flip; the scheduler flips once per frame for all streams
+        movie_stim.setAutoDraw(True)
+        scheduler = FrameScheduler(self.__win, self.__clock, on_frame=self.__check_for_escape)
+        scheduler.add(self.__tones(auditory_stimuli, movie_stim, MMN_data, start_tone, checkpoint_every))
+        self.__clock.reset()
+        self.__win.recordFrameIntervals = True
+        scheduler.run()
+        self.__win.recordFrameIntervals = False
 
         self.__break()
 
         # Data saving
-        print(f'Saving data...')
+        self.__console.message(f'Saving data...')
         MMN_data = pd.concat(MMN_data)
         MMN_data = MMN_data.reset_index()
         MMN_data.to_csv((self.__path + '/mismatched_negativity_task/participant_data/' + str(self.__filename_save)
                          + '_mismatched_negativity_task_data' + self.__experiment_info['date'] + '.csv'), header=True)
+        self.__checkpoint.remove()
 
     def __end_all_experiment(self, duration=1):
         """
@@ -266,24 +378,56 @@ class Experiment:
         :param duration: Duration of wait time before exiting.
         """
 
-        print(f"Ending experiment...")
+        self.__console.message(f"Ending experiment...")
+        self.__rush.release()
         self.__showimage('/Instructions/task_finished_mid.png', duration)
         self.__win.mouseVisible = True
         self.__win.flip()
         self.__this_exp.saveAsWideText(self.__endfilename + '.csv', delim='auto')
         self.__this_exp.saveAsPickle(self.__endfilename)
-        logging.flush()
-        if self.__mode:
+        self.__events.save(self.__endfilename)
+        self.__clocks.stop()
+        self.__clocks.save(self.__endfilename)
+        self.__console.message('Clock drift (ppm): %s' % self.__clocks.drift())
+        if self.__mode and self.__port is not None:
             self.__port.close()
+            self.__port.save(self.__endfilename)
+            self.__console.message('Triggers: %s' % self.__port.status())
+        self.__checkpoint.close()
+        self.__session.save(self.__endfilename, self.__win)
+        self.__console.message('Session: %s' % self.__session.status())
+        self.__console.stop()
+        if self.__quality is not None:
+            self.__quality.stop()
+        logging.flush()
+        self.__log.close()
         self.__win.close()
         core.quit()
 
  #%%%%% RUN EXPERIMENT %%%%%%
     def run(self):
         self.__setup()
-        self.mismatched_negativity()
+        self.mismatched_negativity(resume=self.__resume)
         self.__end_all_experiment()
 
-e = Experiment(portname='/dev/tty.usbserial-FTBXN67I', fullscreen=True, test=True, monitor=True, volume=1)
-e.run()
+# The guard keeps the experiment from starting again in the monitor process (spawned on macOS/Windows)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', default=None, help='checkpoint file (*_checkpoint.pkl) to resume from')
+    parser.add_argument('--replay', default=None, help='session file (*_session.json) to replay without a participant')
+    parser.add_argument('--quality-source', default=None,
+                        help='intensity stream for the signal-quality monitor: a file of float32 frames or '
+                             'tcp://host:port')
+    parser.add_argument('--quality-channels', type=int, default=None, help='channels per frame of --quality-source')
+    args = parser.parse_args()
+    if args.quality_source is not None and args.quality_channels is None:
+        parser.error('--quality-source needs --quality-channels')
+    quality_source = (source_from_arg(args.quality_source, args.quality_channels)
+                      if args.quality_source is not None else None)
+    # A replay sends its triggers to a pty loopback instead of the LUMO
+    loopback = PtyLoopback(echo=False) if args.replay is not None else None
+    portname = loopback.name if loopback is not None else '/dev/tty.usbserial-FTBXN67I'
+    e = Experiment(portname=portname, fullscreen=True, test=True, monitor=True, volume=1,
+                   quality_source=quality_source, resume=args.resume, replay=args.replay)
+    e.run()
 
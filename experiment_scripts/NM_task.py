@@ -12,10 +12,21 @@ import pandas as pd
 import numpy as np
 import random as rd
 import os
-import serial
-import psychtoolbox as ptb
+import argparse
 import random as rd
 
+from clock_service import ClockService
+from event_table import EventTable
+from image_cache import ImageCache
+from log_sink import LogSink
+from operator_console import OperatorConsole
+from quality_monitor import QualityMonitor, source_from_arg
+from rush_mode import RushMode
+from session_replay import SessionRecorder
+from static_screen import hold_static
+from text_cache import TextCache
+from trigger_protocol import PtyLoopback, TriggerPort
+
 #%%%%%%%%%% Path directories %%%%%%%%%%
 _thisDir = os.path.dirname(os.path.abspath(__file__))
 os.chdir(_thisDir)
@@ -24,8 +35,14 @@ os.chdir(_thisDir)
 
 class Experiment:
 
-    def __init__(self, portname, fullscreen, test, monitor):
+    def __init__(self, portname, fullscreen, test, monitor, quality_source=None, trigger_mode='ascii', baudrate=9600,
+                 ack=False, replay=None):
         self.__port_name = portname
+        self.__replay_file = replay
+        self.__session = None
+        self.__trigger_mode = trigger_mode
+        self.__baudrate = baudrate
+        self.__ack = ack
         self.__path = '/Users/emilia/Documents/Dementia task piloting/Lumo'
         self.__win = None
         self.__clock = None
@@ -33,6 +50,13 @@ class Experiment:
         self.__port = None
         self.__blank = None
         self.__fixation_cross = None
+        self.__events = None
+        self.__clocks = None
+        self.__images = None
+        self.__console = None
+        self.__rush = None
+        self.__log = None
+        self.__text = None
         self.__filename_save = None
         self.__experiment_info = None
         self.__this_exp = None
@@ -40,17 +64,31 @@ class Experiment:
         self.__fullscreen = fullscreen
         self.__mode = test
         self.__monitor = monitor
+        self.__quality_source = quality_source
+        self.__quality = None
 
     #%%%%% SETTING UP EXPERIMENT %%%%%
     def __setup(self):
-        print(f"Setting up experiment...")
+        self.__console = OperatorConsole()
+        self.__console.start()
+        self.__console.message(f"Setting up experiment...")
+        self.__clocks = ClockService()
+        self.__clocks.start()
+        # Seeds the random generators (recorded, or taken from the session being replayed)
+        self.__session = SessionRecorder(self.__replay_file)
+        self.__session.start()
         experiment_name = 'Optical Neuroimaging and Cognition (ONAC)'
         self.__experiment_info = {'Participant': ''}
-        dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
-        if not dlg.OK:
-            print("User pressed 'Cancel'!")
-            core.quit()
+        if self.__session.replaying:
+            self.__experiment_info = {'Participant': self.__session.participant}
+        else:
+            dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
+            if not dlg.OK:
+                self.__console.message("User pressed 'Cancel'!")
+                self.__console.stop()
+                core.quit()
 
+        self.__session.participant = self.__experiment_info['Participant']
         self.__experiment_info['date'] = data.getDateStr()
         self.__experiment_info['expName'] = experiment_name
         self.__experiment_info['psychopyVersion'] = '2021.2.3'
@@ -61,8 +99,8 @@ class Experiment:
                                                  originPath='C:/Users/emilia/PycharmProjects/experiment/NM_task.py',
                                                  savePickle=True, saveWideText=True,
                                                  dataFileName=self.__endfilename)
-        # Setting up a log file
-        log_file = logging.LogFile(self.__endfilename + '.log', level=logging.EXP)
+        # Setting up a log file (buffered and written off the render thread)
+        self.__log = LogSink(self.__endfilename + '_log.jsonl', level=logging.EXP)
         logging.console.setLevel(logging.WARNING)
         self.__filename_save = '/P' + str(self.__experiment_info['Participant'])
 
@@ -71,7 +109,8 @@ class Experiment:
 
         if self.__mode:
             if self.__port_name is not None:
-                self.__port = serial.Serial(self.__port_name, baudrate=9600)
+                self.__port = TriggerPort(self.__port_name, mode=self.__trigger_mode, baudrate=self.__baudrate,
+                                         ack=self.__ack)
 
         # Set up window
         if self.__monitor:
@@ -91,14 +130,33 @@ class Experiment:
         else:
             frame_dur = 1.0 / 60.0
 
+        # Images are resampled to their on-screen size and kept within a texture budget
+        self.__images = ImageCache(self.__win, session=self.__session)
+
+        # Count dropped frames for the operator console. Intervals are only recorded while a loop flips every
+        # frame; static holds and key waits would otherwise count as dropped frames
+        self.__win.recordFrameIntervals = False
+        self.__win.refreshThreshold = frame_dur + 0.004
+
+        # Start the online signal-quality monitor
+        if self.__quality_source is not None:
+            self.__quality = QualityMonitor(self.__quality_source)
+            self.__quality.start()
+
         # Hide mouse
         self.__win.mouseVisible = False
 
         # Setting up useful trial components
         self.__clock = core.Clock()
-        self.__kb = keyboard.Keyboard()
+        self.__kb = self.__session.keyboard(keyboard.Keyboard)
         self.__blank = TextStim(self.__win, text='')
-        self.__fixation_cross = TextStim(self.__win, text='+', height=0.3, color=(-1, -1, 1))
+        self.__events = EventTable(self.__win, self.__port, self.__console, self.__clocks, self.__session)
+        self.__text = TextCache(self.__win)
+        self.__fixation_cross = self.__text.add('+', height=0.3, color=(-1, -1, 1))
+
+        # Real-time scheduling for the trial loops
+        self.__rush = RushMode(self.__console)
+        self.__rush.apply()
 
 #%%%%% SOME USEFUL FUNCTIONS %%%%%
 
@@ -112,28 +170,35 @@ class Experiment:
         self.__win.flip()
         self.__check_for_escape()
         self.__clock.reset()
-        while self.__clock.getTime() < (duration + (rd.random() / 10)):  # Randomise the baseline duration
-            self.__fixation_cross.draw()
-            self.__win.flip()
-            self.__check_for_escape()
+        self.__session.anchor()  # trial boundary for recorded keys
+        duration = duration + (rd.random() / 10)  # Randomise the baseline duration
+        self.__fixation_cross.draw()
+        self.__win.flip()
+        self.__check_for_escape()
+        gc_time = self.__rush.collect()
+        cpu = hold_static(self.__clock, duration, self.__check_for_escape)
+        self.__console.message('Baseline %.2f s, CPU %.1f%%, GC %.1f ms' % (duration, 100 * cpu, 1000 * gc_time))
         self.__win.color = [-1, -1, -1]
 
     def __break(self):
-        print(f'Break time!')
+        self.__console.message(f'Break time!')
+        if self.__quality is not None:
+            self.__console.message(self.__quality.report())
         break_text = (self.__path + '/Instructions/break.png')
         self.__win.color = [0, 0, 0]
         break_stim = ImageStim(self.__win, break_text, units='pix', size=self.__size)
         break_stim.draw()
         self.__win.flip()
         self.__check_for_escape()
-        psychopy.event.waitKeys()
+        self.__rush.collect()
+        self.__session.wait_keys()
 
     def __ready(self):
         ready_text = ImageStim(self.__win, image=(self.__path + '/Instructions/task_start.png'), units='pix', size=self.__size)
         ready_text.draw()
         self.__win.flip()
         self.__check_for_escape()
-        psychopy.event.waitKeys()
+        self.__session.wait_keys()
 
     def __wait(self, duration=2):
         core.wait(duration+rd.random()/10)
@@ -163,12 +228,13 @@ class Experiment:
         """
 
         instructions = pd.read_csv(filepath)
+        self.__images.schedule(instructions['path'], self.__size)
         for j in instructions['path']:
-            instruction_stim = ImageStim(self.__win, j, units='pix', size=self.__size)
+            instruction_stim = self.__images.stim(j, self.__size)
             instruction_stim.draw()
             self.__win.flip()
             self.__check_for_escape()
-            psychopy.event.waitKeys()
+            self.__session.wait_keys()
 
     def __showimage(self, image, duration=None):
         showimg = ImageStim(self.__win, image=(image), size=self.__size)
@@ -180,32 +246,81 @@ class Experiment:
             self.__win.flip()
             self.__check_for_escape()
         else:
-            psychopy.event.waitKeys()
+            self.__session.wait_keys()
 
     def __start_trigger(self):
-        print('Sending start trigger')
-        self.__win.callOnFlip(self.__port.write, 'Z'.encode())
+        self.__console.message('Sending start trigger')
+        self.__events.on_flip('Z', 'start')
         self.__win.flip()
         self.__check_for_escape()
-        d = datetime.utcnow()
-        self.__this_exp.addData('Time', d)
+        stamp = self.__clocks.stamp()
+        self.__this_exp.addData('Time', datetime.utcfromtimestamp(stamp['wall']))
+        self.__this_exp.addData('Time_mono', stamp['mono'])
+        self.__this_exp.addData('Time_ptb', stamp.get('ptb'))
         self.__this_exp.nextEntry()
 
     #%%%%% TASKS %%%%%
 
+    def __motor_trial(self, stim, audio_stim, trigger, trial, n_trials, duration=10, rest_duration=20):
+        """
+        Shows a movement instruction, plays its recording on the first flip and waits for the end of the movement.
+
+        :param stim: Instruction text stimulus.
+        :param audio_stim: Spoken instruction.
+        :param trigger: Trigger sent on the first flip ('C' trials run for rest_duration without a response).
+        :param trial: Trial number.
+        :param n_trials: Number of trials, for the operator console.
+        :param duration: Minimum trial duration in seconds.
+        :param rest_duration: Duration of the 'C' (rest) trials in seconds.
+        :return: Keys that ended the trial (empty if none).
+        """
+
+        self.__console.progress('motor', trial, n_trials, self.__win.nDroppedFrames)
+        time = duration
+        trigger_sent = False
+        key_pressed = False
+        sound_played = False
+        keys = []
+        next_flip = self.__win.getFutureFlipTime(clock='ptb')
+        self.__clock.reset()
+        self.__session.anchor()  # trial boundary for recorded keys
+        self.__kb.clock.reset()
+        if trigger =='C':
+            time = rest_duration
+        self.__win.recordFrameIntervals = True
+        while self.__clock.getTime() < time and not key_pressed:
+            stim.draw()
+            if self.__mode and not trigger_sent:
+                self.__events.on_flip(trigger, stim.text, trial)
+                trigger_sent = True
+            if not sound_played:
+                audio_stim.play(when=next_flip)
+                sound_played = True
+            self.__win.flip()
+            self.__check_for_escape()
+            if trigger != 'C':
+                keys = self.__kb.getKeys(keyList=None, waitRelease=False)
+                time += 1
+                if len(keys) > 0:
+                    break
+        self.__win.recordFrameIntervals = False
+        return keys
+
     def naturalistic_motor_task(self):
         """
         Task 7: Naturalistic motor task
 
         """
 
-        print(f"Running naturalistic motor task...")
+        self.__console.message(f"Running naturalistic motor task...")
+        self.__events.task = 'motor'
+        self.__session.task_start('motor')
 
         # Load task components
         naturalistic_motor_stims = pd.read_csv(self.__path +
                                                '/naturalistic_motor_task/naturalistic_motor_task_stimuli.csv')
         naturalistic_motor_data = []
-        naturalistic_motor_stim = TextStim(self.__win, text='')
+        self.__text.add_all(naturalistic_motor_stims['stimulus'].unique())
 
         # Instructions
         # print(f'Presenting naturalistic motor task instructions...')
@@ -223,50 +338,29 @@ class Experiment:
             self.__start_trigger()
 
         # Start testing trials
-        print(f'Starting naturalistic motor task testing...')
+        self.__console.message(f'Starting naturalistic motor task testing...')
         for k in list(range(3)):
             self.__kb.clearEvents()
             for j in range(len(naturalistic_motor_stims)):
-                naturalistic_motor_stim.text = naturalistic_motor_stims['stimulus'].iloc[j]
+                naturalistic_motor_stim = self.__text[naturalistic_motor_stims['stimulus'].iloc[j]]
                 trigger = naturalistic_motor_stims['trigger'].iloc[j]
                 end_trigger = naturalistic_motor_stims['end_trigger'].iloc[j]
                 audio_stim = sound.Sound(naturalistic_motor_stims['instruction'].iloc[j])
-
-                time = 10
+                self.__session.asset('sound', naturalistic_motor_stims['instruction'].iloc[j])
 
                 self.__baseline(7)
 
-                trigger_sent = False
-                key_pressed = False
-                sound_played = False
-                next_flip = self.__win.getFutureFlipTime(clock='ptb')
-                self.__clock.reset()
-                self.__kb.clock.reset()
-                if trigger =='C':
-                    time = 20
-                while self.__clock.getTime() < time and not key_pressed:
-                    naturalistic_motor_stim.draw()
-                    if self.__mode and not trigger_sent:
-                        self.__win.callOnFlip(self.__port.write, trigger.encode())
-                        trigger_sent = True
-                    if not sound_played:
-                        audio_stim.play(when=next_flip)
-                        sound_played = True
-                    self.__win.flip()
-                    self.__check_for_escape()
-                    if trigger != 'C':
-                        keys = self.__kb.getKeys(keyList=None, waitRelease=False)
-                        time += 1
-                        if len(keys) > 0:
-                            break
+                keys = self.__motor_trial(naturalistic_motor_stim, audio_stim, trigger, k * len(naturalistic_motor_stims) + j,
+                                          3 * len(naturalistic_motor_stims))
                 if self.__mode:
-                    self.__port.write(end_trigger.encode())
+                    self.__events.close()
+                    self.__events.send(end_trigger, naturalistic_motor_stim.text, k * len(naturalistic_motor_stims) + j)
                 df = pd.DataFrame({'Stimulus': [naturalistic_motor_stim.text],
-                                   'Duration': [keys[-1].rt],
+                                   'Duration': [keys[-1].rt if keys else np.nan],
                                    'Trial': [k]})
                 naturalistic_motor_data.append(df)
                 self.__this_exp.addData('NMT_stimulus', naturalistic_motor_stim.text)
-                self.__this_exp.addData('NMT_duration', keys[-1].rt)
+                self.__this_exp.addData('NMT_duration', keys[-1].rt if keys else np.nan)
                 self.__this_exp.addData('Task', 'NMT')
                 self.__this_exp.nextEntry()
                 self.__wait(1)
@@ -277,7 +371,7 @@ class Experiment:
                 self.__break()
 
         # Data saving
-        print(f'Saving data...')
+        self.__console.message(f'Saving data...')
         naturalistic_motor_data = pd.concat(naturalistic_motor_data, ignore_index=True)
         naturalistic_motor_data.to_csv((self.__path + '/naturalistic_motor_task/participant_data/' + str(self.__filename_save) \
                                         + '_naturalistic_motor_task_data' + self.__experiment_info['date'] + '.csv'), \
@@ -291,7 +385,8 @@ class Experiment:
         :param duration: Duration of wait time before exiting.
         """
 
-        print(f"Ending experiment...")
+        self.__console.message(f"Ending experiment...")
+        self.__rush.release()
         end_text = (self.__path + '/Instructions/task_finished_mid.png')
         ending = ImageStim(self.__win, end_text)
         ending.draw()
@@ -301,9 +396,21 @@ class Experiment:
         self.__win.flip()
         self.__this_exp.saveAsWideText(self.__endfilename + '.csv', delim='auto')
         self.__this_exp.saveAsPickle(self.__endfilename)
-        logging.flush()
-        if self.__mode:
+        self.__events.save(self.__endfilename)
+        self.__clocks.stop()
+        self.__clocks.save(self.__endfilename)
+        self.__console.message('Clock drift (ppm): %s' % self.__clocks.drift())
+        if self.__mode and self.__port is not None:
             self.__port.close()
+            self.__port.save(self.__endfilename)
+            self.__console.message('Triggers: %s' % self.__port.status())
+        self.__session.save(self.__endfilename, self.__win)
+        self.__console.message('Session: %s' % self.__session.status())
+        self.__console.stop()
+        if self.__quality is not None:
+            self.__quality.stop()
+        logging.flush()
+        self.__log.close()
         self.__win.close()
         core.quit()
 
@@ -314,5 +421,22 @@ class Experiment:
         self.naturalistic_motor_task()
         self.__end_all_experiment()
 
-e = Experiment(portname='/dev/tty.usbserial-FTBXN67I', fullscreen=True, test=True, monitor=True)
-e.run()
+# The guard keeps the experiment from starting again in the monitor process (spawned on macOS/Windows)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', default=None, help='session file (*_session.json) to replay without a participant')
+    parser.add_argument('--quality-source', default=None,
+                        help='intensity stream for the signal-quality monitor: a file of float32 frames or '
+                             'tcp://host:port')
+    parser.add_argument('--quality-channels', type=int, default=None, help='channels per frame of --quality-source')
+    args = parser.parse_args()
+    if args.quality_source is not None and args.quality_channels is None:
+        parser.error('--quality-source needs --quality-channels')
+    quality_source = (source_from_arg(args.quality_source, args.quality_channels)
+                      if args.quality_source is not None else None)
+    # A replay sends its triggers to a pty loopback instead of the LUMO
+    loopback = PtyLoopback(echo=False) if args.replay is not None else None
+    portname = loopback.name if loopback is not None else '/dev/tty.usbserial-FTBXN67I'
+    e = Experiment(portname=portname, fullscreen=True, test=True, monitor=True, quality_source=quality_source,
+                   replay=args.replay)
+    e.run()
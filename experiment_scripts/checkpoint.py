@@ -0,0 +1,139 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import os
+import pickle
+import random as rd
+import threading
+
+import numpy as np
+
+from rush_mode import io_thread
+
+#%%%%%%%%%% Checkpoints %%%%%%%%%%
+
+
+class Checkpoint:
+    """
+    Writes session checkpoints at block boundaries so a task can be resumed after a crash or escape.
+
+    save() only takes a snapshot of the state (lists are copied, everything else is stored by
+    reference and must not change afterwards) and hands it to a writer thread. Pickling and the
+    atomic file replace happen there, so a checkpoint never delays a flip. If checkpoints come in
+    faster than they can be written, only the latest is kept. Failed writes are reported to the
+    operator console and kept in error; the next save() tries again.
+
+    :param filename: Checkpoint file.
+    :param console: Operator console for write failures.
+    """
+
+    def __init__(self, filename, console):
+        self.filename = filename
+        self.error = None
+        self.__console = console
+        self.__latest = None
+        self.__pending = threading.Event()
+        self.__written = threading.Event()
+        self.__written.set()
+        self.__lock = threading.Lock()
+        # Held by the writer for the whole of a write, so remove() can wait for one in progress
+        self.__writing = threading.Lock()
+        self.__running = True
+        self.__start_writer()
+
+    def __report(self, text):
+        self.__console.message(text)
+
+    def __start_writer(self):
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__writer.start()
+
+    def __write(self, state):
+        tmp = self.filename + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.filename)
+            self.error = None
+        except Exception as error:
+            self.error = error
+            self.__report('Checkpoint not written (%s: %s)' % (type(error).__name__, error))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def __write_loop(self):
+        io_thread()
+        while self.__running or self.__pending.is_set():
+            if not self.__pending.wait(timeout=0.1):
+                continue
+            with self.__writing:
+                with self.__lock:
+                    state = self.__latest
+                    self.__pending.clear()
+                # remove() may have dropped the pending checkpoint while this thread waited
+                if state is not None:
+                    self.__write(state)
+            if not self.__pending.is_set():
+                self.__written.set()
+
+    def save(self, **state):
+        """
+        Queues a checkpoint. The random number generator states are added automatically.
+
+        :param state: Task state, e.g. task name, block index, stimulus order and trial data so far.
+        """
+
+        snapshot = {key: list(value) if isinstance(value, list) else value for key, value in state.items()}
+        snapshot['random_state'] = rd.getstate()
+        snapshot['numpy_state'] = np.random.get_state()
+        with self.__lock:
+            self.__latest = snapshot
+            self.__written.clear()
+            self.__pending.set()
+        if not self.__writer.is_alive():
+            self.__report('Checkpoint writer stopped; restarting it')
+            self.__start_writer()
+
+    def flush(self, timeout=2):
+        """
+        Waits for the pending checkpoint to be written.
+
+        :return: True if it was written in time.
+        """
+
+        return self.__written.wait(timeout)
+
+    def close(self):
+        self.__running = False
+        self.__writer.join(timeout=2)
+        if self.__writer.is_alive():
+            self.__report('Checkpoint writer did not finish; the last checkpoint may be missing')
+
+    def remove(self):
+        """
+        Deletes the checkpoint once the task it belongs to has finished. A pending checkpoint is dropped and a
+        write in progress is waited for, so none can recreate the file afterwards.
+        """
+
+        with self.__writing:
+            with self.__lock:
+                self.__latest = None
+                self.__pending.clear()
+                self.__written.set()
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+
+
+def load_checkpoint(filename):
+    """
+    Loads a checkpoint and restores the random number generator states it holds.
+
+    :param filename: Checkpoint file written by Checkpoint.
+    :return: The saved state dict.
+    """
+
+    with open(filename, 'rb') as f:
+        state = pickle.load(f)
+    rd.setstate(state['random_state'])
+    np.random.set_state(state['numpy_state'])
+    return state
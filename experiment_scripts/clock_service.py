@@ -0,0 +1,143 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import core
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import threading
+import time
+
+from rush_mode import io_thread
+
+try:
+    import psychtoolbox as ptb
+except ImportError:
+    ptb = None
+
+#%%%%%%%%%% Clock service %%%%%%%%%%
+
+
+def ptb_audio_clock(snd):
+    """
+    Reads the device time of the audio stream behind a PsychoPy (PTB backend) Sound.
+
+    :param snd: A psychopy.sound.Sound.
+    :return: Callable returning the current stream time, or None if the backend does not expose it.
+    """
+
+    stream = getattr(snd, 'stream', None)
+    if stream is None or 'CurrentStreamTime' not in getattr(stream, 'status', {}):
+        return None
+    return lambda: stream.status['CurrentStreamTime']
+
+
+class ClockService:
+    """
+    Stamps events on one monotonic clock (core.getTime) and maps them onto the other clocks in use:
+    wall time, the psychtoolbox clock and, if given, the audio device clock.
+
+    A background thread samples every clock against the monotonic one once per interval. Each read is
+    bracketed by two monotonic reads and paired with their midpoint. A straight line is fitted to the
+    last `window` samples, so the mappings follow drift. Drift is reported in parts per million.
+    """
+
+    def __init__(self, audio_clock=None, interval=1.0, window=300):
+        self.__clocks = {'wall': time.time}
+        if ptb is not None:
+            self.__clocks['ptb'] = ptb.GetSecs
+        if audio_clock is not None:
+            self.__clocks['audio'] = audio_clock
+        self.__window = window
+        self.__samples = {name: deque(maxlen=window) for name in self.__clocks}
+        self.__fits = {name: (1.0, 0.0, 0.0) for name in self.__clocks}  # slope, offset, reference time
+        self.__history = []
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__running = False
+        self.__thread = None
+
+    @staticmethod
+    def now():
+        return core.getTime()
+
+    def add_clock(self, name, read):
+        with self.__lock:
+            self.__clocks[name] = read
+            self.__samples[name] = deque(maxlen=self.__window)
+            self.__fits[name] = (1.0, 0.0, 0.0)
+
+    def sync(self):
+        """
+        Samples every clock once and refits the mappings.
+        """
+
+        with self.__lock:
+            for name, read in self.__clocks.items():
+                before = core.getTime()
+                value = read()
+                after = core.getTime()
+                mono = (before + after) / 2
+                self.__samples[name].append((mono, value))
+                self.__history.append((name, mono, value, after - before))
+                t, v = np.array(self.__samples[name]).T
+                ref = t[0]
+                if len(t) > 1:
+                    slope, offset = np.polyfit(t - ref, v, 1)
+                else:
+                    slope, offset = 1.0, v[0]
+                self.__fits[name] = (slope, offset, ref)
+
+    def __run(self):
+        io_thread()
+        while self.__running:
+            self.sync()
+            time.sleep(self.__interval)
+
+    def start(self):
+        self.sync()
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join(timeout=2 * self.__interval)
+
+    def to(self, name, t):
+        slope, offset, ref = self.__fits[name]
+        return offset + slope * (t - ref)
+
+    def stamp(self, t=None):
+        """
+        Expresses a monotonic time on every clock.
+
+        :param t: Time from core.getTime (defaults to now).
+        :return: Dict with 'mono' and one entry per mapped clock.
+        """
+
+        t = core.getTime() if t is None else t
+        stamps = {'mono': t}
+        for name in self.__fits:
+            stamps[name] = self.to(name, t)
+        return stamps
+
+    def drift(self):
+        """
+        :return: Dict of each clock's rate relative to the monotonic clock, in parts per million.
+        """
+
+        return {name: (fit[0] - 1) * 1e6 for name, fit in self.__fits.items()}
+
+    def save(self, filename):
+        """
+        Writes every sync sample, so the mappings can be refitted offline.
+
+        :param filename: Output filename without extension.
+        """
+
+        with self.__lock:
+            samples = pd.DataFrame(self.__history, columns=['clock', 'mono', 'value', 'read_time'])
+        samples.to_csv(filename + '_clock_sync.csv', header=True, index=False, float_format='%.9f')
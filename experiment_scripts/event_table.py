@@ -0,0 +1,106 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import core
+
+import pandas as pd
+import numpy as np
+
+#%%%%%%%%%% Event table %%%%%%%%%%
+
+EVENT_COLUMNS = ['task', 'onset', 'flip_time', 'trigger', 'code', 'condition', 'duration', 'wall_time',
+                 'ptb_time', 'audio_time']
+
+
+class EventTable:
+    """
+    Keeps one row per trigger byte sent to the LUMO so that the recording can be epoched
+    without rebuilding onsets by hand.
+
+    Onsets are in seconds relative to the flip that carried the last 'Z' start trigger, which
+    is the marker the LUMO stores in the recording. Flip times are on the PsychoPy clock; with a
+    ClockService each row is also stamped with wall, psychtoolbox and audio device time. With a
+    SessionRecorder every trigger is also an anchor for the recorded keys.
+    """
+
+    def __init__(self, win, port=None, console=None, clocks=None, session=None):
+        self.__win = win
+        self.__port = port
+        self.__console = console
+        self.__clocks = clocks
+        self.__session = session
+        self.__rows = []
+        self.__start_time = np.nan
+        self.__open = None
+        self.task = ''
+
+    def __record(self, trigger, condition, trial, critical):
+        flip_time = core.getTime()
+        if self.__port is not None:
+            self.__port.send(trigger, condition, len(self.__rows) if trial is None else trial, critical)
+        if trigger == 'Z':
+            self.__start_time = flip_time
+        stamps = self.__clocks.stamp(flip_time) if self.__clocks is not None else {}
+        self.__rows.append([self.task, flip_time - self.__start_time, flip_time, trigger, ord(trigger),
+                            condition, np.nan, stamps.get('wall', np.nan), stamps.get('ptb', np.nan),
+                            stamps.get('audio', np.nan)])
+        if self.__console is not None:
+            self.__console.trigger(trigger, flip_time - self.__start_time)
+        if self.__session is not None:
+            self.__session.anchor(flip_time)
+        return len(self.__rows) - 1
+
+    def __record_open(self, trigger, condition, trial):
+        row = self.__record(trigger, condition, trial, True)
+        # A flip-locked row still open when the next one flips ends there, so every stimulus gets a duration
+        if self.__open is not None:
+            previous = self.__rows[self.__open]
+            previous[6] = self.__rows[row][2] - previous[2]
+        # The start marker is not a stimulus and keeps no duration
+        self.__open = None if trigger == 'Z' else row
+
+    def on_flip(self, trigger, condition='', trial=None):
+        """
+        Sends a trigger on the next flip and stamps it with the flip time.
+
+        :param trigger: Single character trigger code.
+        :param condition: Condition label stored alongside the trigger.
+        :param trial: Trial index carried by binary triggers (defaults to the row number).
+        """
+
+        self.__win.callOnFlip(self.__record_open, trigger, condition, trial)
+
+    def send(self, trigger, condition='', trial=None, critical=True):
+        """
+        Sends a trigger straight away, for markers that are not locked to a flip.
+
+        :param trigger: Single character trigger code.
+        :param condition: Condition label stored alongside the trigger.
+        :param trial: Trial index carried by binary triggers (defaults to the row number).
+        :param critical: False lets the trigger port batch the marker with others.
+        """
+
+        self.__record(trigger, condition, trial, critical)
+
+    def close(self):
+        """
+        Sets the duration of the last flip-locked trigger to the time elapsed since its flip. A flip-locked
+        trigger that is not closed ends at the flip of the next one.
+        """
+
+        if self.__open is not None:
+            row = self.__rows[self.__open]
+            row[6] = core.getTime() - row[2]
+            self.__open = None
+
+    def to_frame(self):
+        return pd.DataFrame(self.__rows, columns=EVENT_COLUMNS)
+
+    def save(self, filename):
+        """
+        Writes the event table as a csv that readtable (MATLAB) and preprocessing/events.py can load.
+
+        :param filename: Output filename without extension.
+        """
+
+        self.to_frame().to_csv(filename + '_events.csv', header=True, index=False, float_format='%.6f')
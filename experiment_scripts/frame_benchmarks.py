@@ -0,0 +1,436 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Per-frame overhead benchmarks for the trial loops of the tasks. Each benchmark calls the task's own trial
+# method (Experiment.__memory_trial, __flicker_trial, __motor_trial and the MMN __tones stream) with the real
+# EventTable, ClockService, OperatorConsole, recording keyboard and a binary TriggerPort on a pty loopback.
+# Only the window, the stimuli and the keyboard device are stubs: the stub window's flip advances a frame clock
+# by one refresh period, so the clock-gated branches (prompt after the image, detection dot, tone onsets) run
+# on the frames they would on a display.
+#
+# Needs PsychoPy (with pyglet, which psychopy.visual imports) and pandas/SciPy, but no display; psychtoolbox is
+# optional. A task module is only imported when its loop runs, so --loops can leave out a task whose imports are
+# missing. --smoke runs every loop once over a few frames without the history, as a check that the loops still
+# run (e.g. in CI), not a timing.
+#
+# Every loop is measured several times and gated on the median against the median of earlier passing runs
+# in a local SQLite history. A run fails when a loop is slower by more than the tolerance and by more than
+# three times the run-to-run spread. Only passing runs are stored unless --save-always is given.
+#
+#   python frame_benchmarks.py [--frames 20000] [--repeats 5] [--tolerance 0.25] [--no-save | --save-always]
+#                              [--loops memory_task ...] [--smoke]
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import data
+from psychopy.constants import STARTED
+
+import argparse
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy as np
+import pandas as pd
+
+from checkpoint import Checkpoint
+from clock_service import ClockService
+from event_table import EventTable
+from operator_console import OperatorConsole
+from scheduler import FrameScheduler, Seconds
+from session_replay import SessionRecorder
+from trigger_protocol import PtyLoopback, TriggerPort
+
+_thisDir = os.path.dirname(os.path.abspath(__file__))
+
+#%%%%%%%%%% Stubs %%%%%%%%%%
+
+
+class StubWindow:
+    """
+    Runs the callOnFlip functions on flip and advances time by one refresh period, without drawing.
+    """
+
+    def __init__(self, refresh=60.0):
+        self.__on_flip = []
+        self.period = 1.0 / refresh
+        self.time = 0.0
+        self.frames = 0
+        self.probe = None
+        self.nDroppedFrames = 0
+        self.recordFrameIntervals = False
+        self.color = [-1, -1, -1]
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self.__on_flip.append((function, args, kwargs))
+
+    def flip(self):
+        on_flip, self.__on_flip = self.__on_flip, []
+        for function, args, kwargs in on_flip:
+            function(*args, **kwargs)
+        self.time += self.period
+        self.frames += 1
+        if self.probe is not None:
+            self.probe()
+        return self.time
+
+    def getFutureFlipTime(self, clock=None):
+        return self.time + self.period
+
+
+class FrameClock:
+    """
+    A clock that only moves when the stub window flips.
+    """
+
+    def __init__(self, win):
+        self.__win = win
+        self.__t0 = win.time
+
+    def getTime(self):
+        return self.__win.time - self.__t0
+
+    def reset(self, newT=0.0):
+        self.__t0 = self.__win.time + newT
+
+
+class StubKey:
+    def __init__(self, name, rt):
+        self.name = name
+        self.rt = rt
+        self.duration = None
+
+
+class StubKeyboard:
+    """
+    Presses each key once per trial, when the task clock passes its time.
+
+    :param win: Stub window.
+    :param clock: The task clock, which every trial resets.
+    :param presses: List of (time in the trial, key name).
+    """
+
+    def __init__(self, win, clock, presses=()):
+        self.clock = FrameClock(win)
+        self.__task_clock = clock
+        self.__presses = list(presses)
+        self.__due = list(presses)
+        self.__last = 0.0
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        t = self.__task_clock.getTime()
+        if t < self.__last:
+            self.__due = list(self.__presses)
+        self.__last = t
+        keys = []
+        for press in self.__due:
+            if press[0] <= t and (keyList is None or press[1] in keyList):
+                keys.append(StubKey(press[1], self.clock.getTime()))
+        for key in keys:
+            self.__due = [press for press in self.__due if press[1] != key.name]
+        return keys
+
+    def clearEvents(self, eventType=None):
+        pass
+
+
+class StubStim:
+    def __init__(self, text=''):
+        self.text = text
+
+    def draw(self):
+        pass
+
+
+class StubSound:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def play(self, when=None):
+        pass
+
+
+class StubMovie:
+    status = STARTED
+
+    def getCurrentFrameTime(self):
+        return 0.0
+
+#%%%%%%%%%% Benchmarked experiments %%%%%%%%%%
+
+
+class Bench:
+    """
+    An Experiment of one of the task modules with the real per-trial components and a stub window.
+
+    :param module: Task module, e.g. frontal_tasks.
+    :param presses: Keys the stub keyboard presses in every trial, as (time, name).
+    :param kwargs: Extra Experiment arguments (e.g. volume for the MMN task).
+    """
+
+    def __init__(self, module, presses=(), **kwargs):
+        self.win = StubWindow()
+        self.clock = FrameClock(self.win)
+        self.__directory = tempfile.mkdtemp()
+        self.__loopback = PtyLoopback(echo=False)
+        self.__port = TriggerPort(self.__loopback.name, mode='binary', baudrate=115200)
+        session = SessionRecorder()
+        session.start()
+        console = OperatorConsole()  # Not started: events stay in its deque, as when the pump falls behind
+        self.__checkpoint = Checkpoint(os.path.join(self.__directory, 'bench_checkpoint.pkl'), console)
+        clocks = ClockService()
+        clocks.sync()
+        components = {'win': self.win, 'clock': self.clock, 'session': session, 'console': console,
+                      'clocks': clocks, 'port': self.__port, 'checkpoint': self.__checkpoint,
+                      'kb': session.keyboard(lambda: StubKeyboard(self.win, self.clock, presses)),
+                      'events': EventTable(self.win, self.__port, console, clocks, session),
+                      'experiment_info': {'Participant': 'bench'},
+                      'this_exp': data.ExperimentHandler(name='bench', savePickle=False, saveWideText=False)}
+        self.experiment = module.Experiment(portname=None, test=True, fullscreen=False, monitor=False, **kwargs)
+        # The trial methods only see these through the experiment's (name-mangled) attributes
+        for name, value in components.items():
+            setattr(self.experiment, '_Experiment__' + name, value)
+
+    def method(self, name):
+        return getattr(self.experiment, '_Experiment__' + name)
+
+    def close(self):
+        self.__checkpoint.close()
+        self.__port.close()
+        self.__loopback.close()
+        for name in os.listdir(self.__directory):
+            os.remove(os.path.join(self.__directory, name))
+        os.rmdir(self.__directory)
+
+#%%%%%%%%%% Loops %%%%%%%%%%
+# Each function returns a Bench and a callable that runs one trial (or one block of frames) of the task. The
+# task modules are imported here, so that a loop only needs the imports of its own task.
+
+
+def memory_task():
+    import frontal_tasks
+    bench = Bench(frontal_tasks, presses=[(1.2, 'left'), (3.8, 'right')])
+    trial = bench.method('memory_trial')
+    image, prompt = StubStim(), StubStim('Old or new?')
+    return bench, lambda: trial(image, prompt, 0, 120)
+
+
+def visual_stimulation():
+    import visual_stim
+    bench = Bench(visual_stim, presses=[(4.0, 'space')])
+    trial = bench.method('flicker_trial')
+    stims = (StubStim(), StubStim(), StubStim('+'), StubStim())
+    return bench, lambda: trial(stims, 1 / 7.5, (3, 5), 'E', 'left', 0, 40)
+
+
+def naturalistic_motor_task():
+    import NM_task
+    bench = Bench(NM_task, presses=[(6.0, 'space')])
+    trial = bench.method('motor_trial')
+    stim, instruction = StubStim('Wave your hand'), StubSound()
+    return bench, lambda: trial(stim, instruction, 'A', 0, 30)
+
+
+def tone_table(n_tones=400, deviant_every=8):
+    deviant = np.arange(n_tones) % deviant_every == deviant_every - 1
+    return pd.DataFrame({'Trigger': np.where(deviant, 'B', 'A'), 'Condition': np.where(deviant, 'deviant', 'standard'),
+                         'Sound': np.where(deviant, 'deviant', 'standard'), 'Timing': 0.5})
+
+
+def mismatched_negativity(n_idle=0, block=1500):
+    import MMN_task
+    # The wav files are not loaded: decoding is asset I/O rather than frame overhead
+    MMN_task.sound = types.SimpleNamespace(Sound=StubSound)
+    bench = Bench(MMN_task, volume=1)
+    scheduler = FrameScheduler(bench.win, bench.clock, on_frame=bench.method('check_for_escape'))
+    tone_data = []
+    scheduler.add(bench.method('tones')(tone_table(), StubMovie(), tone_data))
+
+    def probe():
+        while True:
+            yield Seconds(3600)
+
+    for _ in range(n_idle):
+        scheduler.add(probe(), background=True)
+
+    def frames():
+        # Every block starts from an empty data list, so the checkpoints do not grow from one repeat to the next
+        tone_data.clear()
+        for _ in range(block):
+            scheduler.step()
+    return bench, frames
+
+
+def scheduled_streams(n_idle=16):
+    # The MMN tone stream next to idle streams, e.g. vigilance probes
+    return mismatched_negativity(n_idle)
+
+
+LOOPS = {'memory_task': memory_task, 'visual_stimulation': visual_stimulation,
+         'naturalistic_motor_task': naturalistic_motor_task, 'mismatched_negativity': mismatched_negativity,
+         'scheduled_streams': scheduled_streams}
+
+#%%%%%%%%%% Measurement %%%%%%%%%%
+
+
+def spread(values):
+    """
+    Median absolute deviation, scaled to the standard deviation of normal noise.
+    """
+
+    values = np.asarray(values, dtype=float)
+    return 1.4826 * float(np.median(np.abs(values - np.median(values))))
+
+
+def measure(make_loop, n_frames, repeats=5):
+    """
+    Times a trial loop and measures its allocations.
+
+    :param make_loop: Function of LOOPS.
+    :param n_frames: Frames per repeat (whole trials are run, so a repeat may run a few more).
+    :param repeats: Number of timed repeats.
+    :return: Dict with the median ns per frame and its spread over the repeats, transient bytes allocated per
+        frame and memory blocks kept per frame.
+    """
+
+    bench, trial = make_loop()
+    win = bench.win
+    try:
+        trial()
+        times = []
+        for _ in range(repeats):
+            start_frame, start = win.frames, time.perf_counter_ns()
+            while win.frames - start_frame < n_frames:
+                trial()
+            times.append((time.perf_counter_ns() - start) / (win.frames - start_frame))
+
+        # Allocations are measured over one more trial, separately since tracing slows the loop down
+        transient = [0]
+
+        def probe():
+            transient[0] += tracemalloc.get_traced_memory()[1] - tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        start_frame, blocks = win.frames, sys.getallocatedblocks()
+        tracemalloc.start()
+        win.probe = probe
+        trial()
+        win.probe = None
+        tracemalloc.stop()
+        n_traced = max(1, win.frames - start_frame)
+    finally:
+        bench.close()
+    return {'ns_per_frame': float(np.median(times)), 'spread': spread(times), 'bytes_per_frame': transient[0] / n_traced,
+            'blocks_per_frame': (sys.getallocatedblocks() - blocks) / n_traced}
+
+#%%%%%%%%%% History %%%%%%%%%%
+
+
+def open_history(filename):
+    db = sqlite3.connect(filename)
+    db.execute('CREATE TABLE IF NOT EXISTS runs (time TEXT, revision TEXT, python TEXT, loop TEXT, '
+               'ns_per_frame REAL, spread REAL, bytes_per_frame REAL, blocks_per_frame REAL, passed INTEGER)')
+    return db
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_thisDir, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def baseline(db, loop, python, n_runs=10):
+    """
+    :return: Tuple of the median ns per frame of the last passing runs and its noise (the larger of the spread
+        between those runs and their typical spread within a run), or None with fewer than three runs.
+    """
+
+    rows = db.execute('SELECT ns_per_frame, spread FROM runs WHERE loop = ? AND python = ? AND passed = 1 '
+                      'ORDER BY time DESC LIMIT ?', (loop, python, n_runs)).fetchall()
+    if len(rows) < 3:
+        return None
+    medians, spreads = np.array(rows).T
+    return float(np.median(medians)), max(spread(medians), float(np.median(spreads)))
+
+
+def run(n_frames=20000, repeats=5, tolerance=0.25, history=None, save=True, save_always=False, loops=None):
+    """
+    Runs the loop benchmarks and checks them against the recent history.
+
+    :param n_frames: Frames per repeat.
+    :param repeats: Timed repeats per loop; the median is compared.
+    :param tolerance: Allowed slowdown relative to the baseline, as a fraction.
+    :param history: SQLite file (defaults to frame_benchmarks.sqlite next to this script).
+    :param save: Store this run in the history if it passed.
+    :param save_always: Store this run even if it failed (it is kept out of later baselines).
+    :param loops: Keys of LOOPS to run (all if None).
+    :return: True when no loop regressed.
+    """
+
+    db = open_history(history or os.path.join(_thisDir, 'frame_benchmarks.sqlite'))
+    python = platform.python_implementation() + ' ' + platform.python_version()
+    now, revision = time.strftime('%Y-%m-%dT%H:%M:%S'), git_revision()
+    passed = True
+    results = {}
+    print('%-26s %12s %9s %14s %14s %16s' % ('loop', 'ns/frame', 'spread', 'bytes/frame', 'blocks/frame',
+                                            'vs baseline'))
+    for loop in loops or LOOPS:
+        result = results[loop] = measure(LOOPS[loop], n_frames, repeats)
+        reference = baseline(db, loop, python)
+        if reference is None:
+            change = 'no baseline'
+        else:
+            median, noise = reference
+            slower = result['ns_per_frame'] - median
+            change = '%+.0f%%' % (100 * slower / median)
+            if slower > max(tolerance * median, 3 * max(noise, result['spread'])):
+                passed = False
+                change += ' REGRESSION'
+        print('%-26s %12.0f %9.0f %14.1f %14.2f %16s' % (loop, result['ns_per_frame'], result['spread'],
+                                                         result['bytes_per_frame'], result['blocks_per_frame'],
+                                                         change))
+    if (save and passed) or save_always:
+        for loop, result in results.items():
+            db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (now, revision, python, loop, result['ns_per_frame'], result['spread'],
+                        result['bytes_per_frame'], result['blocks_per_frame'], int(passed)))
+        db.commit()
+    db.close()
+    return passed
+
+
+def smoke(n_frames=200, loops=None):
+    """
+    Runs each loop once over a few frames, without timing it against or storing it in the history.
+
+    :param n_frames: Frames to run per loop.
+    :param loops: Keys of LOOPS to run (all if None).
+    """
+
+    for loop in loops or LOOPS:
+        result = measure(LOOPS[loop], n_frames, repeats=1)
+        print('%-26s ran (%.0f ns/frame)' % (loop, result['ns_per_frame']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-frame overhead benchmarks for the task loops')
+    parser.add_argument('--frames', type=int, default=20000, help='frames per repeat')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--history', default=None)
+    parser.add_argument('--no-save', action='store_true', help='do not store this run')
+    parser.add_argument('--save-always', action='store_true', help='store this run even if it regressed')
+    parser.add_argument('--loops', nargs='+', choices=list(LOOPS), default=None, help='loops to run (default: all)')
+    parser.add_argument('--smoke', action='store_true', help='run each loop briefly, without the history')
+    args = parser.parse_args()
+    if args.smoke:
+        smoke(loops=args.loops)
+        sys.exit(0)
+    sys.exit(0 if run(args.frames, args.repeats, args.tolerance, args.history, not args.no_save, args.save_always,
+                      args.loops) else 1)
@@ -12,7 +12,20 @@ import pandas as pd
 import numpy as np
 import random as rd
 import os
-import serial
+import argparse
+
+from checkpoint import Checkpoint, load_checkpoint
+from clock_service import ClockService
+from event_table import EventTable
+from image_cache import ImageCache
+from log_sink import LogSink
+from operator_console import OperatorConsole
+from quality_monitor import QualityMonitor, source_from_arg
+from rush_mode import RushMode
+from session_replay import SessionRecorder
+from static_screen import hold_static
+from text_cache import TextCache
+from trigger_protocol import PtyLoopback, TriggerPort
 
 #%%%%%%%%%% Path directories %%%%%%%%%%
 _thisDir = os.path.dirname(os.path.abspath(__file__))
@@ -22,8 +35,14 @@ os.chdir(_thisDir)
 
 class Experiment:
 
-    def __init__(self, portname, test, fullscreen, monitor):
+    def __init__(self, portname, test, fullscreen, monitor, quality_source=None, resume=None, trigger_mode='ascii',
+                 baudrate=9600, ack=False, replay=None):
         self.__port_name = portname
+        self.__replay_file = replay
+        self.__session = None
+        self.__trigger_mode = trigger_mode
+        self.__baudrate = baudrate
+        self.__ack = ack
         self.__path = '/Users/emilia/Documents/Dementia task piloting/Lumo'
         self.__win = None
         self.__clock = None
@@ -31,6 +50,13 @@ class Experiment:
         self.__port = None
         self.__blank = None
         self.__fixation_cross = None
+        self.__events = None
+        self.__clocks = None
+        self.__images = None
+        self.__console = None
+        self.__rush = None
+        self.__log = None
+        self.__text = None
         self.__filename_save = None
         self.__experiment_info = None
         self.__this_exp = None
@@ -39,32 +65,57 @@ class Experiment:
         self.__fullscreen = fullscreen
         self.__mode = test
         self.__monitor = monitor
+        self.__quality_source = quality_source
+        self.__quality = None
+        self.__resume_file = resume
+        self.__resume = None
+        self.__checkpoint = None
 
     #%%%%% SETTING UP EXPERIMENT %%%%%
     def __setup(self):
-        print(f"Setting up experiment...")
+        self.__console = OperatorConsole()
+        self.__console.start()
+        self.__console.message(f"Setting up experiment...")
+        self.__clocks = ClockService()
+        self.__clocks.start()
+        # Seeds the random generators (recorded, or taken from the session being replayed)
+        self.__session = SessionRecorder(self.__replay_file)
+        self.__session.start()
         experiment_name = 'Optical Neuroimaging and Cognition (ONAC)'
         self.__experiment_info = {'Participant': ''}
-        if self.__mode:
+        if self.__session.replaying:
+            self.__experiment_info = {'Participant': self.__session.participant}
+        elif self.__resume_file is not None:
+            self.__resume = load_checkpoint(self.__resume_file)
+            self.__experiment_info = {'Participant': self.__resume['experiment_info']['Participant']}
+            self.__console.message('Resuming %s from %s' % (self.__resume['task'], self.__resume_file))
+        elif self.__mode:
             dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
             if not dlg.OK:
-                print("User pressed 'Cancel'!")
+                self.__console.message("User pressed 'Cancel'!")
+                self.__console.stop()
                 core.quit()
         else:
             self.__experiment_info = {'Participant': 'test'}
 
+        self.__session.participant = self.__experiment_info['Participant']
         self.__experiment_info['date'] = data.getDateStr()
         self.__experiment_info['expName'] = experiment_name
         self.__experiment_info['psychopyVersion'] = '2021.2.3'
         self.__endfilename = _thisDir + os.sep + u'data/%s_%s_%s_%s' % (self.__experiment_info['Participant'],
                                                            experiment_name, self.__experiment_info['date'], 'frontal_tasks')
+        # A resumed session keeps checkpointing to the file it was resumed from, so finishing removes it
+        checkpoint_file = self.__endfilename + '_checkpoint.pkl'
+        if self.__resume is not None:
+            checkpoint_file = self.__resume_file
+        self.__checkpoint = Checkpoint(checkpoint_file, self.__console)
 
         self.__this_exp = data.ExperimentHandler(name=experiment_name, extraInfo=self.__experiment_info,
                                                  originPath='C:/Users/emilia/PycharmProjects/experiment/frontal_tasks.py',
                                                  savePickle=True, saveWideText=True,
                                                  dataFileName=self.__endfilename)
-        # Setting up a log file
-        log_file = logging.LogFile(self.__endfilename + '.log', level=logging.EXP)
+        # Setting up a log file (buffered and written off the render thread)
+        self.__log = LogSink(self.__endfilename + '_log.jsonl', level=logging.EXP)
         logging.console.setLevel(logging.WARNING)
         self.__filename_save = '/P' + str(self.__experiment_info['Participant'])
 
@@ -73,7 +124,8 @@ class Experiment:
 
         if self.__mode:
             if self.__port_name is not None:
-                self.__port = serial.Serial(self.__port_name, baudrate=9600)
+                self.__port = TriggerPort(self.__port_name, mode=self.__trigger_mode, baudrate=self.__baudrate,
+                                         ack=self.__ack)
 
         if self.__monitor:
             self.__size = (1920, 1080)
@@ -92,14 +144,33 @@ class Experiment:
         else:
             frame_dur = 1.0 / 60.0
 
+        # Images are resampled to their on-screen size and kept within a texture budget
+        self.__images = ImageCache(self.__win, session=self.__session)
+
+        # Count dropped frames for the operator console. Intervals are only recorded while a loop flips every
+        # frame; static holds and key waits would otherwise count as dropped frames
+        self.__win.recordFrameIntervals = False
+        self.__win.refreshThreshold = frame_dur + 0.004
+
+        # Start the online signal-quality monitor
+        if self.__quality_source is not None:
+            self.__quality = QualityMonitor(self.__quality_source)
+            self.__quality.start()
+
         # Hide mouse
         self.__win.mouseVisible = False
 
         # Setting up useful trial components
         self.__clock = core.Clock()
-        self.__kb = keyboard.Keyboard()
+        self.__kb = self.__session.keyboard(keyboard.Keyboard)
         self.__blank = TextStim(self.__win, text='')
-        self.__fixation_cross = TextStim(self.__win, text='+', height=0.1, color=(-1, -1, 1))
+        self.__events = EventTable(self.__win, self.__port, self.__console, self.__clocks, self.__session)
+        self.__text = TextCache(self.__win)
+        self.__fixation_cross = self.__text.add('+', height=0.1, color=(-1, -1, 1))
+
+        # Real-time scheduling for the trial loops
+        self.__rush = RushMode(self.__console)
+        self.__rush.apply()
 
 #%%%%% SOME USEFUL FUNCTIONS %%%%%
 
@@ -111,28 +182,35 @@ class Experiment:
     def __baseline(self, duration=30):
         self.__win.color = [0, 0, 0]
         self.__clock.reset()
-        while self.__clock.getTime() < (duration + (rd.random() / 10)):  # Randomise the baseline duration
-            self.__fixation_cross.draw()
-            self.__win.flip()
-            self.__check_for_escape()
+        self.__session.anchor()  # trial boundary for recorded keys
+        duration = duration + (rd.random() / 10)  # Randomise the baseline duration
+        self.__fixation_cross.draw()
+        self.__win.flip()
+        self.__check_for_escape()
+        gc_time = self.__rush.collect()
+        cpu = hold_static(self.__clock, duration, self.__check_for_escape)
+        self.__console.message('Baseline %.2f s, CPU %.1f%%, GC %.1f ms' % (duration, 100 * cpu, 1000 * gc_time))
         self.__win.color = [-1, -1, -1]
 
     def __break(self):
-        print(f'Break time!')
+        self.__console.message(f'Break time!')
+        if self.__quality is not None:
+            self.__console.message(self.__quality.report())
         break_text = (self.__path + '/Instructions/task_finished.png')
         break_stim = ImageStim(self.__win, break_text, units='pix', size=self.__size)
         self.__win.color = [0, 0, 0]
         break_stim.draw()
         self.__win.flip()
         self.__check_for_escape()
-        psychopy.event.waitKeys()
+        self.__rush.collect()
+        self.__session.wait_keys()
 
     def __ready(self):
         ready_text = ImageStim(self.__win, image=(self.__path + '/ready.png'), units='pix', size=self.__size)
         ready_text.draw()
         self.__win.flip()
         self.__check_for_escape()
-        psychopy.event.waitKeys()
+        self.__session.wait_keys()
 
     def __wait(self, duration=2):
         core.wait(duration+rd.random()/10)
@@ -162,13 +240,14 @@ class Experiment:
         """
 
         instructions = pd.read_csv(filepath)
+        self.__images.schedule(instructions['path'], self.__size)
         self.__win.color = [0, 0, 0]
         for j in instructions['path']:
-            instruction_stim = ImageStim(self.__win, j, units='pix', size=self.__size)
+            instruction_stim = self.__images.stim(j, self.__size)
             instruction_stim.draw()
             self.__win.flip()
             self.__check_for_escape()
-            psychopy.event.waitKeys()
+            self.__session.wait_keys()
 
     def __showimage(self, image, duration=None):
         showimg = ImageStim(self.__win, image=image, size=self.__size)
@@ -181,19 +260,21 @@ class Experiment:
             self.__win.flip()
             self.__check_for_escape()
         else:
-            psychopy.event.waitKeys()
+            self.__session.wait_keys()
 
     def __chunking(self, lst, n):
         for i in range(0, len(lst), n):
             yield lst[i:i + n]
 
     def __start_trigger(self):
-        print('Sending start trigger')
-        self.__win.callOnFlip(self.__port.write, 'Z'.encode())
+        self.__console.message('Sending start trigger')
+        self.__events.on_flip('Z', 'start')
         self.__win.flip()
         self.__check_for_escape()
-        d = datetime.utcnow()
-        self.__this_exp.addData('Time', d)
+        stamp = self.__clocks.stamp()
+        self.__this_exp.addData('Time', datetime.utcfromtimestamp(stamp['wall']))
+        self.__this_exp.addData('Time_mono', stamp['mono'])
+        self.__this_exp.addData('Time_ptb', stamp.get('ptb'))
         self.__this_exp.nextEntry()
 
     #%%%%% TASKS %%%%%
@@ -203,7 +284,7 @@ class Experiment:
 
         """
 
-        print(f"Presenting instructions...")
+        self.__console.message(f"Presenting instructions...")
         self.__present_instructions((self.__path + "/Instructions/overall_instructions.csv"))
 
     def resting_state(self, duration=5):
@@ -213,7 +294,9 @@ class Experiment:
         :param duration: Duration of resting state.
         """
 
-        print(f"Running resting state...")
+        self.__console.message(f"Running resting state...")
+        self.__events.task = 'resting'
+        self.__session.task_start('resting')
         # LOAD TRIAL COMPONENTS
         resting_state_tone = sound.Sound(value='C', secs=0.1, volume=2)
 
@@ -228,91 +311,156 @@ class Experiment:
         self.__check_for_escape()
         self.__wait(duration=2)
 
-        # Start resting state
+        # Start resting state: the blank screen is drawn once and held
         self.__clock.reset()
-        trigger_sent = False
-        while self.__clock.getTime() < (duration * 60+2+(rd.random()/10)):
-            while self.__clock.getTime() < (duration*20):
-                if self.__mode and not trigger_sent:
-                    self.__win.callOnFlip(self.__port.write, 'G'.encode())
-                    trigger_sent = True
-                self.__blank.draw()
-                self.__win.flip()
-                self.__check_for_escape()
+        if self.__mode:
+            self.__events.on_flip('G', 'rest')
+        self.__blank.draw()
+        self.__win.flip()
+        self.__check_for_escape()
+        rest_duration = duration * 60 + 2 + (rd.random() / 10)
+        cpu = hold_static(self.__clock, rest_duration, self.__check_for_escape)
+        self.__console.message('Resting state %.2f s, CPU %.1f%%' % (rest_duration, 100 * cpu))
 
         if self.__mode:
-            self.__port.write('H'.encode())
+            self.__events.close()
+            self.__events.send('H', 'rest_end')
 
         resting_state_tone.play()
 
         self.__break()
 
-    def memory_task(self):
+    def __memory_trial(self, stimulus, text, trial, n_trials, duration=5, image_time=3):
+        """
+        Shows one test image and then the prompt, reading the first response to each.
+
+        :param stimulus: Image stimulus of the trial.
+        :param text: Prompt stimulus shown after the image.
+        :param trial: Trial number, for the operator console.
+        :param n_trials: Number of trials in the phase.
+        :param duration: Trial duration in seconds.
+        :param image_time: Time at which the image is replaced by the prompt.
+        :return: Tuple of the keys pressed during the image and during the prompt (empty if none).
+        """
+
+        self.__console.progress('imt', trial, n_trials, self.__win.nDroppedFrames)
+        keys_img, keys_text = [], []
+        key_pressed_img = False
+        key_pressed_text = False
+        clock_reset_img = False
+        clock_reset_text = False
+
+        self.__clock.reset()
+        self.__session.anchor()  # trial boundary for recorded keys
+        self.__kb.clock.reset()
+
+        self.__win.recordFrameIntervals = True
+        while self.__clock.getTime() < duration:
+            if not clock_reset_img:
+                self.__win.callOnFlip(self.__kb.clock.reset)
+                self.__kb.clearEvents()
+                clock_reset_img = True
+            if self.__clock.getTime() < image_time:
+                stimulus.draw()
+                if not key_pressed_img:
+                    keys_img = self.__kb.getKeys(keyList=['left', 'right'], waitRelease=False)
+                    if len(keys_img) > 0:
+                        key_pressed_img = True
+                        self.__kb.clearEvents()
+            else:
+                if not clock_reset_text:
+                    self.__win.callOnFlip(self.__kb.clock.reset)
+                    clock_reset_text = True
+                text.draw()
+                if not key_pressed_text:
+                    keys_text = self.__kb.getKeys(keyList=['left', 'right'], waitRelease=False)
+                    if len(keys_text) > 0:
+                        key_pressed_text = True
+                        self.__kb.clearEvents()
+            self.__win.flip()
+            self.__check_for_escape()
+        self.__win.recordFrameIntervals = False
+        return keys_img, keys_text
+
+    def memory_task(self, resume=None):
 
         """
 
         Implicit memory task
 
+        :param resume: Checkpoint to continue from, skipping the instructions and practice.
         """
-        print('Running implicit memory task')
-        # Set up trial components
-        text = TextStim(self.__win, text='')
+        self.__console.message('Running implicit memory task')
+        self.__events.task = 'imt'
+        self.__session.task_start('imt', None if resume is None else {
+            'phase': resume['phase'], 'block': resume['block'], 'recall': list(resume['stimuli'][1]['filename'])})
+        # Set up trial components (prompts and feedback are laid out once)
         encoding_text = 'Indoor or outdoor?'
         testing_text = 'Old or new?'
+        self.__text.add_all([encoding_text, testing_text])
 
-        correct_text = TextStim(self.__win, text='Correct!', color=[0, 1, -1])
-        incorrect_text = TextStim(self.__win, text='Incorrect', color=[1, 0, 0])
-        no_key_pressed = TextStim(self.__win, text='No key pressed!', color=[-1, -1, 1])
+        correct_text = self.__text.add('Correct!', color=[0, 1, -1])
+        incorrect_text = self.__text.add('Incorrect', color=[1, 0, 0])
+        no_key_pressed = self.__text.add('No key pressed!', color=[-1, -1, 1])
 
         # Load stimuli
         encoding_stimuli = pd.read_csv(self.__path + '/memory_task/official_stimuli/stimuli/encoded.csv')
         new_stimuli = pd.read_csv(self.__path + '/memory_task/official_stimuli/stimuli/recall.csv')
         practice_stimuli = pd.read_csv(self.__path + '/memory_task/official_stimuli/practice_stimuli/practice.csv')
 
-        # Randomise stimuli
-        rand_encoding_stimuli = encoding_stimuli.sample(frac=1, ignore_index=True)
-        rand_testing_stimuli = new_stimuli.sample(frac=1, ignore_index=True)
-
-        # Present instructions
-        self.__present_instructions((self.__path + '/memory_task/memory_task_instructions.csv'))
-
-        #Practice trials
-        print('Running practice trials')
-        self.__baseline(5)
-        practice_stim = ImageStim(self.__win, units='pix', size=(960, 600))
-        text.text = encoding_text
-        self.__kb.clearEvents()
-        for k in list(range(6)):
+        # Randomise stimuli (a resumed session keeps the order it was started with)
+        if resume is None:
+            rand_encoding_stimuli = encoding_stimuli.sample(frac=1, ignore_index=True)
+            rand_testing_stimuli = new_stimuli.sample(frac=1, ignore_index=True)
+        else:
+            rand_encoding_stimuli, rand_testing_stimuli = resume['stimuli']
+
+        image_size = (960, 600)
+        if resume is None:
+            # Present instructions
+            self.__present_instructions((self.__path + '/memory_task/memory_task_instructions.csv'))
+
+            #Practice trials
+            self.__console.message('Running practice trials')
+            self.__baseline(5)
+            practice_images = [self.__path + '/memory_task/official_stimuli/practice_stimuli/' + practice_stimuli['filename'][k]
+                               for k in range(6)]
+            self.__images.schedule(practice_images, image_size)
+            text = self.__text[encoding_text]
             self.__kb.clearEvents()
-            img = self.__path + '/memory_task/official_stimuli/practice_stimuli/' + practice_stimuli['filename'][k]
-            practice_stim.setImage(img)
-            self.__clock.reset()
-            key_pressed = False
-            while self.__clock.getTime() < 5:
-                if self.__clock.getTime() < 3:
-                    practice_stim.draw()
-                else:
-                    text.draw()
-                    if not key_pressed:
-                        keys = self.__kb.getKeys(keyList=['left', 'right'], waitRelease=False)
-                        if len(keys) > 0:
-                            key_pressed = True
+            for k in list(range(6)):
+                self.__kb.clearEvents()
+                practice_stim = self.__images.stim(practice_images[k], image_size)
+                self.__clock.reset()
+                self.__session.anchor()  # trial boundary for recorded keys
+                key_pressed = False
+                self.__win.recordFrameIntervals = True
+                while self.__clock.getTime() < 5:
+                    if self.__clock.getTime() < 3:
+                        practice_stim.draw()
+                    else:
+                        text.draw()
+                        if not key_pressed:
+                            keys = self.__kb.getKeys(keyList=['left', 'right'], waitRelease=False)
+                            if len(keys) > 0:
+                                key_pressed = True
+                    self.__win.flip()
+                    self.__check_for_escape()
+                self.__win.recordFrameIntervals = False
+
+                if key_pressed: # If a key is pressed, check if right or wrong
+                    response = str(keys[-1].name)
+                    if response == practice_stimuli['corr_ans'][k]:
+                        correct_text.draw()
+                    else:
+                        incorrect_text.draw()
+                elif not key_pressed:
+                        no_key_pressed.draw()
+                self.__kb.clearEvents()
                 self.__win.flip()
                 self.__check_for_escape()
-
-            if key_pressed: # If a key is pressed, check if right or wrong
-                response = str(keys[-1].name)
-                if response == practice_stimuli['corr_ans'][k]:
-                    correct_text.draw()
-                else:
-                    incorrect_text.draw()
-            elif not key_pressed:
-                    no_key_pressed.draw()
-            self.__kb.clearEvents()
-            self.__win.flip()
-            self.__check_for_escape()
-            self.__wait(2)
-            self.__blank_screen()
+                self.__wait(2)
+                self.__blank_screen()
 
         self.__ready()
         if self.__mode:
@@ -321,73 +469,59 @@ class Experiment:
         self.__wait(2)
 
         # Set up trial components
-        print('Running testing trials')
+        self.__console.message('Running testing trials')
         phases = ['encoding', 'recall']
         prompts = [encoding_text, testing_text]
         stimuli = [rand_encoding_stimuli, rand_testing_stimuli]
 
-        stimulus = ImageStim(self.__win, units='pix', size=(960, 600))
         block_data = []
+        start_phase, start_block = 0, 0
+        if resume is not None:
+            start_phase, start_block, block_data = resume['phase'], resume['block'], resume['trial_data']
+
+        # Schedule only the trials still to run, in the loop's order: images of blocks shown before a resume
+        # would otherwise count as upcoming uses and never be evicted
+        for phase_number in range(start_phase, len(phases)):
+            a = 1
+            for block_number, block in enumerate(self.__chunking(stimuli[a], 2)):
+                if phase_number == start_phase and block_number < start_block:
+                    continue
+                self.__images.schedule(self.__path + '/memory_task/official_stimuli/' + block['filename'], image_size)
 
-        for a in range(len(phases)):
+        for phase_number in range(start_phase, len(phases)):
             a = 1
             phase = phases[a]
             if a == 0:
                 block_trigger = 'J'
             else:
                 block_trigger = 'L'
-            text.text = prompts[a]
+            text = self.__text[prompts[a]]
             all_stimuli = list(self.__chunking(stimuli[a], 2))
 
-            for block in all_stimuli:
+            for block_number, block in enumerate(all_stimuli):
+                if phase_number == start_phase and block_number < start_block:
+                    continue
+                self.__checkpoint.save(task='imt', experiment_info=self.__experiment_info, phase=phase_number,
+                                       block=block_number, stimuli=[rand_encoding_stimuli, rand_testing_stimuli],
+                                       trial_data=block_data)
 
                 block = block.reset_index()
+                block_images = self.__path + '/memory_task/official_stimuli/' + block['filename']
+                self.__images.prefetch(block_images, image_size)
 
                 self.__baseline(10)
 
                 if self.__mode:
-                    self.__win.callOnFlip(self.__port.write, block_trigger.encode())
+                    self.__events.on_flip(block_trigger, phase, block_number)
 
                 for j in range(len(block)):
-                    img = self.__path + '/memory_task/official_stimuli/' + block['filename'][j]
-                    stimulus.setImage(img)
+                    stimulus = self.__images.stim(block_images[j], image_size)
                     correct_answer = block['corr_ans'][j]
                     condition_setting = block['condition_setting'][j]
                     condition_memory = block['condition_memory'][j]
 
-                    key_pressed_img = False
-                    key_pressed_text = False
-                    clock_reset_img = False
-                    clock_reset_text = False
-
-                    self.__clock.reset()
-                    self.__kb.clock.reset()
-
-                    while self.__clock.getTime() < 5:
-                        if not clock_reset_img:
-                            self.__win.callOnFlip(self.__kb.clock.reset)
-                            self.__kb.clearEvents()
-                            keys = []
-                            clock_reset_img = True
-                        if self.__clock.getTime() < 3:
-                            stimulus.draw()
-                            if not key_pressed_img:
-                                keys_img = self.__kb.getKeys(keyList=['left', 'right'], waitRelease=False)
-                                if len(keys_img) > 0:
-                                    key_pressed_img = True
-                                    self.__kb.clearEvents()
-                        else:
-                            if not clock_reset_text:
-                                self.__win.callOnFlip(self.__kb.clock.reset)
-                                clock_reset_text = True
-                            text.draw()
-                            if not key_pressed_text:
-                                keys_text = self.__kb.getKeys(keyList=['left', 'right'], waitRelease=False)
-                                if len(keys_text) > 0:
-                                    key_pressed_text = True
-                                    self.__kb.clearEvents()
-                        self.__win.flip()
-                        self.__check_for_escape()
+                    keys_img, keys_text = self.__memory_trial(stimulus, text, block['index'][j], len(stimuli[a]))
+                    key_pressed_img, key_pressed_text = len(keys_img) > 0, len(keys_text) > 0
 
                     if key_pressed_img:
                         response_img = str(keys_img[-1].name)
@@ -438,6 +572,9 @@ class Experiment:
                     self.__this_exp.addData('Task', 'IMT')
                     self.__this_exp.nextEntry()
 
+                if self.__mode:
+                    self.__events.close()
+
             if a == 0:
                 self.__present_instructions((self.__path + '/memory_task/memory_task_instructions_recall.csv'))
                 self.__wait()
@@ -447,6 +584,7 @@ class Experiment:
         data_export = pd.concat(block_data, ignore_index=True)
         data_export.to_csv((self.__path + '/memory_task/participant_data/' + str(self.__filename_save) \
                                         + '_memory_task_data_' + self.__experiment_info['date'] + '.csv'), header=True, index=False)
+        self.__checkpoint.remove()
 
     #%%%%% END EXPERIMENT ROUTINE %%%%%
     def __end_all_experiment(self, duration=1):
@@ -456,7 +594,8 @@ class Experiment:
         :param duration: Duration of wait time before exiting.
         """
 
-        print(f"Ending experiment...")
+        self.__console.message(f"Ending experiment...")
+        self.__rush.release()
         end_text = (self.__path + '/Instructions/task_finished_mid.png')
         ending = ImageStim(self.__win, end_text)
         ending.draw()
@@ -466,18 +605,52 @@ class Experiment:
         self.__win.flip()
         self.__this_exp.saveAsWideText(self.__endfilename + '.csv', delim='auto')
         self.__this_exp.saveAsPickle(self.__endfilename)
-        logging.flush()
-        if self.__mode:
+        self.__events.save(self.__endfilename)
+        self.__clocks.stop()
+        self.__clocks.save(self.__endfilename)
+        self.__console.message('Clock drift (ppm): %s' % self.__clocks.drift())
+        if self.__mode and self.__port is not None:
             self.__port.close()
+            self.__port.save(self.__endfilename)
+            self.__console.message('Triggers: %s' % self.__port.status())
+        self.__checkpoint.close()
+        self.__session.save(self.__endfilename, self.__win)
+        self.__console.message('Session: %s' % self.__session.status())
+        self.__console.stop()
+        if self.__quality is not None:
+            self.__quality.stop()
+        logging.flush()
+        self.__log.close()
         self.__win.close()
         core.quit()
 
     #%%%%% RUN EXPERIMENT %%%%%%
     def run(self):
         self.__setup()
-        # self.memory_task()
-        self.resting_state()
+        if self.__resume is not None:
+            self.memory_task(resume=self.__resume)
+        else:
+            # self.memory_task()
+            self.resting_state()
         self.__end_all_experiment()
 
-e = Experiment(portname='/dev/tty.usbserial-FTBXN67J', fullscreen=True, test=True, monitor=True)
-e.run()
+# The guard keeps the experiment from starting again in the monitor process (spawned on macOS/Windows)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', default=None, help='checkpoint file (*_checkpoint.pkl) to resume from')
+    parser.add_argument('--replay', default=None, help='session file (*_session.json) to replay without a participant')
+    parser.add_argument('--quality-source', default=None,
+                        help='intensity stream for the signal-quality monitor: a file of float32 frames or '
+                             'tcp://host:port')
+    parser.add_argument('--quality-channels', type=int, default=None, help='channels per frame of --quality-source')
+    args = parser.parse_args()
+    if args.quality_source is not None and args.quality_channels is None:
+        parser.error('--quality-source needs --quality-channels')
+    quality_source = (source_from_arg(args.quality_source, args.quality_channels)
+                      if args.quality_source is not None else None)
+    # A replay sends its triggers to a pty loopback instead of the LUMO
+    loopback = PtyLoopback(echo=False) if args.replay is not None else None
+    portname = loopback.name if loopback is not None else '/dev/tty.usbserial-FTBXN67J'
+    e = Experiment(portname=portname, fullscreen=True, test=True, monitor=True, quality_source=quality_source,
+                   resume=args.resume, replay=args.replay)
+    e.run()
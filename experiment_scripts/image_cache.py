@@ -0,0 +1,102 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy.visual import ImageStim
+from PIL import Image
+from collections import Counter, OrderedDict
+
+# Resampling filter used when images are shrunk to their on-screen size
+RESAMPLE_FILTER = Image.LANCZOS
+
+#%%%%%%%%%% Image cache %%%%%%%%%%
+
+
+def next_pow2(n):
+    return 1 << (int(n) - 1).bit_length()
+
+
+class ImageCache:
+    """
+    Loads each image once at the pixel size it is drawn at and keeps the resulting ImageStims within a
+    texture memory budget.
+
+    Images are decoded straight to (about) the target size and resampled with RESAMPLE_FILTER, so a
+    large photo uploads a texture of the size it is shown at, not of the source file. When the budget is
+    exceeded, the least recently used textures that are not scheduled to be shown again are released.
+    With a SessionRecorder, every image shown is recorded in order.
+    """
+
+    def __init__(self, win, budget_mb=256, pow2=True, session=None):
+        self.__win = win
+        self.__session = session
+        self.__budget = budget_mb * 2 ** 20
+        self.__pow2 = pow2
+        self.__stims = OrderedDict()
+        self.__remaining = Counter()
+        self.texture_bytes = 0
+
+    def __cost(self, size):
+        w, h = int(size[0]), int(size[1])
+        if self.__pow2:
+            w, h = next_pow2(w), next_pow2(h)
+        return 4 * w * h
+
+    def schedule(self, paths, size):
+        """
+        Declares images that will be shown, so they are not evicted before their last use.
+
+        :param paths: Image files in the order they will be shown (repeats allowed).
+        :param size: On-screen size in pixels.
+        """
+
+        self.__remaining.update((path, tuple(size)) for path in paths)
+
+    def __load(self, path, size):
+        image = Image.open(path)
+        image.draft('RGB', size)  # JPEGs are decoded at a reduced scale when possible
+        image = image.convert('RGB')
+        if image.size != tuple(size):
+            image = image.resize(tuple(int(s) for s in size), RESAMPLE_FILTER)
+        return ImageStim(self.__win, image=image, units='pix', size=size)
+
+    def __evict(self, keep=None):
+        for key in list(self.__stims):
+            if self.texture_bytes <= self.__budget:
+                break
+            if self.__remaining[key] > 0 or key == keep:
+                continue
+            self.__stims.pop(key).clearTextures()
+            self.texture_bytes -= self.__cost(key[1])
+
+    def prefetch(self, paths, size):
+        """
+        Loads images ahead of use, e.g. during a baseline.
+        """
+
+        for path in paths:
+            key = (path, tuple(size))
+            if key not in self.__stims:
+                self.__stims[key] = self.__load(path, size)
+                self.texture_bytes += self.__cost(size)
+        self.__evict()
+
+    def stim(self, path, size):
+        """
+        Returns the stimulus for an image, loading it if needed, and counts one showing.
+
+        :param path: Image file.
+        :param size: On-screen size in pixels.
+        """
+
+        key = (path, tuple(size))
+        if self.__session is not None:
+            self.__session.asset('image', path)
+        if key in self.__stims:
+            self.__stims.move_to_end(key)
+        else:
+            self.__stims[key] = self.__load(path, size)
+            self.texture_bytes += self.__cost(size)
+        if self.__remaining[key] > 0:
+            self.__remaining[key] -= 1
+        self.__evict(keep=key)
+        return self.__stims[key]
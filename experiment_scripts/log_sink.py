@@ -0,0 +1,159 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import logging
+
+import fnmatch
+import json
+import threading
+import time
+
+from rush_mode import io_thread
+
+#%%%%%%%%%% Rules %%%%%%%%%%
+
+# Stimulus and window property changes logged on every change (e.g. "fixation: color = ..."), per category:
+# keep one record in `sample`, then at most `rate` records per second. Other categories are written in full.
+DEFAULT_RULES = {'*: pos': {'sample': 1, 'rate': 10}, '*: ori': {'sample': 1, 'rate': 10},
+                 '*: color': {'sample': 1, 'rate': 10}, '*: opacity': {'sample': 1, 'rate': 10},
+                 '*: visibleWedge': {'sample': 1, 'rate': 10}, '*: text': {'sample': 1, 'rate': 20},
+                 '*: image': {'sample': 1, 'rate': 20}, 'win*': {'sample': 1, 'rate': 20}}
+
+
+def category(message):
+    """
+    Category of a log message: "<object>: <property>" for property changes, else the text before the first colon.
+    """
+
+    name, colon, rest = message.partition(': ')
+    if not colon:
+        return message.split(' ', 1)[0]
+    return name + ': ' + rest.split(' = ', 1)[0] if ' = ' in rest else name
+
+#%%%%%%%%%% Log sink %%%%%%%%%%
+
+
+class LogSink:
+    """
+    PsychoPy logging target that takes the place of logging.LogFile during a task.
+
+    PsychoPy hands formatted entries to its targets from logging.flush(), which Window.flip() calls on
+    the render thread. write() only puts the entry in a preallocated ring buffer; a writer thread parses
+    entries into JSON lines, applies the per-category sampling and rate limits and writes them to disk.
+    When the ring is full, entries are dropped and counted rather than waited for.
+
+    :param filename: Output file (JSON lines).
+    :param level: Lowest level written, as for logging.LogFile.
+    :param capacity: Ring buffer size, in entries.
+    :param rules: Dict of category pattern (fnmatch) -> {'sample': keep 1 in n, 'rate': max records per second}.
+        The first matching pattern applies.
+    :param interval: Seconds between writes.
+    """
+
+    def __init__(self, filename, level=logging.EXP, capacity=65536, rules=None, interval=0.1):
+        self.filename = filename
+        self.level = level
+        self.stream = None  # PsychoPy flushes target.stream when it has one; writes happen on our thread
+        self.__capacity = capacity
+        self.__slots = [None] * capacity
+        self.__next = 0
+        self.__read = 0
+        self.__rules = DEFAULT_RULES if rules is None else rules
+        self.__matched = {}
+        self.__counts = {}
+        self.__interval = interval
+        self.dropped = 0
+        self.suppressed = 0
+        self.__file = open(filename, 'w')
+        self.__running = True
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__writer.start()
+        logging.root.addTarget(self)
+
+    def setLevel(self, level):
+        self.level = level
+
+    def write(self, text):
+        """
+        Called by PsychoPy with one formatted entry, from logging.flush(). Never blocks.
+        """
+
+        index = self.__next
+        if index - self.__read >= self.__capacity:
+            self.dropped += 1
+            return
+        self.__slots[index % self.__capacity] = (index, time.perf_counter(), text)
+        self.__next = index + 1
+
+    def __rule(self, name):
+        if name not in self.__matched:
+            self.__matched[name] = next((rule for pattern, rule in self.__rules.items()
+                                         if fnmatch.fnmatchcase(name, pattern)), None)
+        return self.__matched[name]
+
+    def __keep(self, name, now):
+        rule = self.__rule(name)
+        if rule is None:
+            return True, 0
+        # Per category: [entries seen, start of the current second, records in it, suppressed since last record]
+        counts = self.__counts.setdefault(name, [0, now, 0, 0])
+        counts[0] += 1
+        if now - counts[1] >= 1:
+            counts[1], counts[2] = now, 0
+        if (counts[0] - 1) % rule.get('sample', 1) or counts[2] >= rule.get('rate', float('inf')):
+            counts[3] += 1
+            self.suppressed += 1
+            return False, 0
+        counts[2] += 1
+        suppressed, counts[3] = counts[3], 0
+        return True, suppressed
+
+    def __drain(self):
+        lines = []
+        while True:
+            slot = self.__slots[self.__read % self.__capacity]
+            if slot is None or slot[0] != self.__read:
+                break
+            _, received, text = slot
+            self.__slots[self.__read % self.__capacity] = None
+            self.__read += 1
+            # PsychoPy's format is '%(t).4f \t%(levelname)s \t%(message)s'
+            parts = text.rstrip('\n').split(' \t', 2)
+            if len(parts) == 3:
+                t, levelname, message = float(parts[0]), parts[1].strip(), parts[2]
+            else:
+                t, levelname, message = None, '', text.rstrip('\n')
+            name = category(message)
+            keep, suppressed = self.__keep(name, received)
+            if keep:
+                record = {'t': t, 'level': levelname, 'category': name, 'message': message}
+                if suppressed:
+                    record['suppressed'] = suppressed
+                lines.append(json.dumps(record))
+        if lines:
+            self.__file.write('\n'.join(lines) + '\n')
+            self.__file.flush()
+
+    def __write_loop(self):
+        io_thread()
+        while self.__running:
+            time.sleep(self.__interval)
+            self.__drain()
+
+    def status(self):
+        return {'dropped': self.dropped, 'suppressed': self.suppressed}
+
+    def close(self):
+        """
+        Stops taking entries, writes what is left and a summary record, and closes the file. Call after the
+        last logging.flush().
+        """
+
+        if self in logging.root.targets:
+            logging.root.targets.remove(self)
+        self.__running = False
+        self.__writer.join(timeout=2)
+        self.__drain()
+        self.__file.write(json.dumps({'t': None, 'level': 'INFO', 'category': 'log_sink',
+                                      'message': 'closed', **self.status()}) + '\n')
+        self.__file.close()
@@ -0,0 +1,92 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Operator console that runs in its own process. The experiment only appends events to an in-process
+# deque (no locks, never blocks); a pump thread forwards them to the console process, which is the only
+# place that writes to the terminal.
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from collections import deque
+import multiprocessing as mp
+import queue
+import threading
+import time
+
+from rush_mode import io_thread
+
+#%%%%%%%%%% Console process %%%%%%%%%%
+
+
+def _console(events, n_triggers=5):
+    task, trial, n_trials, dropped = '', 0, 0, 0
+    triggers = deque(maxlen=n_triggers)
+    while True:
+        kind, t, fields = events.get()
+        if kind == 'stop':
+            break
+        if kind == 'message':
+            print(fields['text'], flush=True)
+            continue
+        if kind == 'progress':
+            task, trial, n_trials = fields['task'], fields['trial'], fields['n_trials']
+            dropped = fields.get('dropped', dropped)
+        elif kind == 'trigger':
+            triggers.append('%s@%.3f' % (fields['trigger'], fields['onset']))
+        print('[%s] trial %s/%s | dropped frames %s | last triggers %s'
+              % (task, trial, n_trials, dropped, ' '.join(triggers)), flush=True)
+
+#%%%%%%%%%% Experiment-side client %%%%%%%%%%
+
+
+class OperatorConsole:
+    """
+    Publishes progress, trigger and timing events to the operator console process.
+    """
+
+    def __init__(self, interval=0.02, maxlen=10000):
+        self.__pending = deque(maxlen=maxlen)
+        self.__events = mp.Queue()
+        self.__interval = interval
+        self.__running = False
+        self.__process = None
+        self.__pump = None
+
+    def start(self):
+        self.__process = mp.Process(target=_console, args=(self.__events,), daemon=True)
+        self.__process.start()
+        self.__running = True
+        self.__pump = threading.Thread(target=self.__forward, daemon=True)
+        self.__pump.start()
+
+    def __forward(self):
+        io_thread()
+        while self.__running or self.__pending:
+            while self.__pending:
+                item = self.__pending.popleft()
+                try:
+                    self.__events.put_nowait(item)
+                except queue.Full:
+                    # Keep the item, in order, for the next pass
+                    self.__pending.appendleft(item)
+                    break
+            time.sleep(self.__interval)
+
+    def publish(self, kind, **fields):
+        self.__pending.append((kind, time.perf_counter(), fields))
+
+    def message(self, text):
+        self.publish('message', text=text)
+
+    def progress(self, task, trial, n_trials, dropped=0):
+        self.publish('progress', task=task, trial=trial, n_trials=n_trials, dropped=dropped)
+
+    def trigger(self, trigger, onset):
+        self.publish('trigger', trigger=trigger, onset=onset)
+
+    def stop(self):
+        if self.__process is None:
+            return
+        self.__running = False
+        self.__pump.join(timeout=1)
+        self.__events.put(('stop', time.perf_counter(), {}))
+        self.__process.join(timeout=1)
+        self.__process = None
@@ -0,0 +1,165 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Checks a task's trial plan against the display before a session. Every distinct frame composition in
+# the plan is drawn into the back buffer (never flipped) and timed with glFinish, and the cost is
+# compared with the calibrated frame period. Flicker frequencies that the refresh rate cannot show
+# as whole frames per half cycle are reported alongside.
+#
+#   python preflight.py visual --plan <path>/visual_stimulation/visual_stimulation_stimuli.csv [--refresh 60]
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import visual
+from pyglet import gl as GL
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from visual_stim import visual_stimuli
+
+#%%%%%%%%%% Flicker %%%%%%%%%%
+
+
+def flicker(frequency, refresh, tolerance=0.05):
+    """
+    Works out how a counter-phase reversal frequency lands on the refresh rate.
+
+    :param frequency: Reversal frequency in Hz (one full cycle shows both phases).
+    :param refresh: Display refresh rate in Hz.
+    :param tolerance: How far from a whole number of frames a half cycle may be, in frames.
+    :return: Tuple of (frames per half cycle, frequency actually shown, whether it is represented exactly).
+    """
+
+    frames_per_half = refresh / (2.0 * frequency)
+    n = max(1, int(round(frames_per_half)))
+    exact = frames_per_half >= 1 and abs(frames_per_half - n) <= tolerance
+    return frames_per_half, refresh / (2.0 * n), exact
+
+#%%%%%%%%%% Draw cost %%%%%%%%%%
+
+
+def draw_cost(win, stims, repeats=50, warmup=5):
+    """
+    Times drawing a frame composition into the back buffer.
+
+    :param win: PsychoPy window.
+    :param stims: Stimuli drawn in order, as the task loop does.
+    :param repeats: Number of timed draws.
+    :param warmup: Untimed draws first, so texture uploads and vertex rebuilds are not counted.
+    :return: Array of draw times in seconds.
+    """
+
+    times = np.empty(repeats)
+    for i in range(warmup + repeats):
+        start = time.perf_counter()
+        for stim in stims:
+            stim.draw()
+        GL.glFinish()
+        if i >= warmup:
+            times[i - warmup] = time.perf_counter() - start
+        win.clearBuffer()
+    return times
+
+#%%%%%%%%%% Plans %%%%%%%%%%
+
+
+def visual_plan(win, plan):
+    """
+    Frame compositions of the visual stimulation paradigm: either wedge phase, with and without the
+    detection dot, for every wedge geometry in the condition table.
+
+    :param win: PsychoPy window.
+    :param plan: Condition table (visual_stimulation_stimuli.csv) as a DataFrame.
+    :return: List of (condition index, geometry key, composition name, prepare callable, stimuli).
+    """
+
+    wedge_1, wedge_2, fixation_cross, dot = visual_stimuli(win)
+    compositions = []
+    for i, row in plan.iterrows():
+        key = (row['orientation1'], row['orientation2'], row['pos1'], row['pos2'])
+
+        def prepare(row=row):
+            for wedge in (wedge_1, wedge_2):
+                wedge.visibleWedge = [row['orientation1'], row['orientation2']]
+                wedge.pos = (row['pos1'], row['pos2'])
+
+        for name, stims in (('wedge_1', [wedge_1, fixation_cross]), ('wedge_2', [wedge_2, fixation_cross]),
+                            ('wedge_1+dot', [wedge_1, fixation_cross, dot]),
+                            ('wedge_2+dot', [wedge_2, fixation_cross, dot])):
+            compositions.append((i, key, name, prepare, stims))
+    return compositions
+
+
+PLANS = {'visual': visual_plan}
+
+#%%%%%%%%%% Preflight %%%%%%%%%%
+
+
+def preflight(task, plan_file, refresh=None, size=(1920, 1080), screen=0, fullscreen=False, repeats=50,
+              headroom=0.5):
+    """
+    Measures every frame composition of a trial plan and flags the conditions at risk of dropped frames.
+
+    :param task: Key of PLANS.
+    :param plan_file: Condition table csv.
+    :param refresh: Refresh rate in Hz (measured from the display when None).
+    :param size: Window size, as in the task.
+    :param screen: Screen to open the window on.
+    :param fullscreen: Open the window fullscreen, as in the task.
+    :param repeats: Timed draws per composition.
+    :param headroom: Fraction of the frame period the draw may take; the rest is left for the flip,
+        triggers and input.
+    :return: DataFrame with one row per condition and composition.
+    """
+
+    plan = pd.read_csv(plan_file)
+    win = visual.Window(size, color=[-1, -1, -1], fullscr=fullscreen, screen=screen, allowGUI=False)
+    if refresh is None:
+        refresh = win.getActualFrameRate() or 60.0
+    budget = headroom / refresh
+
+    costs = {}
+    rows = []
+    for i, key, name, prepare, stims in PLANS[task](win, plan):
+        if (key, name) not in costs:
+            prepare()
+            costs[(key, name)] = draw_cost(win, stims, repeats)
+        times = costs[(key, name)]
+        frames_per_half, shown, exact = flicker(plan['frequency'][i], refresh)
+        rows.append({'condition': i, 'trigger': plan['trigger'][i], 'frequency': plan['frequency'][i],
+                     'composition': name, 'median_ms': 1000 * np.median(times),
+                     'p95_ms': 1000 * np.percentile(times, 95), 'max_ms': 1000 * times.max(),
+                     'budget_ms': 1000 * budget, 'at_risk': np.percentile(times, 95) > budget,
+                     'frames_per_half': frames_per_half, 'shown_frequency': shown, 'flicker_exact': exact})
+    win.close()
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks a trial plan against the frame budget of the display')
+    parser.add_argument('task', choices=list(PLANS))
+    parser.add_argument('--plan', required=True, help='condition table csv')
+    parser.add_argument('--refresh', type=float, default=None, help='refresh rate in Hz (measured if omitted)')
+    parser.add_argument('--size', type=int, nargs=2, default=(1920, 1080))
+    parser.add_argument('--screen', type=int, default=0)
+    parser.add_argument('--fullscreen', action='store_true')
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--headroom', type=float, default=0.5)
+    args = parser.parse_args()
+
+    report = preflight(args.task, args.plan, args.refresh, tuple(args.size), args.screen, args.fullscreen,
+                       args.repeats, args.headroom)
+    report.to_csv(args.plan[:-len('.csv')] + '_preflight.csv', header=True, index=False)
+    risky = report[report['at_risk']]
+    inexact = report[~report['flicker_exact']].drop_duplicates('condition')
+    print(report.groupby('composition')[['median_ms', 'p95_ms', 'max_ms']].max().round(3))
+    for _, row in risky.iterrows():
+        print(f"Condition {row['condition']} ({row['composition']}): p95 draw {row['p95_ms']:.2f} ms over the "
+              f"{row['budget_ms']:.2f} ms budget")
+    for _, row in inexact.iterrows():
+        print(f"Condition {row['condition']}: {row['frequency']} Hz needs {row['frames_per_half']:.2f} frames per "
+              f"half cycle, shown as {row['shown_frequency']:.2f} Hz")
+    sys.exit(1 if len(risky) or len(inexact) else 0)
@@ -0,0 +1,227 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Online signal-quality monitor. A separate process reads channel intensities from a stream source and
+# keeps a rolling SNR (mean/std, the same measure enPruneChannels.m uses) per channel, so bad optode
+# coupling shows up during the session rather than in dataQualityCheck.m afterwards.
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import multiprocessing as mp
+import os
+import socket
+import time
+
+import numpy as np
+
+#%%%%%%%%%% Rolling SNR %%%%%%%%%%
+
+
+class RollingSNR:
+    """
+    Per-channel SNR over the last `window` samples. Each sample costs O(1) per channel: the running sums
+    are updated with the sample entering and the one leaving the ring buffer. The sums are rebuilt from
+    the buffer once per window to stop rounding errors building up.
+    """
+
+    def __init__(self, n_channels, window):
+        self.__buffer = np.zeros((window, n_channels))
+        self.__sum = np.zeros(n_channels)
+        self.__sumsq = np.zeros(n_channels)
+        self.__window = window
+        self.__head = 0
+        self.n = 0
+
+    def update(self, sample):
+        old = self.__buffer[self.__head]
+        if self.n >= self.__window:
+            self.__sum -= old
+            self.__sumsq -= old * old
+        self.__buffer[self.__head] = sample
+        self.__sum += sample
+        self.__sumsq += sample * sample
+        self.__head = (self.__head + 1) % self.__window
+        self.n += 1
+        if self.__head == 0:
+            self.__sum = self.__buffer.sum(axis=0)
+            self.__sumsq = (self.__buffer * self.__buffer).sum(axis=0)
+
+    def snr(self):
+        n = min(self.n, self.__window)
+        if n < 2:
+            return np.full(self.__sum.shape, np.nan)
+        mean = self.__sum / n
+        var = np.maximum(self.__sumsq - n * mean * mean, 0) / (n - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return mean / np.sqrt(var)
+
+#%%%%%%%%%% Stream sources %%%%%%%%%%
+
+
+class StreamSource:
+    """
+    Base class for intensity sources. Frames are float32 vectors of n_channels values. Sources are
+    opened inside the monitor process, so they only hold picklable settings until open() is called.
+    """
+
+    def __init__(self, n_channels):
+        self.n_channels = n_channels
+        self._pending = b''
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _read_bytes(self):
+        raise NotImplementedError
+
+    def read(self):
+        """
+        :return: Array (nFrames x nChannels) of the complete frames received since the last call.
+        """
+
+        data = self._pending + self._read_bytes()
+        frame_bytes = 4 * self.n_channels
+        n_frames = len(data) // frame_bytes
+        self._pending = data[n_frames * frame_bytes:]
+        return np.frombuffer(data[:n_frames * frame_bytes], dtype='<f4').reshape(n_frames, self.n_channels)
+
+
+class FileTailSource(StreamSource):
+    """
+    Follows a binary file of float32 frames as it is being written.
+    """
+
+    def __init__(self, filename, n_channels):
+        super().__init__(n_channels)
+        self.filename = filename
+        self.__file = None
+
+    def open(self):
+        while not os.path.exists(self.filename):
+            time.sleep(0.1)
+        self.__file = open(self.filename, 'rb')
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+
+    def _read_bytes(self):
+        return self.__file.read()
+
+
+class SocketSource(StreamSource):
+    """
+    Reads float32 frames from a local TCP socket, a stand-in for the LUMO stream.
+    """
+
+    def __init__(self, n_channels, host='127.0.0.1', port=5555):
+        super().__init__(n_channels)
+        self.address = (host, port)
+        self.__socket = None
+
+    def open(self):
+        self.__socket = socket.create_connection(self.address)
+        self.__socket.setblocking(False)
+
+    def close(self):
+        if self.__socket is not None:
+            self.__socket.close()
+
+    def _read_bytes(self):
+        chunks = []
+        try:
+            while True:
+                chunk = self.__socket.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except BlockingIOError:
+            pass
+        return b''.join(chunks)
+
+
+
+def source_from_arg(spec, n_channels):
+    """
+    Stream source from a command line argument.
+
+    :param spec: 'tcp://host:port' for a SocketSource, anything else is a file followed by a FileTailSource.
+    :param n_channels: Number of channels per frame.
+    """
+
+    if spec.startswith('tcp://'):
+        host, _, port = spec[len('tcp://'):].rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError("Socket sources are given as tcp://host:port, not '%s'" % spec)
+        return SocketSource(n_channels, host, int(port))
+    return FileTailSource(spec, n_channels)
+
+#%%%%%%%%%% Monitor process %%%%%%%%%%
+
+
+def _monitor(source, window, snr_shared, n_samples, stop, poll):
+    source.open()
+    rolling = RollingSNR(source.n_channels, window)
+    try:
+        while not stop.is_set():
+            frames = source.read()
+            if len(frames) == 0:
+                time.sleep(poll)
+                continue
+            for frame in frames:
+                rolling.update(frame)
+            snr_shared[:] = rolling.snr()
+            n_samples.value = rolling.n
+    finally:
+        source.close()
+
+
+class QualityMonitor:
+    """
+    Runs the rolling SNR in its own process and publishes the latest values in shared memory, so the
+    experiment process only ever reads a small array.
+    """
+
+    def __init__(self, source, window=500, SNRthresh=12, poll=0.05):
+        self.__source = source
+        self.__window = window
+        self.__thresh = SNRthresh
+        self.__poll = poll
+        self.__snr = mp.Array('d', source.n_channels, lock=False)
+        self.__n_samples = mp.Value('q', 0, lock=False)
+        self.__stop = mp.Event()
+        self.__process = None
+
+    def start(self):
+        self.__process = mp.Process(target=_monitor, daemon=True,
+                                    args=(self.__source, self.__window, self.__snr, self.__n_samples,
+                                          self.__stop, self.__poll))
+        self.__process.start()
+
+    def stop(self):
+        if self.__process is not None:
+            self.__stop.set()
+            self.__process.join(timeout=1)
+
+    def summary(self, n_worst=5):
+        """
+        Compact summary of the current signal quality.
+
+        :param n_worst: Number of worst channels to list.
+        :return: Dict with sample count, number of good/bad channels, median SNR and the worst channels.
+        """
+
+        snr = np.frombuffer(self.__snr, dtype=np.float64).copy()
+        valid = np.isfinite(snr)
+        worst = np.argsort(np.where(valid, snr, -np.inf))[:n_worst]
+        return {'samples': self.__n_samples.value,
+                'good': int((snr[valid] > self.__thresh).sum()),
+                'bad': int((~valid).sum() + (snr[valid] <= self.__thresh).sum()),
+                'median_snr': float(np.median(snr[valid])) if valid.any() else np.nan,
+                'worst': [(int(c), round(float(snr[c]), 1)) for c in worst]}
+
+    def report(self):
+        s = self.summary()
+        return ('Signal quality: %s good / %s bad channels, median SNR %.1f, worst (channel, SNR): %s'
+                % (s['good'], s['bad'], s['median_snr'], s['worst']))
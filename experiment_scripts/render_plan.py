@@ -0,0 +1,363 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Renders a task's trial plan to a video offline, for checking stimuli without sitting through the task.
+#
+# The plan is compiled from the task's condition tables with the task's own timings and random draws (the
+# jitter of __baseline/__wait, the shuffles, the dot onsets). With --session the generators start from the
+# states a session recorded by session_replay.py stored as the task started (a resumed task also starts where
+# it was resumed), so the video shows that session whatever ran before the task. With --seed they are seeded
+# as SessionRecorder.start does, which only matches a session whose script runs the task first.
+#
+# Instruction slides, which wait for a key in the task, are held for --slide seconds. Frame compositions are
+# drawn into the back buffer, read back once each and reused for every frame that shows them; each frame is
+# then stamped with its index, trial and time. Trials are split across worker processes, each encoding its
+# part with ffmpeg, and the parts are joined without re-encoding.
+#
+# Needs ffmpeg on the PATH. On a machine without a display, run it under a virtual one with software GL:
+#
+#   LIBGL_ALWAYS_SOFTWARE=1 xvfb-run -a -s "-screen 0 1920x1080x24" python render_plan.py visual out.mp4 --workers 8
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import visual
+from psychopy.visual import ImageStim, TextStim
+from pyglet import gl as GL
+from PIL import Image, ImageDraw
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import argparse
+import os
+import random
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from session_replay import task_generators
+from visual_stim import visual_stimuli
+
+PATH = '/Users/emilia/Documents/Dementia task piloting/Lumo'
+GREY = (0, 0, 0)
+BLACK = (-1, -1, -1)
+
+#%%%%%%%%%% Plans %%%%%%%%%%
+
+
+class Plan:
+    """
+    Frame-by-frame plan of a task, as trials of runs of (composition, number of frames).
+
+    Compositions are tuples naming what is on screen, e.g. ('fixation',), ('slide', path) or
+    ('wedge', geometry, phase, dot), so a plan can be sent to worker processes and drawn there.
+    """
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self.trials = []
+
+    def trial(self, label):
+        self.trials.append({'label': label, 'runs': []})
+
+    def hold(self, composition, duration):
+        self.trials[-1]['runs'].append((composition, max(1, int(round(duration * self.refresh)))))
+
+    def frames(self, compositions):
+        runs = self.trials[-1]['runs']
+        for composition in compositions:
+            if runs and runs[-1][0] == composition:
+                runs[-1] = (composition, runs[-1][1] + 1)
+            else:
+                runs.append((composition, 1))
+
+    def n_frames(self, trial):
+        return sum(n for _, n in trial['runs'])
+
+
+def generators(task, seed=0, session=None):
+    """
+    Generators for a task's plan, positioned where the task started drawing.
+
+    :param seed: Seed, as set by SessionRecorder.start, for a task that runs first in its script.
+    :param session: A *_session.json file to take the generator states from instead (see task_generators).
+    :return: Tuple of (random.Random, numpy RandomState, what the task was resumed from or None).
+    """
+
+    if session is not None:
+        return task_generators(session, task)
+    return random.Random(seed), np.random.RandomState(seed), None
+
+
+def visual_plan(refresh, generators, path=PATH, slide=2.0):
+    """
+    visual_stimulation: instructions, then per condition __baseline(10), 10 s of counter-phase wedges with
+    the detection dot for 2 s from a random second 1-7, and __baseline(5).
+    """
+
+    rng, _, _ = generators
+    conditions = pd.read_csv(path + '/visual_stimulation/visual_stimulation_stimuli.csv')
+    instructions = pd.read_csv(path + '/visual_stimulation/instructions.csv')
+
+    plan = Plan(refresh)
+    plan.trial('instructions')
+    for slide_path in instructions['path']:
+        plan.hold(('slide', slide_path), slide)
+    plan.hold(('blank',), 1 / refresh)
+    plan.hold(('blank',), 2 + rng.random() / 10)
+    for i, row in conditions.iterrows():
+        plan.trial('trial %d (%s, %s Hz)' % (i, row['side'], row['frequency']))
+        plan.hold(('fixation',), 10 + rng.random() / 10)
+        start_int = rng.randint(1, 7)
+        period = 1 / row['frequency']
+        geometry = (row['orientation1'], row['orientation2'], row['pos1'], row['pos2'])
+        t = np.arange(int(round(10 * refresh))) / refresh
+        phases = np.where(t % period < period / 2.0, 1, 2)
+        dots = (start_int < t) & (t < start_int + 2)
+        plan.frames([('wedge', geometry, int(phase), bool(dot)) for phase, dot in zip(phases, dots)])
+        plan.hold(('fixation',), 5 + rng.random() / 10)
+    return plan
+
+
+def memory_plan(refresh, generators, path=PATH, slide=2.0):
+    """
+    memory_task: instructions, six practice trials, then the recall blocks (two 5 s trials after each
+    __baseline(10): the image for 3 s, then the prompt). The task loop runs the recall phase for both
+    of its phases, and so does the plan. A resumed task skips the instructions and practice, keeps the
+    order it was started with and starts at the block it was resumed from.
+    """
+
+    rng, state, resume = generators
+    stimuli = path + '/memory_task/official_stimuli/'
+    plan = Plan(refresh)
+    if resume is None:
+        # Same draws, in the same order, as sample(frac=1) on the global generator in the task
+        pd.read_csv(stimuli + 'stimuli/encoded.csv').sample(frac=1, ignore_index=True, random_state=state)
+        recall = pd.read_csv(stimuli + 'stimuli/recall.csv').sample(frac=1, ignore_index=True, random_state=state)
+        practice = pd.read_csv(stimuli + 'practice_stimuli/practice.csv')
+        instructions = pd.read_csv(path + '/memory_task/memory_task_instructions.csv')
+
+        plan.trial('instructions')
+        for slide_path in instructions['path']:
+            plan.hold(('slide', slide_path), slide)
+        plan.hold(('fixation',), 5 + rng.random() / 10)
+        for k in range(6):
+            plan.trial('practice %d' % k)
+            plan.hold(('image', stimuli + 'practice_stimuli/' + practice['filename'][k]), 3)
+            plan.hold(('text', 'Indoor or outdoor?', None), 2)
+            plan.hold(('text', 'No key pressed!', (-1, -1, 1)), 2 + rng.random() / 10)
+            plan.hold(('blank',), 1)
+        start_phase, start_block = 0, 0
+    else:
+        recall = pd.DataFrame({'filename': resume['recall']})
+        start_phase, start_block = resume['phase'], resume['block']
+    plan.trial('ready')
+    plan.hold(('slide', path + '/ready.png'), slide)
+    plan.hold(('blank',), 1 / refresh)
+    plan.hold(('blank',), 2 + rng.random() / 10)
+    for phase_number in range(start_phase, 2):
+        for block_number, start in enumerate(range(0, len(recall), 2)):
+            if phase_number == start_phase and block_number < start_block:
+                continue
+            plan.trial('recall %d block %d' % (phase_number, block_number))
+            plan.hold(('fixation',), 10 + rng.random() / 10)
+            for filename in recall['filename'][start:start + 2]:
+                plan.hold(('image', stimuli + filename), 3)
+                plan.hold(('text', 'Old or new?', None), 2)
+    return plan
+
+
+PLANS = {'visual': visual_plan, 'imt': memory_plan}
+
+#%%%%%%%%%% Drawing %%%%%%%%%%
+
+
+class Canvas:
+    """
+    Offscreen drawing of plan compositions. Each composition is drawn and read back once; the most recent
+    ones are kept as frames.
+
+    :param size: Window size, as in the task.
+    :param image_size: On-screen size of the memory task images in pixels.
+    :param cache: Number of composed frames kept.
+    """
+
+    def __init__(self, size, image_size=(960, 600), cache=32):
+        self.__size = size
+        self.__image_size = image_size
+        self.__cache = cache
+        self.win = visual.Window(size, color=BLACK, fullscr=False, allowGUI=False)
+        self.shape = (int(self.win.size[1]), int(self.win.size[0]), 3)
+        self.__frames = OrderedDict()
+        self.__stims = {}
+        self.__wedges = None
+        self.__fixation = TextStim(self.win, text='+', height=0.1, color=(-1, -1, 1))
+
+    def __compose(self, composition):
+        kind = composition[0]
+        if kind == 'slide':
+            if composition not in self.__stims:
+                self.__stims[composition] = ImageStim(self.win, composition[1], units='pix', size=self.__size)
+            return GREY, [self.__stims[composition]]
+        if kind == 'fixation':
+            return GREY, [self.__fixation]
+        if kind == 'wedge':
+            if self.__wedges is None:
+                self.__wedges = visual_stimuli(self.win)
+            wedge_1, wedge_2, fixation_cross, dot = self.__wedges
+            orientation1, orientation2, pos1, pos2 = composition[1]
+            wedge = wedge_1 if composition[2] == 1 else wedge_2
+            wedge.visibleWedge = [orientation1, orientation2]
+            wedge.pos = (pos1, pos2)
+            return BLACK, [wedge, fixation_cross] + ([dot] if composition[3] else [])
+        if kind == 'image':
+            if composition not in self.__stims:
+                self.__stims[composition] = ImageStim(self.win, composition[1], units='pix', size=self.__image_size)
+            return BLACK, [self.__stims[composition]]
+        if kind == 'text':
+            if composition not in self.__stims:
+                style = {} if composition[2] is None else {'color': composition[2]}
+                self.__stims[composition] = TextStim(self.win, text=composition[1], **style)
+            return BLACK, [self.__stims[composition]]
+        return BLACK, []
+
+    def frame(self, composition):
+        """
+        :return: The composition as an RGB array (height x width x 3, uint8).
+        """
+
+        if composition in self.__frames:
+            self.__frames.move_to_end(composition)
+            return self.__frames[composition]
+        background, stims = self.__compose(composition)
+        self.win.color = background
+        self.win.clearBuffer()
+        for stim in stims:
+            stim.draw()
+        height, width, _ = self.shape
+        pixels = (GL.GLubyte * (width * height * 3))()
+        GL.glReadBuffer(GL.GL_BACK)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glReadPixels(0, 0, width, height, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, pixels)
+        frame = np.frombuffer(pixels, dtype=np.uint8).reshape(self.shape)[::-1].copy()
+        self.__frames[composition] = frame
+        if len(self.__frames) > self.__cache:
+            self.__frames.popitem(last=False)
+        return frame
+
+    def close(self):
+        self.win.close()
+
+
+def overlay(frame, text):
+    """
+    Stamps a line of text in a black box in the top left corner of a frame.
+    """
+
+    image = Image.fromarray(frame)
+    draw = ImageDraw.Draw(image)
+    left, top, right, bottom = draw.textbbox((8, 6), text)
+    draw.rectangle((0, 0, right + 8, bottom + 6), fill=(0, 0, 0))
+    draw.text((8, 6), text, fill=(255, 255, 0))
+    return image.tobytes()
+
+#%%%%%%%%%% Rendering %%%%%%%%%%
+
+
+def _encoder(filename, shape, fps, crf=18):
+    return subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                             '-s', '%dx%d' % (shape[1], shape[0]), '-r', repr(float(fps)), '-i', '-',
+                             '-c:v', 'libx264', '-preset', 'veryfast', '-crf', str(crf), '-pix_fmt', 'yuv420p',
+                             filename], stdin=subprocess.PIPE)
+
+
+def _render_part(trials, first_frame, size, fps, filename):
+    canvas = Canvas(size)
+    encoder = _encoder(filename, canvas.shape, fps)
+    index = first_frame
+    for trial in trials:
+        for composition, n in trial['runs']:
+            frame = canvas.frame(composition)
+            for _ in range(n):
+                encoder.stdin.write(overlay(frame, 'frame %d   %.3f s   %s' % (index, index / fps, trial['label'])))
+                index += 1
+    encoder.stdin.close()
+    encoder.wait()
+    canvas.close()
+    if encoder.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed on {filename}')
+    return index - first_frame
+
+
+def split(plan, n_parts):
+    """
+    Splits the trials into contiguous parts of about the same number of frames.
+
+    :return: List of (trials, first frame index).
+    """
+
+    counts = np.array([plan.n_frames(trial) for trial in plan.trials])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    part = np.minimum((starts * n_parts) // max(1, counts.sum()), n_parts - 1)
+    return [([plan.trials[i] for i in np.flatnonzero(part == p)], int(starts[part == p][0]))
+            for p in range(n_parts) if np.any(part == p)]
+
+
+def render(task, out, seed=0, refresh=60.0, size=(1920, 1080), path=PATH, slide=2.0, workers=None, session=None):
+    """
+    Renders a task's trial plan to a video, one part per worker.
+
+    :param task: Key of PLANS.
+    :param out: Output video (.mp4).
+    :param seed: Seed of random and NumPy's generator, as set by SessionRecorder.start.
+    :param session: A *_session.json file whose generator states to use instead of seed.
+    :param refresh: Frame rate of the video, i.e. the refresh rate the plan is timed for.
+    :param size: Window size, as in the task.
+    :param path: Folder holding the task materials.
+    :param slide: Seconds each instruction slide is shown.
+    :return: DataFrame of the first frame of every trial, also written next to the video as *_index.csv.
+    """
+
+    plan = PLANS[task](refresh, generators(task, seed, session), path, slide)
+    workers = workers or os.cpu_count()
+    parts = split(plan, 4 * workers)
+    base = os.path.splitext(out)[0]
+    filenames = ['%s.part%03d.mp4' % (base, p) for p in range(len(parts))]
+    print(f'Rendering {sum(plan.n_frames(t) for t in plan.trials)} frames of {task} in {len(parts)} parts...')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_render_part, trials, first_frame, size, refresh, filename)
+                   for (trials, first_frame), filename in zip(parts, filenames)]
+        for future in futures:
+            future.result()
+
+    with open(base + '.parts.txt', 'w') as f:
+        f.writelines("file '%s'\n" % os.path.abspath(filename) for filename in filenames)
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', base + '.parts.txt',
+                    '-c', 'copy', out], check=True)
+    for filename in filenames + [base + '.parts.txt']:
+        os.remove(filename)
+
+    counts = [plan.n_frames(trial) for trial in plan.trials]
+    index = pd.DataFrame({'trial': [trial['label'] for trial in plan.trials], 'n_frames': counts,
+                          'first_frame': np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)})
+    index['start_time'] = index['first_frame'] / refresh
+    index.to_csv(base + '_index.csv', header=True, index=False)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Renders a task trial plan to a video')
+    parser.add_argument('task', choices=list(PLANS))
+    parser.add_argument('out', help='output video (.mp4)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--session', default=None,
+                        help='*_session.json whose generator states at the start of the task to use instead of --seed')
+    parser.add_argument('--refresh', type=float, default=60.0)
+    parser.add_argument('--size', type=int, nargs=2, default=(1920, 1080))
+    parser.add_argument('--path', default=PATH, help='folder holding the task materials')
+    parser.add_argument('--slide', type=float, default=2.0, help='seconds each instruction slide is shown')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    index = render(args.task, args.out, args.seed, args.refresh, tuple(args.size), args.path, args.slide, args.workers,
+                   args.session)
+    print(f'Wrote {args.out} ({index["n_frames"].sum()} frames, {len(index)} trials)')
@@ -0,0 +1,147 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import gc
+import os
+import sys
+import threading
+import time
+
+# The I/O helpers import io_thread from here and also run without PsychoPy (trigger_protocol's CLI)
+try:
+    from psychopy import core
+except ImportError:
+    core = None
+
+#%%%%%%%%%% Rush mode %%%%%%%%%%
+
+# Cores of the I/O threads while rush mode is applied
+_io_cpus = None
+
+
+def io_thread():
+    """
+    Moves the calling thread to the I/O cores while rush mode is applied. Helper threads call it first thing:
+    a thread started after apply() inherits the render core from the thread that started it.
+    """
+
+    cpus = _io_cpus
+    if cpus is not None:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError:
+            pass
+
+
+
+class RushMode:
+    """
+    Real-time settings for the trial loops: raised scheduling priority, the render thread and the I/O
+    threads pinned to separate cores, and the garbage collector only run during baselines and breaks.
+
+    Every setting is attempted separately and the outcome is logged, since most of them need
+    permissions the acquisition PCs may not grant.
+    """
+
+    def __init__(self, console, fifo_priority=10, nice=-10, render_cpu=None):
+        self.__console = console
+        self.__fifo_priority = fifo_priority
+        self.__nice = nice
+        self.__render_cpu = render_cpu
+        self.__old_nice = None
+        self.__old_affinity = None
+        self.status = {}
+
+    def __log(self, setting, result):
+        self.status[setting] = result
+        text = 'Rush mode: %s -> %s' % (setting, result)
+        self.__console.message(text)
+
+    def __raise_priority(self):
+        if sys.platform.startswith('linux'):
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.__fifo_priority))
+                return 'SCHED_FIFO %s' % self.__fifo_priority
+            except (PermissionError, OSError):
+                pass
+            try:
+                self.__old_nice = os.getpriority(os.PRIO_PROCESS, 0)
+                os.setpriority(os.PRIO_PROCESS, 0, self.__nice)
+                return 'nice %s' % self.__nice
+            except (PermissionError, OSError):
+                self.__old_nice = None
+                return 'not permitted'
+        return 'core.rush' if core is not None and core.rush(True) else 'not permitted'
+
+    def __pin_threads(self):
+        global _io_cpus
+        if not hasattr(os, 'sched_setaffinity'):
+            return 'not supported on %s' % sys.platform
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) < 2:
+            return 'only one core available'
+        render_cpu = cpus[-1] if self.__render_cpu is None else self.__render_cpu
+        io_cpus = set(cpus) - {render_cpu}
+        self.__old_affinity = set(cpus)
+        # Helper threads started from now on move themselves there (io_thread)
+        _io_cpus = io_cpus
+        try:
+            # Threads started so far (console pump, quality monitor, sound) go to the other cores
+            for thread in threading.enumerate():
+                if thread is not threading.main_thread() and thread.native_id is not None:
+                    os.sched_setaffinity(thread.native_id, io_cpus)
+            os.sched_setaffinity(threading.main_thread().native_id, {render_cpu})
+        except OSError as error:
+            _io_cpus = None
+            return 'failed (%s)' % error
+        return 'render thread on core %s, I/O threads on cores %s' % (render_cpu, sorted(io_cpus))
+
+    def apply(self):
+        """
+        Applies the real-time settings. Call at the end of setup; helper threads started later are moved to the
+        I/O cores by io_thread.
+        """
+
+        self.__log('priority', self.__raise_priority())
+        self.__log('affinity', self.__pin_threads())
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+        self.__log('garbage collection', 'manual (baselines and breaks only)')
+
+    def collect(self):
+        """
+        Runs a full garbage collection. Only call where timing does not matter (baselines, breaks).
+
+        :return: Time the collection took, in seconds.
+        """
+
+        start = time.perf_counter()
+        gc.collect()
+        return time.perf_counter() - start
+
+    def release(self):
+        """
+        Restores normal scheduling and automatic garbage collection.
+        """
+
+        global _io_cpus
+        _io_cpus = None
+        gc.enable()
+        gc.unfreeze()
+        if sys.platform.startswith('linux'):
+            try:
+                os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+                if self.__old_nice is not None:
+                    os.setpriority(os.PRIO_PROCESS, 0, self.__old_nice)
+            except (PermissionError, OSError):
+                pass
+        elif core is not None:
+            core.rush(False)
+        if self.__old_affinity is not None:
+            for thread in threading.enumerate():
+                try:
+                    if thread.native_id is not None:
+                        os.sched_setaffinity(thread.native_id, self.__old_affinity)
+                except OSError:
+                    pass
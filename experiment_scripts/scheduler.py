@@ -0,0 +1,113 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import heapq
+import itertools
+
+#%%%%%%%%%% Frame scheduler %%%%%%%%%%
+
+
+class Seconds:
+    """
+    Yielded by a stream to sleep for a duration. The stream resumes on the first frame that starts at or
+    after the requested time.
+    """
+
+    __slots__ = ('duration',)
+
+    def __init__(self, duration):
+        self.duration = duration
+
+
+class FrameScheduler:
+    """
+    Runs stimulus streams side by side with one flip per frame.
+
+    A stream is a generator that does this frame's work (draw, call on flip, play, read keys) and then
+    yields how long to sleep:
+
+        yield           - resume next frame (streams that draw must do this every frame)
+        yield n         - resume after n frames
+        yield Seconds(t) - resume on the first frame at least t seconds from now
+
+    Sleeping streams sit in two heaps (by frame and by time), so a frame only touches the streams that
+    are due and the dispatch cost does not grow with the number of idle streams. A stream finishes when
+    its generator returns; run() returns once every stream that was not added as background has finished.
+
+    :param win: PsychoPy window.
+    :param clock: Clock the Seconds waits are measured on (anything with getTime).
+    :param on_frame: Called after every flip, e.g. the task's escape check.
+    """
+
+    def __init__(self, win, clock, on_frame=None):
+        self.__win = win
+        self.__clock = clock
+        self.__on_frame = on_frame
+        self.__frame = 0
+        self.__by_frame = []
+        self.__by_time = []
+        self.__order = itertools.count()
+        self.__foreground = 0
+        self.__background = set()
+
+    @property
+    def frame(self):
+        return self.__frame
+
+    def add(self, stream, background=False):
+        """
+        Adds a stream that starts on the next frame.
+
+        :param stream: Generator object.
+        :param background: Do not keep run() going for this stream; it is dropped once the rest finish.
+        """
+
+        if background:
+            self.__background.add(stream)
+        else:
+            self.__foreground += 1
+        heapq.heappush(self.__by_frame, (self.__frame, next(self.__order), stream))
+
+    def __resume(self, stream, now):
+        try:
+            wait = next(stream)
+        except StopIteration:
+            if stream in self.__background:
+                self.__background.discard(stream)
+            else:
+                self.__foreground -= 1
+            return
+        if wait is None:
+            heapq.heappush(self.__by_frame, (self.__frame + 1, next(self.__order), stream))
+        elif isinstance(wait, Seconds):
+            heapq.heappush(self.__by_time, (now + wait.duration, next(self.__order), stream))
+        else:
+            heapq.heappush(self.__by_frame, (self.__frame + int(wait), next(self.__order), stream))
+
+    def step(self):
+        """
+        Runs one frame: resumes every due stream in the order it went to sleep, then flips.
+        """
+
+        now = self.__clock.getTime()
+        due = []
+        while self.__by_time and self.__by_time[0][0] <= now:
+            due.append(heapq.heappop(self.__by_time))
+        while self.__by_frame and self.__by_frame[0][0] <= self.__frame:
+            due.append(heapq.heappop(self.__by_frame))
+        if len(due) > 1:
+            due.sort(key=lambda entry: entry[1])
+        for entry in due:
+            self.__resume(entry[2], now)
+        self.__win.flip()
+        self.__frame += 1
+        if self.__on_frame is not None:
+            self.__on_frame()
+
+    def run(self):
+        while self.__foreground > 0:
+            self.step()
+        for stream in self.__background:
+            stream.close()
+        self.__background.clear()
+        self.__by_frame, self.__by_time = [], []
@@ -0,0 +1,325 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Record and replay of the non-deterministic inputs of a session, so two versions of a task can be timed on
+# exactly the same workload.
+#
+# A recorded session stores the seed of `random` and of NumPy's global generator (baseline jitter, stimulus
+# shuffles, dot onsets), every key the task read, and the order in which images and sounds were loaded. Keys
+# are stored against the last anchor before they were read and the time since it. Anchors are the trigger
+# flips, the end of every waitKeys() and the trial boundaries the tasks mark (baselines and trial starts), so
+# keys read without triggers, or before the first one, are still placed within their trial. A replay reseeds
+# the generators and feeds the keys back at the same point after the same anchor, without a participant:
+# waitKeys() returns the recorded key at once and the participant dialog is skipped. A recorded key that has
+# not been read by the time the next anchor is reached is dropped (counted in keys_expired). Assets loaded in a
+# different order are counted as mismatches. The generator states are also stored as each task starts, with
+# what it was resumed from, so the draws of one task can be reproduced on their own (render_plan.py). Both
+# runs write an events table and the frame intervals, and `diff` compares the two.
+#
+#   python frontal_tasks.py --replay <data/...>_session.json     (triggers go to a pty loopback)
+#   python session_replay.py diff <data/...run_a> <data/...run_b>
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy import core
+
+from collections import deque
+
+import argparse
+import json
+import random as rd
+
+import numpy as np
+import pandas as pd
+
+import psychopy.event
+
+#%%%%%%%%%% Keyboards %%%%%%%%%%
+
+
+class RecordedKey:
+    """
+    A key read during a recorded session, with the fields the tasks use from psychopy KeyPress.
+    """
+
+    def __init__(self, name, rt=None, duration=None):
+        self.name = name
+        self.rt = rt
+        self.duration = duration
+
+
+class RecordingKeyboard:
+    """
+    Wraps a psychopy Keyboard and records every key that getKeys returns.
+    """
+
+    def __init__(self, kb, session):
+        self.__kb = kb
+        self.__session = session
+        self.clock = kb.clock
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        keys = self.__kb.getKeys(keyList=keyList, waitRelease=waitRelease, clear=clear)
+        if keys:
+            self.__session.record_keys(keys)
+        return keys
+
+    def clearEvents(self, eventType=None):
+        self.__kb.clearEvents(eventType)
+
+
+class ReplayKeyboard:
+    """
+    Stands in for a psychopy Keyboard during a replay and returns the recorded keys when they are due.
+    """
+
+    def __init__(self, session):
+        self.__session = session
+        self.clock = core.Clock()
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        return self.__session.due_keys(keyList)
+
+    def clearEvents(self, eventType=None):
+        # Recorded keys were read, never cleared, so there is nothing to discard
+        pass
+
+#%%%%%%%%%% Session recorder %%%%%%%%%%
+
+
+class SessionRecorder:
+    """
+    Records the inputs of a session, or replays the inputs of a recorded one.
+
+    :param replay: A *_session.json file to replay, or None to record.
+    """
+
+    def __init__(self, replay=None):
+        self.replaying = replay is not None
+        self.__keys = []
+        self.__waits = []
+        self.__assets = []
+        self.__tasks = []
+        self.__n_anchors = 0
+        self.__anchor_time = core.getTime()
+        self.mismatches = []
+        self.expired = []
+        if self.replaying:
+            with open(replay) as f:
+                recording = json.load(f)
+            self.seed = recording['seed']
+            self.participant = recording['participant']
+            self.__pending = deque(recording['keys'])
+            self.__pending_waits = deque(recording['waits'])
+            self.__recorded_assets = recording['assets']
+        else:
+            self.seed = int(np.random.SeedSequence().entropy % 2 ** 32)
+            self.participant = ''
+
+    def start(self):
+        """
+        Seeds `random` and NumPy's global generator. Call before anything random happens.
+        """
+
+        rd.seed(self.seed)
+        np.random.seed(self.seed)
+        self.__anchor_time = core.getTime()
+
+    def anchor(self, flip_time=None):
+        """
+        Marks a point keys are timed from: a trigger flip (called by EventTable), the end of a waitKeys() or a
+        trial boundary (called by the tasks). During a replay, keys of earlier anchors that were never read
+        are dropped, so they cannot turn up in a later trial.
+
+        :param flip_time: Time of the flip, or None for now.
+        """
+
+        self.__n_anchors += 1
+        self.__anchor_time = core.getTime() if flip_time is None else flip_time
+        if self.replaying:
+            while self.__pending and self.__pending[0]['anchor'] < self.__n_anchors:
+                self.expired.append(self.__pending.popleft())
+
+    def task_start(self, task, resume=None):
+        """
+        Records the state of `random` and NumPy's global generator as a task starts.
+
+        :param task: Task name, as in the event table.
+        :param resume: What a resumed task starts from (JSON-serialisable), or None.
+        """
+
+        numpy_state = np.random.get_state()
+        random_state = rd.getstate()
+        self.__tasks.append({'task': task, 'resume': resume,
+                             'random_state': [random_state[0], list(random_state[1]), random_state[2]],
+                             'numpy_state': [numpy_state[0], numpy_state[1].tolist(), int(numpy_state[2]),
+                                             int(numpy_state[3]), float(numpy_state[4])]})
+
+    def __position(self):
+        return self.__n_anchors, core.getTime() - self.__anchor_time
+
+    def keyboard(self, make_keyboard):
+        """
+        :param make_keyboard: Callable returning the real keyboard, e.g. psychopy.hardware.keyboard.Keyboard.
+        :return: A recording keyboard, or a replay keyboard that never opens the real one.
+        """
+
+        if self.replaying:
+            return ReplayKeyboard(self)
+        return RecordingKeyboard(make_keyboard(), self)
+
+    def record_keys(self, keys):
+        anchor, offset = self.__position()
+        for key in keys:
+            self.__keys.append({'anchor': anchor, 'offset': offset, 'name': key.name, 'rt': key.rt,
+                                'duration': key.duration})
+
+    def due_keys(self, keyList=None):
+        """
+        Recorded keys that are due by now and in keyList, in the order they were read.
+        """
+
+        anchor, offset = self.__position()
+        keys = []
+        for key in list(self.__pending):
+            if key['anchor'] > anchor or (key['anchor'] == anchor and key['offset'] > offset):
+                break
+            if keyList is None or key['name'] in keyList:
+                self.__pending.remove(key)
+                self.__keys.append(key)
+                keys.append(RecordedKey(key['name'], key['rt'], key['duration']))
+        return keys
+
+    def wait_keys(self):
+        """
+        psychopy.event.waitKeys, recorded; during a replay the recorded keys are returned at once.
+        """
+
+        if self.replaying:
+            wait = self.__pending_waits.popleft() if self.__pending_waits else {'keys': []}
+            self.__waits.append(wait)
+            keys = wait['keys']
+        else:
+            anchor, offset = self.__position()
+            keys = psychopy.event.waitKeys()
+            self.__waits.append({'anchor': anchor, 'offset': offset, 'keys': keys})
+        # A replay returns at once, so the keys after a wait are timed from its end rather than from before it
+        self.anchor()
+        return keys
+
+    def asset(self, kind, name):
+        """
+        Records an image or sound being loaded; during a replay, checks it against the recorded order.
+        """
+
+        index = len(self.__assets)
+        self.__assets.append([kind, str(name)])
+        if self.replaying:
+            expected = self.__recorded_assets[index] if index < len(self.__recorded_assets) else None
+            if expected != [kind, str(name)]:
+                self.mismatches.append({'index': index, 'expected': expected, 'loaded': [kind, str(name)]})
+
+    def status(self):
+        status = {'seed': self.seed, 'keys': len(self.__keys), 'waits': len(self.__waits),
+                  'assets': len(self.__assets)}
+        if self.replaying:
+            status.update({'keys_left': len(self.__pending), 'keys_expired': len(self.expired),
+                           'waits_left': len(self.__pending_waits), 'asset_mismatches': len(self.mismatches)})
+        return status
+
+    def save(self, filename, win=None):
+        """
+        Writes the session (<filename>_session.json) and, with a window, its frame intervals (<filename>_frames.csv).
+
+        :param filename: Output filename without extension.
+        :param win: Window whose frame intervals were recorded (the tasks record them during animated loops only).
+        """
+
+        with open(filename + '_session.json', 'w') as f:
+            json.dump({'seed': self.seed, 'participant': self.participant, 'replay': self.replaying,
+                       'keys': self.__keys, 'waits': self.__waits, 'assets': self.__assets, 'tasks': self.__tasks,
+                       'mismatches': self.mismatches, 'expired': self.expired}, f, indent=1)
+        if win is not None:
+            pd.DataFrame({'interval': win.frameIntervals}).to_csv(filename + '_frames.csv', header=True, index=False,
+                                                                 float_format='%.6f')
+
+
+
+def task_generators(filename, task):
+    """
+    Generators positioned where a task's random draws started in a recorded session.
+
+    :param filename: A *_session.json file.
+    :param task: Task name, as passed to SessionRecorder.task_start.
+    :return: Tuple of (random.Random, numpy RandomState, what the task was resumed from or None).
+    """
+
+    with open(filename) as f:
+        tasks = [t for t in json.load(f).get('tasks', []) if t['task'] == task]
+    if not tasks:
+        raise ValueError('%s holds no generator states for %s (recorded before they were stored, or the task did '
+                         'not run)' % (filename, task))
+    record = tasks[-1]
+    rng = rd.Random()
+    version, internal, gauss = record['random_state']
+    rng.setstate((version, tuple(internal), gauss))
+    state = np.random.RandomState()
+    name, keys, pos, has_gauss, cached = record['numpy_state']
+    state.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached))
+    return rng, state, record['resume']
+
+#%%%%%%%%%% Timing comparison %%%%%%%%%%
+
+
+def timing_report(filename):
+    """
+    Summary of a run's frame intervals (ms).
+
+    :param filename: Run filename without extension, as passed to SessionRecorder.save.
+    """
+
+    intervals = 1000 * pd.read_csv(filename + '_frames.csv')['interval'].to_numpy()
+    median = np.median(intervals)
+    return {'frames': len(intervals), 'mean_ms': intervals.mean(), 'sd_ms': intervals.std(),
+            'p99_ms': np.percentile(intervals, 99), 'max_ms': intervals.max(),
+            'dropped': int(np.sum(intervals > 1.5 * median))}
+
+
+def diff(filename_a, filename_b):
+    """
+    Compares the timing of two runs of the same session.
+
+    :return: Tuple of (DataFrame of frame statistics per run, DataFrame of trigger timing differences per
+        trigger code, in ms).
+    """
+
+    frames = pd.DataFrame([timing_report(filename_a), timing_report(filename_b)], index=['a', 'b'])
+    frames.loc['b - a'] = frames.loc['b'] - frames.loc['a']
+
+    a = pd.read_csv(filename_a + '_events.csv')
+    b = pd.read_csv(filename_b + '_events.csv')
+    n = min(len(a), len(b))
+    same = (a['trigger'].iloc[:n].to_numpy() == b['trigger'].iloc[:n].to_numpy())
+    if len(a) != len(b) or not same.all():
+        first = int(np.argmin(same)) if not same.all() else n
+        print(f'Trigger sequences differ from row {first} ({len(a)} vs {len(b)} rows); comparing the first {first}')
+        n = first
+    delta = pd.DataFrame({'trigger': a['trigger'].iloc[:n],
+                          'onset': 1000 * (b['onset'].iloc[:n] - a['onset'].iloc[:n]),
+                          'duration': 1000 * (b['duration'].iloc[:n] - a['duration'].iloc[:n])})
+    triggers = delta.groupby('trigger').agg(n=('onset', 'size'), onset_mean=('onset', 'mean'),
+                                            onset_max=('onset', lambda x: x.abs().max()),
+                                            duration_mean=('duration', 'mean'),
+                                            duration_max=('duration', lambda x: x.abs().max()))
+    return frames, triggers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the timing of two runs of a recorded session')
+    parser.add_argument('command', choices=['diff'])
+    parser.add_argument('a', help='first run, filename without extension (..._events.csv, ..._frames.csv)')
+    parser.add_argument('b', help='second run')
+    args = parser.parse_args()
+    frames, triggers = diff(args.a, args.b)
+    with pd.option_context('display.width', 160, 'display.float_format', '{:.3f}'.format):
+        print(frames)
+        print()
+        print(triggers)
@@ -0,0 +1,33 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import time
+
+#%%%%%%%%%% Static hold %%%%%%%%%%
+
+
+def hold_static(clock, duration, check_for_escape, poll=0.01, spin=0.002):
+    """
+    Keeps the frame that is already on screen until the clock reaches the given time, instead of
+    redrawing and flipping an unchanged screen at the full refresh rate.
+
+    The process sleeps in short steps and checks for escape after each one. Only the last few
+    milliseconds are spun so that the next flip is as close to the deadline as a flip loop would give.
+
+    :param clock: Clock that was reset when the screen went up (e.g. the task's core.Clock).
+    :param duration: Time on the clock at which to return.
+    :param check_for_escape: Called after every sleep.
+    :param poll: Sleep step in seconds, which bounds the escape latency.
+    :param spin: Time before the deadline at which to stop sleeping.
+    :return: CPU time used while holding, as a fraction of one core.
+    """
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    remaining = duration - clock.getTime()
+    while remaining > spin:
+        time.sleep(min(poll, remaining - spin))
+        check_for_escape()
+        remaining = duration - clock.getTime()
+    while clock.getTime() < duration:
+        pass
+    return (time.process_time() - cpu) / max(time.perf_counter() - wall, 1e-9)
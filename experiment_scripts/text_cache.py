@@ -0,0 +1,44 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from psychopy.visual import TextStim
+
+#%%%%%%%%%% Text cache %%%%%%%%%%
+
+
+class TextCache:
+    """
+    One TextStim per distinct string, laid out once at task setup. Setting TextStim.text makes PsychoPy
+    re-layout the glyphs and rebuild the vertex buffers on the render thread, so tasks pick the
+    prepared stimulus for a string instead of changing the text of a shared one.
+    """
+
+    def __init__(self, win, **style):
+        self.__win = win
+        self.__style = style
+        self.__stims = {}
+
+    def add(self, text, **style):
+        """
+        Prepares a string (once) and returns its stimulus.
+
+        :param text: The string to show.
+        :param style: TextStim arguments (color, height, ...) overriding the cache defaults.
+        """
+
+        if text not in self.__stims:
+            stim = TextStim(self.__win, text=text, **{**self.__style, **style})
+            stim.draw()  # Lays out the glyphs now rather than on the first trial
+            self.__win.clearBuffer()
+            self.__stims[text] = stim
+        return self.__stims[text]
+
+    def add_all(self, texts, **style):
+        for text in texts:
+            self.add(text, **style)
+
+    def __getitem__(self, text):
+        return self.__stims[text]
+
+    def __contains__(self, text):
+        return text in self.__stims
@@ -0,0 +1,287 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Trigger protocol layer between the tasks and the serial port to the LUMO.
+#
+# 'ascii'  - legacy mode: one character per trigger ('Z', 'G', 'H', ...), as the tasks have always sent.
+# 'binary' - 6-byte frames: sync 0xA5, code (u8), condition id (u8), trial index (u16, little endian) and an
+#            XOR checksum of the four payload bytes. Condition ids are assigned on first use and written
+#            to *_trigger_codes.csv so frames can be decoded offline.
+#
+# Markers sent with critical=False are batched and written together by a background thread. In ack mode
+# the device is expected to echo every frame back; a reader thread matches echoes against what was sent
+# and counts round trips and losses.
+#
+#   python trigger_protocol.py --mode binary --baudrate 115200 --ack      (runs against a pty loopback)
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from collections import deque
+
+import argparse
+import os
+import struct
+import threading
+import time
+
+import pandas as pd
+import serial
+
+from rush_mode import io_thread
+
+# The pty loopback is Unix only; the tasks import this module on the Windows lab machines too
+if os.name == 'posix':
+    import tty
+else:
+    tty = None
+
+#%%%%%%%%%% Frames %%%%%%%%%%
+
+SYNC = 0xA5
+FRAME = struct.Struct('<BBBHB')
+
+
+def checksum(payload):
+    value = 0
+    for byte in payload:
+        value ^= byte
+    return value
+
+
+def encode(code, condition=0, trial=0):
+    """
+    Packs one binary trigger frame.
+
+    :param code: Trigger code, 0-255 (the tasks use ord() of their trigger character).
+    :param condition: Condition id, 0-255.
+    :param trial: Trial index, 0-65535 (wraps).
+    :return: The frame as bytes.
+    """
+
+    payload = struct.pack('<BBH', code, condition, trial & 0xFFFF)
+    return FRAME.pack(SYNC, code, condition, trial & 0xFFFF, checksum(payload))
+
+
+def decode(data):
+    """
+    Parses binary frames out of a byte string, skipping bytes until the next sync byte after a bad frame.
+
+    :param data: Bytes read from the port.
+    :return: Tuple of (list of (code, condition, trial), unparsed remainder, number of bad frames).
+    """
+
+    frames, bad, i = [], 0, 0
+    while True:
+        i = data.find(bytes([SYNC]), i)
+        if i < 0 or len(data) - i < FRAME.size:
+            break
+        sync, code, condition, trial, check = FRAME.unpack_from(data, i)
+        if checksum(data[i + 1:i + FRAME.size - 1]) == check:
+            frames.append((code, condition, trial))
+            i += FRAME.size
+        else:
+            bad += 1
+            i += 1
+    remainder = data[i:] if i >= 0 else b''
+    return frames, remainder, bad
+
+#%%%%%%%%%% Trigger port %%%%%%%%%%
+
+
+class TriggerPort:
+    """
+    Sends triggers to the LUMO in either the legacy ASCII or the binary protocol.
+
+    :param port_name: Serial device, e.g. '/dev/tty.usbserial-FTBXN67J'.
+    :param mode: 'ascii' or 'binary'.
+    :param baudrate: Line rate. Each byte takes 10 bits on the wire, so a binary frame takes 0.52 ms at
+        115200 baud against 1.04 ms for one ASCII byte at 9600.
+    :param ack: Expect the device to echo every trigger and count the ones that do not come back.
+    :param batch_interval: How often non-critical markers are written, in seconds.
+    :param ack_timeout: Time after which an unechoed trigger is counted as lost, in seconds.
+    """
+
+    def __init__(self, port_name, mode='ascii', baudrate=9600, ack=False, batch_interval=0.05, ack_timeout=0.5):
+        if mode not in ('ascii', 'binary'):
+            raise ValueError("mode must be 'ascii' or 'binary'")
+        self.mode = mode
+        self.__port = serial.Serial(port_name, baudrate=baudrate, timeout=0.05)
+        self.__ack = ack
+        self.__ack_timeout = ack_timeout
+        self.__batch_interval = batch_interval
+        self.__conditions = {'': 0}
+        self.__batch = []
+        self.__pending = deque()
+        self.__round_trips = []
+        self.__sent = 0
+        self.__lost = 0
+        self.__corrupt = 0
+        self.__lock = threading.Lock()
+        self.__running = True
+        self.__threads = [threading.Thread(target=self.__batch_loop, daemon=True)]
+        if ack:
+            self.__threads.append(threading.Thread(target=self.__ack_loop, daemon=True))
+        for thread in self.__threads:
+            thread.start()
+
+    def condition_id(self, condition):
+        if condition not in self.__conditions:
+            if len(self.__conditions) > 255:
+                raise ValueError('More than 255 conditions do not fit in a binary trigger frame')
+            self.__conditions[condition] = len(self.__conditions)
+        return self.__conditions[condition]
+
+    def frame(self, trigger, condition='', trial=0):
+        if self.mode == 'ascii':
+            return trigger.encode()
+        return encode(ord(trigger), self.condition_id(condition), trial)
+
+    def __write(self, data, frames):
+        with self.__lock:
+            if self.__ack:
+                now = time.perf_counter()
+                self.__pending.extend((frame, now) for frame in frames)
+            self.__sent += len(frames)
+        self.__port.write(data)
+
+    def send(self, trigger, condition='', trial=0, critical=True):
+        """
+        Sends a trigger.
+
+        :param trigger: Single character trigger code.
+        :param condition: Condition label, sent as its id in binary mode.
+        :param trial: Trial index, sent in binary mode.
+        :param critical: False to batch the marker with others instead of writing it now.
+        """
+
+        frame = self.frame(trigger, condition, trial)
+        if critical:
+            self.__write(frame, [frame])
+        else:
+            with self.__lock:
+                self.__batch.append(frame)
+
+    def flush(self):
+        with self.__lock:
+            batch, self.__batch = self.__batch, []
+        if batch:
+            self.__write(b''.join(batch), batch)
+
+    def __batch_loop(self):
+        io_thread()
+        while self.__running:
+            time.sleep(self.__batch_interval)
+            self.flush()
+
+    def __ack_loop(self):
+        io_thread()
+        buffer = b''
+        while self.__running:
+            buffer += self.__port.read(max(1, self.__port.in_waiting))
+            if self.mode == 'binary':
+                frames, buffer, bad = decode(buffer)
+                echoed = [encode(*frame) for frame in frames]
+            else:
+                echoed, buffer, bad = [bytes([byte]) for byte in buffer], b'', 0
+            now = time.perf_counter()
+            with self.__lock:
+                self.__corrupt += bad
+                for frame in echoed:
+                    # Anything sent before the echoed frame that has not come back was lost
+                    while self.__pending and self.__pending[0][0] != frame:
+                        self.__pending.popleft()
+                        self.__lost += 1
+                    if self.__pending:
+                        self.__round_trips.append(now - self.__pending.popleft()[1])
+                while self.__pending and now - self.__pending[0][1] > self.__ack_timeout:
+                    self.__pending.popleft()
+                    self.__lost += 1
+
+    def status(self):
+        """
+        :return: Dict with triggers sent, lost and corrupt echoes, and the median round trip in ms.
+        """
+
+        with self.__lock:
+            round_trips = sorted(self.__round_trips)
+            return {'sent': self.__sent, 'lost': self.__lost, 'corrupt': self.__corrupt,
+                    'round_trip_ms': 1000 * round_trips[len(round_trips) // 2] if round_trips else None}
+
+    def save(self, filename):
+        """
+        Writes the condition ids used in binary mode.
+
+        :param filename: Output filename without extension.
+        """
+
+        codes = pd.DataFrame(list(self.__conditions.items()), columns=['condition', 'id'])
+        codes.to_csv(filename + '_trigger_codes.csv', header=True, index=False)
+
+    def close(self):
+        self.flush()
+        if self.__ack:
+            time.sleep(self.__ack_timeout)
+        self.__running = False
+        for thread in self.__threads:
+            thread.join(timeout=1)
+        self.__port.close()
+
+#%%%%%%%%%% Loopback %%%%%%%%%%
+
+
+class PtyLoopback:
+    """
+    A pseudo-terminal that stands in for the LUMO trigger input. Everything written to `name` is kept in
+    `received` and, with echo=True, written straight back so ack mode can be exercised. Needs a Unix system.
+    """
+
+    def __init__(self, echo=True):
+        if tty is None:
+            raise RuntimeError('The trigger loopback needs a pseudo-terminal, which %s does not have; replay and '
+                               'loopback tests only run on Linux or macOS' % os.name)
+        self.__master, self.__slave = os.openpty()
+        tty.setraw(self.__slave)
+        self.name = os.ttyname(self.__slave)
+        self.received = bytearray()
+        self.__echo = echo
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        io_thread()
+        while self.__running:
+            try:
+                data = os.read(self.__master, 1024)
+            except OSError:
+                break
+            self.received.extend(data)
+            if self.__echo:
+                os.write(self.__master, data)
+
+    def close(self):
+        self.__running = False
+        os.close(self.__slave)
+        os.close(self.__master)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sends test triggers through a pty loopback')
+    parser.add_argument('--mode', default='binary', choices=['ascii', 'binary'])
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--ack', action='store_true')
+    parser.add_argument('--n', type=int, default=200)
+    args = parser.parse_args()
+
+    loopback = PtyLoopback(echo=args.ack)
+    port = TriggerPort(loopback.name, mode=args.mode, baudrate=args.baudrate, ack=args.ack)
+    start = time.perf_counter()
+    for i in range(args.n):
+        port.send('Z' if i == 0 else 'A', condition='standard', trial=i, critical=i % 2 == 0)
+    port.close()
+    print('Sent %d triggers in %.1f ms' % (args.n, 1000 * (time.perf_counter() - start)))
+    if args.mode == 'binary':
+        frames, remainder, bad = decode(bytes(loopback.received))
+        print('Device decoded %d frames, %d bad' % (len(frames), bad))
+    else:
+        print('Device received %d bytes' % len(loopback.received))
+    print(port.status())
+    loopback.close()
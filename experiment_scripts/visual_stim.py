@@ -12,20 +12,57 @@ import pandas as pd
 import numpy as np
 import random as rd
 import os
-import serial
-import psychtoolbox as ptb
+import argparse
 import random as rd
 
+from clock_service import ClockService
+from event_table import EventTable
+from image_cache import ImageCache
+from log_sink import LogSink
+from operator_console import OperatorConsole
+from rush_mode import RushMode
+from session_replay import SessionRecorder
+from static_screen import hold_static
+from trigger_protocol import PtyLoopback, TriggerPort
+
 #%%%%%%%%%% Path directories %%%%%%%%%%
 _thisDir = os.path.dirname(os.path.abspath(__file__))
 os.chdir(_thisDir)
 
+#%%%%%%%%%% Stimuli %%%%%%%%%%
+
+def visual_stimuli(win):
+    """
+    Builds the stimuli of the visual stimulation paradigm (shared with preflight.py).
+
+    :param win: PsychoPy window.
+    :return: Tuple of the two counter-phase wedges, the fixation cross and the detection dot.
+    """
+
+    wedge_1 = visual.RadialStim(win, tex='sqrXsqr', color=1, size=1.5,
+                               visibleWedge=[180, 360], radialCycles=6, angularCycles=12, interpolate=False,
+                               autoLog=False)
+    wedge_2 = visual.RadialStim(win, tex='sqrXsqr', color=-1, size=1.5,
+                               visibleWedge=[180, 360], radialCycles=6, angularCycles=12, interpolate=False,
+                               autoLog=False)
+
+    fixation_cross = TextStim(win, text='+', height=0.2, color=[0, 0, 0], pos=(0, 0))
+    dot = DotStim(win, units='pix', nDots=1, fieldPos=(0,0), dotSize=25, fieldShape='circle', color=(1, 0, 1),
+                  speed=0)
+    return wedge_1, wedge_2, fixation_cross, dot
+
 #%%%%%%%%%% Experiment %%%%%%%%%%
 
 class Experiment:
 
-    def __init__(self, portname, test, fullscreen, monitor):
+    def __init__(self, portname, test, fullscreen, monitor, trigger_mode='ascii', baudrate=9600, ack=False,
+                 replay=None):
         self.__port_name = portname
+        self.__replay_file = replay
+        self.__session = None
+        self.__trigger_mode = trigger_mode
+        self.__baudrate = baudrate
+        self.__ack = ack
         self.__path = '/Users/emilia/Documents/Dementia task piloting/Lumo'
         self.__win = None
         self.__clock = None
@@ -33,6 +70,12 @@ class Experiment:
         self.__port = None
         self.__blank = None
         self.__fixation_cross = None
+        self.__events = None
+        self.__clocks = None
+        self.__images = None
+        self.__console = None
+        self.__rush = None
+        self.__log = None
         self.__filename_save = None
         self.__experiment_info = None
         self.__this_exp = None
@@ -44,14 +87,26 @@ class Experiment:
 
     #%%%%% SETTING UP EXPERIMENT %%%%%
     def __setup(self):
-        print(f"Setting up experiment...")
+        self.__console = OperatorConsole()
+        self.__console.start()
+        self.__console.message(f"Setting up experiment...")
+        self.__clocks = ClockService()
+        self.__clocks.start()
+        # Seeds the random generators (recorded, or taken from the session being replayed)
+        self.__session = SessionRecorder(self.__replay_file)
+        self.__session.start()
         experiment_name = 'Optical Neuroimaging and Cognition (ONAC)'
         self.__experiment_info = {'Participant': ''}
-        dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
-        if not dlg.OK:
-            print("User pressed 'Cancel'!")
-            core.quit()
+        if self.__session.replaying:
+            self.__experiment_info = {'Participant': self.__session.participant}
+        else:
+            dlg = gui.DlgFromDict(dictionary=self.__experiment_info, sortKeys=False, title=experiment_name)
+            if not dlg.OK:
+                self.__console.message("User pressed 'Cancel'!")
+                self.__console.stop()
+                core.quit()
 
+        self.__session.participant = self.__experiment_info['Participant']
         self.__experiment_info['date'] = data.getDateStr()
         self.__experiment_info['expName'] = experiment_name
         self.__experiment_info['psychopyVersion'] = '2021.2.3'
@@ -62,8 +117,8 @@ class Experiment:
                                                  originPath='C:/Users/emilia/PycharmProjects/experiment/visual_stim.py',
                                                  savePickle=True, saveWideText=True,
                                                  dataFileName=self.__endfilename)
-        # Setting up a log file
-        log_file = logging.LogFile(self.__endfilename + '.log', level=logging.EXP)
+        # Setting up a log file (buffered and written off the render thread)
+        self.__log = LogSink(self.__endfilename + '_log.jsonl', level=logging.EXP)
         logging.console.setLevel(logging.WARNING)
         self.__filename_save = '/P' + str(self.__experiment_info['Participant'])
 
@@ -72,7 +127,8 @@ class Experiment:
 
         if self.__mode:
             if self.__port_name is not None:
-                self.__port = serial.Serial(self.__port_name, baudrate=9600)
+                self.__port = TriggerPort(self.__port_name, mode=self.__trigger_mode, baudrate=self.__baudrate,
+                                         ack=self.__ack)
 
         if self.__monitor:
             self.__size = (1920, 1080)
@@ -91,15 +147,28 @@ class Experiment:
         else:
             frame_dur = 1.0 / 60.0
 
+        # Images are resampled to their on-screen size and kept within a texture budget
+        self.__images = ImageCache(self.__win, session=self.__session)
+
+        # Count dropped frames for the operator console. Intervals are only recorded while a loop flips every
+        # frame; static holds and key waits would otherwise count as dropped frames
+        self.__win.recordFrameIntervals = False
+        self.__win.refreshThreshold = frame_dur + 0.004
+
         # Hide mouse
         self.__win.mouseVisible = False
 
         # Setting up useful trial components
         self.__clock = core.Clock()
-        self.__kb = keyboard.Keyboard()
+        self.__kb = self.__session.keyboard(keyboard.Keyboard)
         self.__blank = TextStim(self.__win, text='')
+        self.__events = EventTable(self.__win, self.__port, self.__console, self.__clocks, self.__session)
         self.__fixation_cross = TextStim(self.__win, text='+', height=0.1, color=(-1, -1, 1))
 
+        # Real-time scheduling for the trial loops
+        self.__rush = RushMode(self.__console)
+        self.__rush.apply()
+
 #%%%%% SOME USEFUL FUNCTIONS %%%%%
 
     def __check_for_escape(self):
@@ -110,10 +179,14 @@ class Experiment:
     def __baseline(self, duration=30):
         self.__win.color = [0, 0, 0]
         self.__clock.reset()
-        while self.__clock.getTime() < (duration + (rd.random() / 10)):  # Randomise the baseline duration
-            self.__fixation_cross.draw()
-            self.__win.flip()
-            self.__check_for_escape()
+        self.__session.anchor()  # trial boundary for recorded keys
+        duration = duration + (rd.random() / 10)  # Randomise the baseline duration
+        self.__fixation_cross.draw()
+        self.__win.flip()
+        self.__check_for_escape()
+        gc_time = self.__rush.collect()
+        cpu = hold_static(self.__clock, duration, self.__check_for_escape)
+        self.__console.message('Baseline %.2f s, CPU %.1f%%, GC %.1f ms' % (duration, 100 * cpu, 1000 * gc_time))
         self.__win.color = [-1, -1, -1]
 
     def __wait(self, duration=2):
@@ -127,25 +200,75 @@ class Experiment:
         """
 
         instructions = pd.read_csv(filepath)
+        self.__images.schedule(instructions['path'], self.__size)
         self.__win.color = [0, 0, 0]
         for j in instructions['path']:
-            instruction_stim = ImageStim(self.__win, j, units='pix', size=self.__size)
+            instruction_stim = self.__images.stim(j, self.__size)
             instruction_stim.draw()
             self.__win.flip()
             self.__check_for_escape()
-            psychopy.event.waitKeys()
+            self.__session.wait_keys()
 
     def __start_trigger(self):
-        print('Sending start trigger')
-        self.__win.callOnFlip(self.__port.write, 'Z'.encode())
+        self.__console.message('Sending start trigger')
+        self.__events.on_flip('Z', 'start')
         self.__win.flip()
         self.__check_for_escape()
-        d = datetime.utcnow()
-        self.__this_exp.addData('Time', d)
+        stamp = self.__clocks.stamp()
+        self.__this_exp.addData('Time', datetime.utcfromtimestamp(stamp['wall']))
+        self.__this_exp.addData('Time_mono', stamp['mono'])
+        self.__this_exp.addData('Time_ptb', stamp.get('ptb'))
         self.__this_exp.nextEntry()
 
     #%%%%% TASKS %%%%%
 
+    def __flicker_trial(self, stims, frequency, dot_ints, trigger, side, trial, n_trials, duration=10):
+        """
+        Flickers the wedge in counter-phase and shows the detection dot for part of the trial.
+
+        :param stims: Tuple of the two wedges, the fixation cross and the dot (from visual_stimuli).
+        :param frequency: Reversal period in seconds.
+        :param dot_ints: Start and end of the dot, in seconds from the trial start.
+        :param trigger: Trigger sent on the first flip.
+        :param side: Condition label stored with the trigger.
+        :param trial: Trial number.
+        :param n_trials: Number of trials, for the operator console.
+        :param duration: Trial duration in seconds.
+        :return: 1 if the dot was detected, else 0.
+        """
+
+        wedge_1, wedge_2, fixation_cross, dot = stims
+        self.__console.progress('visual', trial, n_trials, self.__win.nDroppedFrames)
+        trigger_sent = False
+        response = 0
+        self.__clock.reset()
+        self.__session.anchor()  # trial boundary for recorded keys
+        detected = False
+        self.__win.recordFrameIntervals = True
+        while self.__clock.getTime() < duration:
+            if self.__mode and not trigger_sent:
+                self.__events.on_flip(trigger, side, trial)
+                trigger_sent = True
+            if self.__clock.getTime() % frequency < frequency / 2.0:
+                stim = wedge_1
+            else:
+                stim = wedge_2
+            stim.draw()
+            fixation_cross.draw()
+            if dot_ints[0] < self.__clock.getTime() < dot_ints[1]:
+                dot.draw()
+                if not detected:
+                    keys = self.__kb.getKeys(keyList=['space'])
+                    if len(keys)>0:
+                        response = 1
+                        detected = True
+                    else:
+                        response = 0
+            self.__win.flip()
+            self.__check_for_escape()
+        self.__win.recordFrameIntervals = False
+        return response
+
     def visual_stimulation(self):
         '''
         Task 4: visual stimulation paradigm.
@@ -155,24 +278,17 @@ class Experiment:
 
         '''
 
-        print(f"Running visual stimulation paradigm")
+        self.__console.message(f"Running visual stimulation paradigm")
+        self.__events.task = 'visual'
+        self.__session.task_start('visual')
 
         # Set up trial components
-        wedge_1 = visual.RadialStim(self.__win, tex='sqrXsqr', color=1, size=1.5,
-                                   visibleWedge=[180, 360], radialCycles=6, angularCycles=12, interpolate=False,
-                                   autoLog=False)
-        wedge_2 = visual.RadialStim(self.__win, tex='sqrXsqr', color=-1, size=1.5,
-                                   visibleWedge=[180, 360], radialCycles=6, angularCycles=12, interpolate=False,
-                                   autoLog=False)
-
-        fixation_cross = TextStim(self.__win, text='+', height=0.2, color=[0, 0, 0], pos=(0, 0))
-        dot = DotStim(self.__win, units='pix', nDots=1, fieldPos=(0,0), dotSize=25, fieldShape='circle', color=(1, 0, 1),
-                      speed=0)
+        wedge_1, wedge_2, fixation_cross, dot = visual_stimuli(self.__win)
 
         visual_conditions = pd.read_csv((self.__path + '/visual_stimulation/visual_stimulation_stimuli.csv'))
 
         # Instructions
-        print('Presenting instructions')
+        self.__console.message('Presenting instructions')
         self.__present_instructions(self.__path + '/visual_stimulation/instructions.csv')
 
         self.__blank.draw()
@@ -186,7 +302,6 @@ class Experiment:
         visual_stim_data = []
 
         for i in range(0, len(visual_conditions.loc[:,'frequency'])):
-            print('Trial number: %s out of %s' % (i, len(visual_conditions.loc[:,'frequency'])))
             frequency = 1/visual_conditions.loc[:,'frequency'][i]
             trigger = visual_conditions.loc[:, 'trigger'][i]
             wedge_1.visibleWedge = list((visual_conditions.loc[:, 'orientation1'][i],
@@ -196,35 +311,15 @@ class Experiment:
             wedge_1.pos = tuple((visual_conditions.loc[:, 'pos1'][i], visual_conditions.loc[:, 'pos2'][i]))
             wedge_2.pos = tuple((visual_conditions.loc[:, 'pos1'][i], visual_conditions.loc[:, 'pos2'][i]))
             side = visual_conditions.loc[:, 'side'][i]
-            trigger_sent = False
 
             self.__baseline(10)
 
             start_int = rd.randint(1, 7)
             dot_ints = tuple((start_int, start_int+2))
-            self.__clock.reset()
-            detected = False
-            while self.__clock.getTime() < 10:
-                if self.__mode and not trigger_sent:
-                    self.__win.callOnFlip(self.__port.write, trigger.encode())
-                    trigger_sent = True
-                if self.__clock.getTime() % frequency < frequency / 2.0:
-                    stim = wedge_1
-                else:
-                    stim = wedge_2
-                stim.draw()
-                fixation_cross.draw()
-                if dot_ints[0] < self.__clock.getTime() < dot_ints[1]:
-                    dot.draw()
-                    if not detected:
-                        keys = self.__kb.getKeys(keyList=['space'])
-                        if len(keys)>0:
-                            response = 1
-                            detected = True
-                        else:
-                            response = 0
-                self.__win.flip()
-                self.__check_for_escape()
+            response = self.__flicker_trial((wedge_1, wedge_2, fixation_cross, dot), frequency, dot_ints, trigger,
+                                            side, i, len(visual_conditions.loc[:,'frequency']))
+            if self.__mode:
+                self.__events.close()
             self.__kb.clearEvents()
             self.__baseline(5)
 
@@ -237,7 +332,7 @@ class Experiment:
             self.__this_exp.nextEntry()
 
         # Data saving
-        print(f'Saving data...')
+        self.__console.message(f'Saving data...')
         visual_stim_data_export = pd.concat(visual_stim_data, ignore_index=True)
         visual_stim_data_export.to_csv((self.__path + '/visual_stimulation/participant_data/' + str(self.__filename_save) \
                             + '_visual_stim_data' + self.__experiment_info['date'] + '.csv'), header=True, index=False)
@@ -250,7 +345,8 @@ class Experiment:
         :param duration: Duration of wait time before exiting.
         """
 
-        print(f"Ending experiment...")
+        self.__console.message(f"Ending experiment...")
+        self.__rush.release()
         end_text = (self.__path + '/Instructions/task_finished_mid.png')
         ending = ImageStim(self.__win, end_text)
         ending.draw()
@@ -260,9 +356,19 @@ class Experiment:
         self.__win.flip()
         self.__this_exp.saveAsWideText(self.__endfilename + '.csv', delim='auto')
         self.__this_exp.saveAsPickle(self.__endfilename)
-        logging.flush()
-        if self.__mode:
+        self.__events.save(self.__endfilename)
+        self.__clocks.stop()
+        self.__clocks.save(self.__endfilename)
+        self.__console.message('Clock drift (ppm): %s' % self.__clocks.drift())
+        if self.__mode and self.__port is not None:
             self.__port.close()
+            self.__port.save(self.__endfilename)
+            self.__console.message('Triggers: %s' % self.__port.status())
+        self.__session.save(self.__endfilename, self.__win)
+        self.__console.message('Session: %s' % self.__session.status())
+        self.__console.stop()
+        logging.flush()
+        self.__log.close()
         self.__win.close()
         core.quit()
 
@@ -271,8 +377,15 @@ class Experiment:
         self.__setup()
         self.visual_stimulation()
         self.__end_all_experiment()
-        s
 
-e = Experiment(portname='/dev/tty.usbserial-FTBXN67J', fullscreen=True, test=True, monitor=True)
-e.run()
+# The guard keeps the experiment from starting again in the console process (spawned on macOS/Windows)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', default=None, help='session file (*_session.json) to replay without a participant')
+    args = parser.parse_args()
+    # A replay sends its triggers to a pty loopback instead of the LUMO
+    loopback = PtyLoopback(echo=False) if args.replay is not None else None
+    portname = loopback.name if loopback is not None else '/dev/tty.usbserial-FTBXN67J'
+    e = Experiment(portname=portname, fullscreen=True, test=True, monitor=True, replay=args.replay)
+    e.run()
 
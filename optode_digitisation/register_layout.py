@@ -0,0 +1,302 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Registers the LUMO template layout to digitised head point clouds. The five cranial landmarks (Nasion,
+# Inion, Ar, Al, Cz, as picked in LUMO_pointlocalisation.m) give the starting alignment, then an ICP loop
+# matches the template optodes to the .ply cloud. Each iteration takes the nearest cloud vertices of every
+# optode from a KD-tree and assigns them one-to-one (Hungarian algorithm), so two optodes never snap to the
+# same vertex. The hand-picked source positions are not needed. Registered layouts are cached per
+# participant, cap and registration setting.
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+
+LANDMARKS = ['Nasion', 'Inion', 'Ar', 'Al', 'Cz']
+
+#%%%%%%%%%% Loading %%%%%%%%%%
+
+
+def find_layout(task):
+    """
+    Python version of preprocessing/utils/LUMO_findLayout.m.
+
+    :param task: Task name.
+    :return: Layout (cap) name.
+    """
+
+    layouts = {'resting': 'frontal', 'imt': 'frontal', 'visual': 'visual', 'motor': 'motor', 'mmn': 'auditory'}
+    return layouts[task]
+
+
+def load_ply(filename):
+    """
+    Reads the vertex positions of an ASCII or binary little-endian .ply file.
+
+    :return: Array (nPoints x 3).
+    """
+
+    with open(filename, 'rb') as f:
+        header = []
+        while True:
+            line = f.readline().decode('ascii').strip()
+            header.append(line)
+            if line == 'end_header':
+                break
+        fmt = header[1].split()[1]
+        n_vertices, props, in_vertex = 0, [], False
+        for line in header:
+            words = line.split()
+            if words[:2] == ['element', 'vertex']:
+                n_vertices, in_vertex = int(words[2]), True
+            elif words and words[0] == 'element':
+                in_vertex = False
+            elif in_vertex and words and words[0] == 'property':
+                props.append((words[-1], words[1]))
+        types = {'float': '<f4', 'float32': '<f4', 'double': '<f8', 'uchar': 'u1', 'uint8': 'u1',
+                 'int': '<i4', 'int32': '<i4', 'short': '<i2', 'ushort': '<u2'}
+        if fmt == 'ascii':
+            vertices = np.loadtxt(f, max_rows=n_vertices, usecols=range(len(props)), ndmin=2)
+            names = [p[0] for p in props]
+            return vertices[:, [names.index(c) for c in 'xyz']]
+        vertices = np.fromfile(f, dtype=[(name, types[kind]) for name, kind in props], count=n_vertices)
+    return np.column_stack([vertices[c] for c in 'xyz']).astype(np.float64)
+
+
+def load_points(filename):
+    """
+    Reads labelled points saved by LUMO_pointlocalisation.m (Location, X, Y, Z).
+
+    :return: DataFrame indexed by Location with X, Y, Z columns.
+    """
+
+    return pd.read_csv(filename).set_index('Location')[['X', 'Y', 'Z']]
+
+
+@lru_cache(maxsize=None)
+def load_template(filename):
+    """
+    Reads a LUMO layout file (.json) or a labelled point csv. Cached per cap, since every participant
+    wearing the same cap shares one template.
+
+    Source optodes are named Src<dock><A/B/C> and detectors Det<dock><1-4>, matching the labels used in
+    LUMO_pointlocalisation.m.
+
+    :return: DataFrame indexed by Location with X, Y, Z columns.
+    """
+
+    if filename.endswith('.csv'):
+        return load_points(filename)
+    with open(filename) as f:
+        layout = json.load(f)
+    rows = []
+    for landmark in layout.get('landmarks', []):
+        c = landmark['coordinates_3d']
+        rows.append((landmark['name'], c['x'], c['y'], c['z']))
+    for dock in layout['docks']:
+        dock_id = str(dock['dock_id']).split('_')[-1]
+        for optode in dock['optodes']:
+            optode_id = str(optode['optode_id']).split('_')[-1]
+            prefix = 'Src' if optode_id.isalpha() else 'Det'
+            c = optode['coordinates_3d']
+            rows.append((prefix + dock_id + optode_id, c['x'], c['y'], c['z']))
+    return pd.DataFrame(rows, columns=['Location', 'X', 'Y', 'Z']).set_index('Location')
+
+#%%%%%%%%%% Registration %%%%%%%%%%
+
+
+def similarity_transform(source, target, scale=True):
+    """
+    Least-squares rotation, translation and (optionally) scale mapping source onto target (Umeyama).
+
+    :return: Tuple (s, R, t) so that target ~ s * source @ R.T + t.
+    """
+
+    mu_s, mu_t = source.mean(axis=0), target.mean(axis=0)
+    xs, xt = source - mu_s, target - mu_t
+    U, S, Vt = np.linalg.svd(xt.T @ xs)
+    D = np.eye(3)
+    D[2, 2] = np.sign(np.linalg.det(U @ Vt))
+    R = U @ D @ Vt
+    s = np.trace(np.diag(S) @ D) / (xs ** 2).sum() if scale else 1.0
+    return s, R, mu_t - s * mu_s @ R.T
+
+
+def match_one_to_one(moved, tree, max_dist, k=8):
+    """
+    Assigns every point to a different target, minimising the summed distance over each point's k nearest
+    targets within max_dist.
+
+    :param moved: Points to match (nPoints x 3).
+    :param tree: cKDTree of the targets.
+    :return: Tuple of the matched target index (-1 if none) and the distance (inf if none) of every point.
+    """
+
+    k = min(k, tree.n)
+    dist, idx = tree.query(moved, k=k, distance_upper_bound=max_dist)
+    dist, idx = dist.reshape(len(moved), k), idx.reshape(len(moved), k)
+    match, match_dist = np.full(len(moved), -1), np.full(len(moved), np.inf)
+    found = np.isfinite(dist)
+    if not found.any():
+        return match, match_dist
+    candidates = np.unique(idx[found])
+    # Pairs that are not candidates cost more than any real match, so they are only used when unavoidable
+    cost = np.full((len(moved), candidates.size), 2 * max_dist * len(moved))
+    rows = np.broadcast_to(np.arange(len(moved))[:, None], idx.shape)
+    cost[rows[found], np.searchsorted(candidates, idx[found])] = dist[found]
+    r, c = linear_sum_assignment(cost)
+    ok = cost[r, c] < max_dist
+    match[r[ok]] = candidates[c[ok]]
+    match_dist[r[ok]] = cost[r[ok], c[ok]]
+    return match, match_dist
+
+
+def register(template, points, cloud=None, scale=True, max_dist=15.0, n_iter=50, tol=1e-6):
+    """
+    Aligns the template to one participant.
+
+    :param template: Template points (DataFrame from load_template).
+    :param points: Digitised labelled points (DataFrame from load_points). Only the LANDMARKS rows are used
+        when a cloud is given; without one, the other labelled points are the targets instead.
+    :param cloud: Digitised points (e.g. the .ply vertices) the optodes are matched to.
+    :param scale: Allow an isotropic scale in the alignment.
+    :param max_dist: Matches further apart than this (mm) are not made.
+    :return: DataFrame with the registered template positions, the matched digitised point and the residual
+        (NaN for optodes left unmatched).
+    """
+
+    landmarks = [name for name in LANDMARKS if name in template.index and name in points.index]
+    if len(landmarks) < 3:
+        raise ValueError('At least three landmarks are needed to initialise the registration')
+    template_landmarks = template.loc[landmarks].to_numpy()
+    digitised_landmarks = points.loc[landmarks].to_numpy()
+    s, R, t = similarity_transform(template_landmarks, digitised_landmarks, scale)
+
+    optodes = template.drop(index=[name for name in LANDMARKS if name in template.index])
+    if cloud is None:
+        targets = points.drop(index=[name for name in LANDMARKS if name in points.index]).to_numpy()
+    else:
+        targets = np.asarray(cloud, dtype=np.float64)
+    tree = cKDTree(targets)
+    src = optodes.to_numpy()
+    previous = np.inf
+    for _ in range(n_iter):
+        moved = s * src @ R.T + t
+        match, dist = match_one_to_one(moved, tree, max_dist)
+        inliers = match >= 0
+        if inliers.sum() < 3:
+            break
+        # The labelled landmarks stay in every fit, so the alignment cannot drift along the scalp
+        s, R, t = similarity_transform(np.vstack([template_landmarks, src[inliers]]),
+                                       np.vstack([digitised_landmarks, targets[match[inliers]]]), scale)
+        error = np.mean(dist[inliers] ** 2)
+        if abs(previous - error) < tol:
+            break
+        previous = error
+
+    moved = s * template.to_numpy() @ R.T + t
+    registered = pd.DataFrame(moved, index=template.index, columns=['X', 'Y', 'Z'])
+    rows = template.index.get_indexer(optodes.index)
+    match, dist = match_one_to_one(moved[rows], tree, max_dist)
+    matched = np.full((len(template), 3), np.nan)
+    residual = np.full(len(template), np.nan)
+    matched[rows[match >= 0]] = targets[match[match >= 0]]
+    residual[rows[match >= 0]] = dist[match >= 0]
+    rows = template.index.get_indexer(landmarks)
+    matched[rows] = digitised_landmarks
+    residual[rows] = np.linalg.norm(moved[rows] - digitised_landmarks, axis=1)
+    registered[['matchX', 'matchY', 'matchZ']] = matched
+    registered['residual'] = residual
+    registered.attrs['transform'] = {'scale': s, 'rotation': R, 'translation': t}
+    return registered
+
+#%%%%%%%%%% Batch mode %%%%%%%%%%
+
+
+def _file_hash(*filenames, settings=()):
+    h = hashlib.sha1()
+    for filename in filenames:
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+    h.update(repr(settings).encode())
+    return h.hexdigest()[:16]
+
+
+def register_participant(datpath, participant, layout, template_file, cache_dir=None, use_cloud=True, scale=True,
+                         max_dist=15.0):
+    """
+    Registers the template for one participant, reusing the cached result when the inputs and settings are
+    unchanged.
+
+    The landmarks are read from <participant>_<layout>_scaled_landmarks.csv (Location, X, Y, Z; the five
+    LANDMARKS only) or, if there is none, from the landmark rows of <participant>_<layout>_scaled_points.csv.
+    With the .ply cloud the optodes are matched to the cloud and no hand-picked source is used.
+
+    :param datpath: Study folder holding <participant>/<participant>_<layout>_scaled_landmarks.csv and .ply.
+    :param participant: Participant ID.
+    :param layout: Cap name (see find_layout).
+    :param template_file: LUMO layout file for this cap.
+    :param cache_dir: Cache folder (defaults to <datpath>/layout_cache/<layout>).
+    :param use_cloud: Match to the .ply cloud; otherwise to the labelled points of the points csv.
+    :param scale: Allow an isotropic scale in the alignment.
+    :param max_dist: Matches further apart than this (mm) are not made.
+    :return: Registered layout DataFrame.
+    """
+
+    base = os.path.join(datpath, participant, participant + '_' + layout + '_scaled')
+    cloud_file = base + '.ply'
+    use_cloud = use_cloud and os.path.exists(cloud_file)
+    points_file = base + '_landmarks.csv' if use_cloud and os.path.exists(base + '_landmarks.csv') else base + '_points.csv'
+    cache_dir = cache_dir or os.path.join(datpath, 'layout_cache', layout)
+    key = _file_hash(points_file, template_file, cloud_file if use_cloud else '',
+                     settings=(use_cloud, bool(scale), float(max_dist)))
+    cache_file = os.path.join(cache_dir, '%s_%s.csv' % (participant, key))
+    if os.path.exists(cache_file):
+        return pd.read_csv(cache_file, index_col='Location')
+
+    points = load_points(points_file)
+    cloud = load_ply(cloud_file) if use_cloud else None
+    registered = register(load_template(template_file), points, cloud, scale=scale, max_dist=max_dist)
+    os.makedirs(cache_dir, exist_ok=True)
+    registered.to_csv(cache_file, index_label='Location')
+    return registered
+
+
+def register_study(datpath, participants, layout, template_file, workers=None, **settings):
+    """
+    Registers many participants in parallel.
+
+    :param settings: Passed to register_participant (use_cloud, scale, max_dist).
+    :return: Dict of participant ID to registered layout.
+    """
+
+    print(f'Registering {len(participants)} participants to the {layout} layout...')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {p: pool.submit(register_participant, datpath, p, layout, template_file, **settings)
+                   for p in participants}
+        return {p: future.result() for p, future in futures.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Register LUMO layouts to digitised point clouds')
+    parser.add_argument('datpath')
+    parser.add_argument('layout')
+    parser.add_argument('template')
+    parser.add_argument('participants', nargs='+')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-dist', type=float, default=15.0, help='largest optode to cloud match in mm')
+    parser.add_argument('--no-scale', action='store_true', help='rigid alignment without scaling')
+    args = parser.parse_args()
+    results = register_study(args.datpath, args.participants, args.layout, args.template, args.workers,
+                             scale=not args.no_scale, max_dist=args.max_dist)
+    for participant, registered in results.items():
+        print('%s: median residual %.2f mm' % (participant, registered['residual'].median()))
@@ -0,0 +1,202 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Resting-state connectivity between HD-DOT channels over the rest period of resting_state (between the
+# 'G' and 'H' triggers). Correlation is one matrix product on the standardised signal and coherence one
+# complex product per frequency bin; both are computed in float32, tile by tile, so the channel x channel
+# output can be a memory-mapped file. Cohort mode runs participants on a process pool, each worker
+# writing its own slice of a shared .npy memmap.
+#
+#   python connectivity.py cohort.csv connectivity.npy --measure correlation --workers 8
+#
+# cohort.csv has columns recording, events and start_time (time of the 'Z' marker in the recording).
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.signal import butter, sosfiltfilt
+
+from events import read_events
+from pipeline import Pipeline
+from prune_channels import enable_lufr
+
+#%%%%%%%%%% Rest segment %%%%%%%%%%
+
+
+def rest_segment(events, fs, start_time=0.0):
+    """
+    Samples of the rest period.
+
+    :param events: Event table from events.read_events.
+    :param fs: Sampling frequency in Hz.
+    :param start_time: Time of the 'Z' marker in the recording, in seconds.
+    :return: Tuple of (first sample, last sample + 1).
+    """
+
+    rest = events[events['task'] == 'resting']
+    onset = rest.loc[rest['trigger'] == 'G', 'onset'].iloc[0]
+    end = rest.loc[rest['trigger'] == 'H', 'onset']
+    end = end.iloc[0] if len(end) else onset + rest.loc[rest['trigger'] == 'G', 'duration'].iloc[0]
+    return int(np.round((onset + start_time) * fs)), int(np.round((end + start_time) * fs))
+
+#%%%%%%%%%% Measures %%%%%%%%%%
+
+
+def standardise(x, band=None, fs=None, channel_chunk=512):
+    """
+    Band-passes (optionally) and scales every channel to zero mean and unit norm, so that correlation is z.T @ z.
+
+    :param x: Data (nTpts x nChannels).
+    :param band: Optional (low, high) pass band in Hz.
+    :param fs: Sampling frequency in Hz, needed with band.
+    :return: float32 array (nTpts x nChannels).
+    """
+
+    z = np.empty(x.shape, dtype=np.float32)
+    sos = butter(3, band, btype='bandpass', fs=fs, output='sos') if band is not None else None
+    for start in range(0, x.shape[1], channel_chunk):
+        block = np.asarray(x[:, start:start + channel_chunk], dtype=np.float64)
+        if sos is not None:
+            block = sosfiltfilt(sos, block, axis=0)
+        block -= block.mean(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block /= np.linalg.norm(block, axis=0)
+        z[:, start:start + channel_chunk] = block
+    return z
+
+
+def correlation(z, out=None, tile=2048):
+    """
+    Channel x channel correlation of standardised data, one tile of the upper triangle at a time.
+
+    :param z: Output of standardise.
+    :param out: Optional (nChannels x nChannels) float32 array to fill, e.g. a memmap.
+    :param tile: Channels per tile.
+    :return: The correlation matrix.
+    """
+
+    n = z.shape[1]
+    if out is None:
+        out = np.empty((n, n), dtype=np.float32)
+    for i in range(0, n, tile):
+        for j in range(i, n, tile):
+            block = z[:, i:i + tile].T @ z[:, j:j + tile]
+            out[i:i + tile, j:j + tile] = block
+            if j != i:
+                out[j:j + tile, i:i + tile] = block.T
+    return out
+
+
+def coherence(x, fs, band=(0.009, 0.08), nperseg=None, out=None, tile=2048):
+    """
+    Magnitude-squared coherence between channels, averaged over the frequency bins of a band (Welch).
+
+    :param x: Data (nTpts x nChannels).
+    :param fs: Sampling frequency in Hz.
+    :param band: Frequency band in Hz.
+    :param nperseg: Segment length (defaults to the largest power of two giving at least 7 half-overlapping
+        segments).
+    :param out: Optional (nChannels x nChannels) float32 array to fill.
+    :param tile: Channels per tile.
+    :return: The coherence matrix.
+    """
+
+    if nperseg is None:
+        nperseg = int(2 ** np.floor(np.log2(x.shape[0] / 4)))
+    nperseg = min(nperseg, x.shape[0])
+    step = nperseg // 2
+    starts = np.arange(0, x.shape[0] - nperseg + 1, step)
+    freqs = np.fft.rfftfreq(nperseg, 1 / fs)
+    bins = np.flatnonzero((freqs >= band[0]) & (freqs <= band[1]))
+    window = np.hanning(nperseg).astype(np.float32)
+    n = x.shape[1]
+
+    # Spectra of every segment at the band bins only: (bins x segments x channels)
+    spectra = np.empty((len(bins), len(starts), n), dtype=np.complex64)
+    for s, start in enumerate(starts):
+        segment = np.asarray(x[start:start + nperseg], dtype=np.float32)
+        segment = (segment - segment.mean(axis=0)) * window[:, None]
+        spectra[:, s] = np.fft.rfft(segment, axis=0)[bins]
+    power = (np.abs(spectra) ** 2).sum(axis=1)  # bins x channels
+
+    if out is None:
+        out = np.empty((n, n), dtype=np.float32)
+    for i in range(0, n, tile):
+        for j in range(i, n, tile):
+            block = np.zeros((min(tile, n - i), min(tile, n - j)), dtype=np.float32)
+            for b in range(len(bins)):
+                cross = spectra[b, :, i:i + tile].conj().T @ spectra[b, :, j:j + tile]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    block += np.abs(cross) ** 2 / np.outer(power[b, i:i + tile], power[b, j:j + tile])
+            block /= max(1, len(bins))
+            out[i:i + tile, j:j + tile] = block
+            if j != i:
+                out[j:j + tile, i:i + tile] = block.T
+    return out
+
+
+MEASURES = {'correlation': lambda x, fs, band, out=None: correlation(standardise(x, band, fs), out),
+            'coherence': lambda x, fs, band, out=None: coherence(x, fs, band, out=out)}
+
+#%%%%%%%%%% Cohort %%%%%%%%%%
+
+
+def _participant(row, out_file, index, measure, band, cache_dir):
+    pipeline = Pipeline(cache_dir)
+    od = pipeline.run('od', row['recording'])
+    dod, fs = od['dod'], od['fs']
+    start, stop = rest_segment(read_events(row['events'], 'resting'), fs, row.get('start_time', 0.0))
+    out = np.load(out_file, mmap_mode='r+')
+    # Tiles are written straight into this participant's slice of the output
+    MEASURES[measure](dod[start:stop], fs, band, out[index])
+    out.flush()
+    return row['recording']
+
+
+def cohort(recordings, out_file, measure='correlation', band=(0.009, 0.08), n_channels=None, cache_dir=None,
+           workers=None):
+    """
+    Computes a connectivity matrix for every participant into one memory-mapped (nParticipants x nChannels
+    x nChannels) .npy file.
+
+    :param recordings: DataFrame with columns recording, events and start_time.
+    :param out_file: Output .npy file.
+    :param measure: 'correlation' or 'coherence'.
+    :param band: Frequency band in Hz.
+    :param n_channels: Channels per recording (read from the first recording if None; all must match).
+    :param cache_dir: Pipeline cache folder (defaults to pipeline_cache next to the output).
+    :param workers: Number of worker processes.
+    :return: The memmap, opened read-only.
+    """
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(out_file)), 'pipeline_cache')
+    if n_channels is None:
+        n_channels = Pipeline(cache_dir).run('od', recordings['recording'].iloc[0])['dod'].shape[1]
+    out = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32,
+                                    shape=(len(recordings), n_channels, n_channels))
+    del out
+    print(f'Computing {measure} for {len(recordings)} participants...')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_participant, row, out_file, i, measure, band, cache_dir)
+                   for i, (_, row) in enumerate(recordings.iterrows())]
+        for future in futures:
+            future.result()
+    return np.load(out_file, mmap_mode='r')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resting-state connectivity of HD-DOT channels')
+    parser.add_argument('recordings', help='csv with columns recording, events, start_time')
+    parser.add_argument('out', help='output .npy file')
+    parser.add_argument('--measure', default='correlation', choices=list(MEASURES))
+    parser.add_argument('--band', type=float, nargs=2, default=(0.009, 0.08))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--lufr', action='store_true', help='also read .lufr recordings (layout not yet checked '
+                        'against a LUMO recording)')
+    args = parser.parse_args()
+    if args.lufr:
+        enable_lufr()
+    cohort(pd.read_csv(args.recordings), args.out, args.measure, tuple(args.band), workers=args.workers)
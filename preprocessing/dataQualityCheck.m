@@ -17,7 +17,13 @@ function dataQuality(fpath, task)
         end
     end
 
+    % Event tables written by the tasks (experiment_scripts/data), kept with the quality check output
+    events = LUMO_loadEvents(participant, task);
+
     nirsFileName = strcat(pathstr, '/', participant, '_', task, 'qualityCheck_nirsfile');
+    if ~isempty(events)
+        writetable(events, strcat(nirsFileName, '_events.csv'));
+    end
     nirs = data.write_NIRS(nirsFileName,'sd_style','flat');
     dod = hmrIntensity2OD(nirs.d);
     nWavs = length(nirs.SD3D.Lambda);
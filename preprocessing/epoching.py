@@ -0,0 +1,162 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Event-locked epoching and block averaging of HD-DOT data (nTpts x nChannels). All epochs are cut with a
+# single fancy index per block of channels, so there is no loop over trials, and only one block of
+# channels is held at a time. Data can be a NumPy array, a np.memmap or a LufrRecording.
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from events import event_samples, read_events
+from prune_channels import enable_lufr, load_recording
+
+#%%%%%%%%%% Windows %%%%%%%%%%
+
+# Epoch windows in seconds around each trigger, following the task timings: visual trials are 10 s
+# after __baseline(10) and followed by __baseline(5); memory blocks follow __baseline(10); motor trials
+# (up to 20 s) follow __baseline(7)
+TASK_WINDOWS = {'visual': {'tmin': -5.0, 'tmax': 15.0, 'baseline': (-5.0, 0.0)},
+                'imt': {'tmin': -5.0, 'tmax': 30.0, 'baseline': (-5.0, 0.0)},
+                'motor': {'tmin': -5.0, 'tmax': 20.0, 'baseline': (-5.0, 0.0)},
+                'mmn': {'tmin': -1.0, 'tmax': 3.0, 'baseline': (-1.0, 0.0)}}
+
+#%%%%%%%%%% Epoching %%%%%%%%%%
+
+
+def epoch_index(onsets, fs, tmin, tmax, n_samples):
+    """
+    Sample index of every epoch.
+
+    :param onsets: Onset samples of the triggers.
+    :param fs: Sampling frequency in Hz.
+    :param tmin: Epoch start relative to the trigger, in seconds.
+    :param tmax: Epoch end relative to the trigger, in seconds.
+    :param n_samples: Length of the recording; epochs that do not fit are dropped.
+    :return: Tuple of (index array nTrials x nTimes, times in seconds, mask of the onsets kept).
+    """
+
+    offsets = np.arange(int(np.round(tmin * fs)), int(np.round(tmax * fs)) + 1)
+    onsets = np.asarray(onsets, dtype=np.int64)
+    keep = (onsets + offsets[0] >= 0) & (onsets + offsets[-1] < n_samples)
+    return onsets[keep, None] + offsets[None, :], offsets / fs, keep
+
+
+def epoch(data, onsets, fs, tmin=-5.0, tmax=15.0, baseline=(-5.0, 0.0), channel_chunk=512, out=None):
+    """
+    Cuts baseline-corrected epochs out of a recording.
+
+    :param data: Data (nTpts x nChannels).
+    :param onsets: Onset samples of the triggers.
+    :param fs: Sampling frequency in Hz.
+    :param tmin: Epoch start relative to the trigger, in seconds.
+    :param tmax: Epoch end relative to the trigger, in seconds.
+    :param baseline: Window (seconds) whose mean is subtracted from each epoch, or None.
+    :param channel_chunk: Number of channels cut at once.
+    :param out: Optional preallocated array (nTrials x nTimes x nChannels), e.g. a np.memmap.
+    :return: Tuple of (epochs, times, mask of the onsets kept).
+    """
+
+    index, times, keep = epoch_index(onsets, fs, tmin, tmax, data.shape[0])
+    n_trials, n_times = index.shape
+    if out is None:
+        out = np.empty((n_trials, n_times, data.shape[1]), dtype=np.float32)
+    flat = index.ravel()
+    window = None if baseline is None else (times >= baseline[0]) & (times <= baseline[1])
+    for start in range(0, data.shape[1], channel_chunk):
+        block = np.asarray(data[flat, start:start + channel_chunk], dtype=np.float32).reshape(n_trials, n_times, -1)
+        if window is not None:
+            block -= block[:, window].mean(axis=1, keepdims=True)
+        out[:, :, start:start + channel_chunk] = block
+    return out, times, keep
+
+
+def block_average(data, onsets, conditions, fs, tmin=-5.0, tmax=15.0, baseline=(-5.0, 0.0), channel_chunk=512):
+    """
+    Baseline-corrected average per condition, without keeping the epochs of more than one block of channels.
+
+    :param data: Data (nTpts x nChannels).
+    :param onsets: Onset samples of the triggers.
+    :param conditions: Condition label of each trigger.
+    :param fs: Sampling frequency in Hz.
+    :return: Tuple of (dict of condition -> average nTimes x nChannels, dict of condition -> standard error,
+        times, DataFrame of trial counts per condition).
+    """
+
+    index, times, keep = epoch_index(onsets, fs, tmin, tmax, data.shape[0])
+    conditions = np.asarray(conditions)[keep]
+    labels, groups = np.unique(conditions, return_inverse=True)
+    n_trials, n_times = index.shape
+    counts = np.bincount(groups, minlength=len(labels))
+    mean = np.zeros((len(labels), n_times, data.shape[1]), dtype=np.float32)
+    sem = np.zeros_like(mean)
+    flat = index.ravel()
+    window = None if baseline is None else (times >= baseline[0]) & (times <= baseline[1])
+    # Summing trials into their condition is a matrix product with the one-hot condition matrix
+    design = np.zeros((len(labels), n_trials))
+    design[groups, np.arange(n_trials)] = 1
+    for start in range(0, data.shape[1], channel_chunk):
+        block = np.asarray(data[flat, start:start + channel_chunk], dtype=np.float32).reshape(n_trials, n_times, -1)
+        if window is not None:
+            block -= block[:, window].mean(axis=1, keepdims=True)
+        flat_block = block.reshape(n_trials, -1).astype(np.float64)
+        total = design @ flat_block
+        squares = design @ (flat_block * flat_block)
+        m = total / counts[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = (squares - counts[:, None] * m * m) / (counts[:, None] - 1)
+            se = np.sqrt(np.maximum(var, 0) / counts[:, None])
+        mean[:, :, start:start + channel_chunk] = m.reshape(len(labels), n_times, -1)
+        sem[:, :, start:start + channel_chunk] = se.reshape(len(labels), n_times, -1)
+    averages = {label: mean[i] for i, label in enumerate(labels)}
+    errors = {label: sem[i] for i, label in enumerate(labels)}
+    return averages, errors, times, pd.DataFrame({'condition': labels, 'n_trials': counts})
+
+
+def average_events(data, events, fs, start_time=0.0, task=None, triggers=None, **window):
+    """
+    Block averages per condition straight from a task event table.
+
+    :param data: Data (nTpts x nChannels).
+    :param events: Event table from events.read_events.
+    :param fs: Sampling frequency in Hz.
+    :param start_time: Time of the 'Z' marker in the recording, in seconds.
+    :param task: Task name, to pick the window from TASK_WINDOWS and filter the events.
+    :param triggers: Trigger codes to epoch (defaults to the stimulus onsets: every trigger with a duration,
+        i.e. every flip-locked trigger but 'Z', which leaves out end markers sent without a flip).
+    :param window: tmin, tmax, baseline or channel_chunk overriding the task window.
+    """
+
+    if task is not None:
+        events = events[events['task'] == task]
+        window = dict(TASK_WINDOWS.get(task, {}), **window)
+    if triggers is None:
+        events = events[(events['trigger'] != 'Z') & events['duration'].notna()]
+    else:
+        events = events[events['trigger'].isin(triggers)]
+    onsets, _ = event_samples(events, fs, start_time)
+    return block_average(data, onsets, events['condition'].to_numpy(), fs, **window)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Block averages of an HD-DOT recording per condition')
+    parser.add_argument('recording', help='recording with an extension registered in prune_channels.LOADERS')
+    parser.add_argument('events', help='*_events.csv written by the task')
+    parser.add_argument('task', choices=list(TASK_WINDOWS))
+    parser.add_argument('--start-time', type=float, default=0.0, help="time of the 'Z' marker in the recording")
+    parser.add_argument('--lufr', action='store_true', help='also read .lufr recordings (layout not yet checked '
+                        'against a LUMO recording)')
+    args = parser.parse_args()
+    if args.lufr:
+        enable_lufr()
+
+    d, SD, fs = load_recording(args.recording)
+    averages, errors, times, counts = average_events(d, read_events(args.events), fs, args.start_time, args.task)
+    print(counts)
+    base = os.path.splitext(args.recording)[0] + '_' + args.task
+    np.savez(base + '_block_average.npz', times=times, conditions=counts['condition'].to_numpy(),
+             mean=np.stack([averages[c] for c in counts['condition']]),
+             sem=np.stack([errors[c] for c in counts['condition']]))
@@ -0,0 +1,87 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Reads the event tables written by the experiment scripts (experiment_scripts/event_table.py) so that
+# HD-DOT recordings can be epoched by joining onsets against the 'Z' start marker in the recording.
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+#%%%%%%%%%% Reading %%%%%%%%%%
+
+EVENT_DTYPES = {'task': str, 'onset': np.float64, 'flip_time': np.float64, 'trigger': str,
+                'code': np.int16, 'condition': str, 'duration': np.float64, 'wall_time': np.float64,
+                'ptb_time': np.float64, 'audio_time': np.float64}
+
+
+def read_events(filename, task=None):
+    """
+    Loads one event table.
+
+    :param filename: Path to a *_events.csv file.
+    :param task: Optional task name ('resting', 'imt', 'visual', 'motor', 'mmn') to keep.
+    :return: DataFrame with one row per trigger byte.
+    """
+
+    numeric = [column for column, dtype in EVENT_DTYPES.items() if dtype == np.float64]
+    events = pd.read_csv(filename, dtype=EVENT_DTYPES, keep_default_na=False,
+                         na_values={column: [''] for column in numeric})
+    if task is not None:
+        events = events[events['task'] == task].reset_index(drop=True)
+    return events
+
+
+def read_study_events(fpath, task=None):
+    """
+    Loads every event table for a participant or study folder into one table.
+
+    :param fpath: Folder searched recursively for *_events.csv files.
+    :param task: Optional task name to keep.
+    :return: DataFrame with an extra 'session' column holding the source filename.
+    """
+
+    files = sorted(glob.glob(os.path.join(fpath, '**', '*_events.csv'), recursive=True))
+    tables = []
+    for filename in files:
+        events = read_events(filename, task)
+        events.insert(0, 'session', os.path.basename(filename)[:-len('_events.csv')])
+        tables.append(events)
+    if not tables:
+        return pd.DataFrame(columns=['session'] + list(EVENT_DTYPES))
+    return pd.concat(tables, ignore_index=True)
+
+#%%%%%%%%%% Alignment %%%%%%%%%%
+
+
+def event_samples(events, fs, start_time=0.0):
+    """
+    Converts event onsets and durations to sample indices of a recording.
+
+    :param events: Event table from read_events.
+    :param fs: Sampling frequency of the recording in Hz.
+    :param start_time: Time of the 'Z' marker in the recording, in seconds.
+    :return: Tuple of (onset samples, duration in samples) as integer arrays.
+    """
+
+    onsets = np.rint((events['onset'].to_numpy() + start_time) * fs).astype(np.int64)
+    durations = np.rint(np.nan_to_num(events['duration'].to_numpy()) * fs).astype(np.int64)
+    return onsets, durations
+
+
+def join_recordings(events, recordings):
+    """
+    Aligns the events of many sessions to their recordings in a single join.
+
+    :param events: Table from read_study_events.
+    :param recordings: DataFrame with columns 'session', 'start_time' (time of the 'Z' marker in the
+        recording, in seconds) and 'fs' (sampling frequency in Hz).
+    :return: The events with 'sample' and 'duration_samples' columns added.
+    """
+
+    joined = events.merge(recordings[['session', 'start_time', 'fs']], on='session', how='inner')
+    joined['sample'] = np.rint((joined['onset'] + joined['start_time']) * joined['fs']).astype(np.int64)
+    joined['duration_samples'] = np.rint(joined['duration'].fillna(0) * joined['fs']).astype(np.int64)
+    return joined
@@ -0,0 +1,278 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Reads LUMO .lufr recordings without converting them to .nirs first. A .lufr file is a zip archive:
+#
+#   metadata.toml    file version
+#   recording.toml   [recording] chn_fps, n_chans and a [[channels]] table (src_node, src_optode, det_node,
+#                    det_optode, wavelength), one entry per column of the frames
+#   layout.json      optional cap layout (docks/optodes/coordinates_3d), as read by LUMO_findLayout.m
+#   data/*.bin       intensity frames, little-endian float32, frames x n_chans, chunked in name order
+#
+# The archive is indexed once. Frame chunks stored without compression are memory-mapped in place;
+# compressed chunks are inflated once into a .frames file next to the recording and mapped from there. The
+# .frames file is named after the CRCs of the chunks it holds, so a rewritten recording is inflated again.
+# Slicing a recording only reads the chunks and channels asked for.
+#
+# This layout has only been checked against the file versions in FILE_VERSIONS. Recordings of any other
+# version, or that do not match the layout, are refused with a ValueError instead of being misread. The layout
+# was written from the LUMO documentation and has not yet been checked against a recording from a LUMO
+# system, so the batch tools only read .lufr files when asked to (--lufr, see prune_channels.enable_lufr).
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+try:
+    import tomllib
+except ImportError:
+    import toml as tomllib
+
+FRAME_DTYPE = np.dtype('<f4')
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+# metadata.toml file versions whose archive layout this reader has been checked against
+FILE_VERSIONS = ('0.5.0',)
+CHANNEL_COLUMNS = ('src_node', 'src_optode', 'det_node', 'det_optode', 'wavelength')
+
+#%%%%%%%%%% Archive index %%%%%%%%%%
+
+
+def _data_offset(f, info):
+    """
+    Offset of a stored zip member's data, after its local header.
+    """
+
+    f.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    return info.header_offset + LOCAL_HEADER.size + header[9] + header[10]
+
+
+def _chunk_maps(filename, members, n_chans):
+    """
+    Maps every frame chunk of the archive.
+
+    :return: List of (first frame, memmap of frames x n_chans).
+    """
+
+    frame_bytes = n_chans * FRAME_DTYPE.itemsize
+    if all(info.compress_type == zipfile.ZIP_STORED for info in members):
+        source, offsets = filename, []
+        with open(filename, 'rb') as f:
+            for info in members:
+                offsets.append((_data_offset(f, info), info.file_size))
+    else:
+        key = hashlib.blake2b(repr([(info.filename, info.CRC, info.file_size) for info in members]).encode(),
+                              digest_size=8).hexdigest()
+        base = os.path.splitext(filename)[0]
+        source = '%s.%s.frames' % (base, key)
+        offsets, position = [], 0
+        for info in members:
+            offsets.append((position, info.file_size))
+            position += info.file_size
+        if not os.path.exists(source) or os.path.getsize(source) != position:
+            # Every worker inflates into its own temporary file; the rename is atomic
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(base) + '.', suffix='.tmp',
+                                       dir=os.path.dirname(source) or '.')
+            try:
+                with zipfile.ZipFile(filename) as archive, os.fdopen(fd, 'wb') as out:
+                    for info in members:
+                        with archive.open(info) as member:
+                            shutil.copyfileobj(member, out, 1 << 20)
+                os.replace(tmp, source)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            # Frames inflated from an earlier version of the recording
+            for stale in glob.glob(glob.escape(base) + '.*.frames'):
+                if stale != source:
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+
+    chunks, start = [], 0
+    for offset, size in offsets:
+        n_frames = size // frame_bytes
+        if n_frames == 0:
+            continue
+        chunks.append((start, np.memmap(source, dtype=FRAME_DTYPE, mode='r', offset=offset,
+                                        shape=(n_frames, n_chans))))
+        start += n_frames
+    return chunks
+
+#%%%%%%%%%% Recording %%%%%%%%%%
+
+
+class LufrRecording:
+    """
+    Intensity frames of a .lufr recording (nTpts x nChannels) that slice lazily like an array.
+
+    d[a:b] and d[a:b, channels] read only the chunks covering frames a to b, so a recording can be passed
+    straight to prune_channels or epoched without loading every channel into memory.
+
+    :param filename: Path to the .lufr file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with zipfile.ZipFile(filename) as archive:
+            names = archive.namelist()
+            for name in ('metadata.toml', 'recording.toml'):
+                if name not in names:
+                    raise ValueError(f'{filename} has no {name}; not a .lufr archive this reader understands')
+            self.metadata = tomllib.loads(archive.read('metadata.toml').decode())
+            version = str(self.metadata.get('file_version'))
+            if version not in FILE_VERSIONS:
+                raise ValueError(f'{filename} has file_version {version}; only {", ".join(FILE_VERSIONS)} have '
+                                 f'been checked against this reader')
+            recording = tomllib.loads(archive.read('recording.toml').decode())
+            self.layout = json.loads(archive.read('layout.json')) if 'layout.json' in names else None
+            members = sorted((info for info in archive.infolist()
+                              if info.filename.startswith('data/') and info.filename.endswith('.bin')),
+                             key=lambda info: info.filename)
+        try:
+            self.fs = float(recording['recording']['chn_fps'])
+            n_chans = int(recording['recording']['n_chans'])
+        except KeyError as e:
+            raise ValueError(f'{filename}: recording.toml has no [recording] {e.args[0]}') from None
+        self.channels = pd.DataFrame(recording.get('channels', []))
+        missing = [c for c in CHANNEL_COLUMNS if c not in self.channels]
+        if missing or len(self.channels) != n_chans:
+            raise ValueError(f'{filename}: recording.toml lists {len(self.channels)} channels for n_chans = '
+                             f'{n_chans}' + (f' and lacks {", ".join(missing)}' if missing else ''))
+        frame_bytes = n_chans * FRAME_DTYPE.itemsize
+        if not members or any(info.file_size % frame_bytes for info in members):
+            raise ValueError(f'{filename}: data/*.bin chunks are missing or not whole frames of {n_chans} float32')
+        self.__chunks = _chunk_maps(filename, members, n_chans)
+        self.__starts = np.array([start for start, _ in self.__chunks] +
+                                 [self.__chunks[-1][0] + len(self.__chunks[-1][1]) if self.__chunks else 0])
+        self.shape = (int(self.__starts[-1]), n_chans)
+        self.dtype = FRAME_DTYPE
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def t(self):
+        return np.arange(self.shape[0]) / self.fs
+
+    def __read_frames(self, start, stop, channels):
+        first = max(0, np.searchsorted(self.__starts, start, side='right') - 1)
+        last = np.searchsorted(self.__starts, stop, side='left')
+        parts = []
+        for chunk_start, chunk in self.__chunks[first:last]:
+            part = chunk[max(start - chunk_start, 0):max(min(stop - chunk_start, len(chunk)), 0)]
+            parts.append(part[:, channels])
+        if not parts:
+            return np.empty((0, len(np.arange(self.shape[1])[channels])), dtype=FRAME_DTYPE)
+        return np.concatenate(parts) if len(parts) > 1 else np.array(parts[0])
+
+    def __getitem__(self, key):
+        time, channels = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(time, slice):
+            start, stop, step = time.indices(self.shape[0])
+            frames = self.__read_frames(start, max(start, stop), channels)
+            return frames[::step] if step != 1 else frames
+        if np.isscalar(time):
+            time = int(time)
+            if not -self.shape[0] <= time < self.shape[0]:
+                raise IndexError('frame %d is out of range for a recording of %d frames' % (time, self.shape[0]))
+            time = time % self.shape[0]
+            return self.__read_frames(time, time + 1, channels)[0]
+        # Index arrays are read chunk by chunk, so scattered epochs do not pull in the frames between them
+        time = np.asarray(time)
+        if time.dtype == bool:
+            time = np.flatnonzero(time)
+        if time.size and not (-self.shape[0] <= time.min() and time.max() < self.shape[0]):
+            raise IndexError('frames out of range for a recording of %d frames' % self.shape[0])
+        time = np.where(time < 0, time + self.shape[0], time)
+        order = np.argsort(time, kind='stable')
+        out = np.empty((time.size, len(np.arange(self.shape[1])[channels])), dtype=FRAME_DTYPE)
+        chunk_index = np.searchsorted(self.__starts, time[order], side='right') - 1
+        for c in np.unique(chunk_index):
+            selected = order[chunk_index == c]
+            chunk_start, chunk = self.__chunks[c]
+            out[selected] = chunk[time[selected] - chunk_start][:, channels]
+        return out
+
+#%%%%%%%%%% Probe %%%%%%%%%%
+
+
+def layout_positions(layout):
+    """
+    Optode positions of a LUMO layout, named Src<dock><A/B/C> and Det<dock><1-4> as in register_layout.py.
+
+    :return: Dict of name -> (x, y, z).
+    """
+
+    positions = {}
+    for dock in layout['docks']:
+        dock_id = str(dock['dock_id']).split('_')[-1]
+        for optode in dock['optodes']:
+            optode_id = str(optode['optode_id']).split('_')[-1]
+            prefix = 'Src' if optode_id.isalpha() else 'Det'
+            c = optode['coordinates_3d']
+            positions[prefix + dock_id + optode_id] = (c['x'], c['y'], c['z'])
+    return positions
+
+
+def probe(recording, layout=None):
+    """
+    Builds the SD structure used by prune_channels (flat, one row per channel and wavelength).
+
+    :param recording: LufrRecording.
+    :param layout: LUMO layout dict (defaults to the layout embedded in the recording).
+    :return: Dict with 'MeasList', 'SrcPos', 'DetPos', 'Lambda' and the optode names in 'SrcNames'/'DetNames'.
+    """
+
+    layout = layout if layout is not None else recording.layout
+    if layout is None:
+        raise ValueError(f'{recording.filename} has no embedded layout; pass one from LUMO_findLayout')
+    positions = layout_positions(layout)
+    channels = recording.channels
+    src = 'Src' + channels['src_node'].astype(str) + channels['src_optode'].astype(str)
+    det = 'Det' + channels['det_node'].astype(str) + channels['det_optode'].astype(str)
+    src_names, src_index = np.unique(src, return_inverse=True)
+    det_names, det_index = np.unique(det, return_inverse=True)
+    wavelengths, wavelength_index = np.unique(channels['wavelength'], return_inverse=True)
+    meas_list = np.column_stack([src_index + 1, det_index + 1, np.ones(len(channels), dtype=np.int64),
+                                 wavelength_index + 1])
+    return {'MeasList': meas_list, 'SrcPos': np.array([positions[name] for name in src_names]),
+            'DetPos': np.array([positions[name] for name in det_names]), 'Lambda': wavelengths,
+            'SrcNames': list(src_names), 'DetNames': list(det_names)}
+
+
+def load_lufr(filename, layout_file=None):
+    """
+    Loads a .lufr recording into (d, SD, fs), with d memory-mapped. Registered in prune_channels.LOADERS by enable_lufr (--lufr).
+
+    :param filename: Path to the .lufr file.
+    :param layout_file: LUMO layout json to use instead of the embedded one.
+    """
+
+    recording = LufrRecording(filename)
+    layout = None
+    if layout_file is not None:
+        with open(layout_file) as f:
+            layout = json.load(f)
+    return recording, probe(recording, layout), recording.fs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarises a LUMO .lufr recording')
+    parser.add_argument('filename')
+    args = parser.parse_args()
+    recording = LufrRecording(args.filename)
+    print(f'{args.filename}: {recording.shape[0]} frames x {recording.shape[1]} channels at {recording.fs} Hz '
+          f'({recording.shape[0] / recording.fs:.1f} s)')
@@ -0,0 +1,334 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Memoized preprocessing pipeline: load -> od -> prune -> conc, the Python counterpart of the stages that
+# dataQualityCheck.m reruns from raw on every call.
+#
+# Every stage names its upstream stages and its parameters. Its output is cached on disk under a key made
+# from the stage name and version, its parameters and the keys of its inputs; the root key is a content
+# hash of the recording. Changing SNRthresh therefore reuses the optical density and only reruns prune and
+# conc. Arrays are cached as .npy and reloaded memory-mapped. The load stage is not cached: it only opens the
+# recording (a .lufr is memory-mapped), and od and prune read it in chunks, so the raw intensities are never
+# held in memory or copied into the cache. od writes its chunks straight into a memory-mapped .npy in its
+# cache folder, so the optical density is not held in memory either.
+#
+#   python pipeline.py <study folder> --task visual --target conc --snr 8 --workers 8
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from prune_channels import LOADERS, enable_lufr, load_recording, prune_channels, source_detector_distances
+
+#%%%%%%%%%% Stages %%%%%%%%%%
+
+# Molar extinction coefficients (cm-1/M) of HbO and HbR from Prahl's tabulation, as used by Homer2's
+# GetExtinctions; intermediate wavelengths are interpolated
+EXTINCTION = pd.DataFrame(
+    [(700, 290, 1794.28), (710, 314, 1540.48), (720, 348, 1325.88), (730, 390, 1102.2), (740, 446, 1115.88),
+     (750, 506, 1405.24), (760, 586, 1548.52), (770, 652, 1311.88), (780, 710, 1075.44), (790, 770, 882.52),
+     (800, 816, 761.72), (810, 864, 717.08), (820, 916, 693.44), (830, 974, 693.04), (840, 1022, 692.36),
+     (850, 1058, 691.32), (860, 1092, 694.32), (870, 1128, 705.84), (880, 1154, 726.44), (890, 1178, 743.6),
+     (900, 1198, 761.84)], columns=['wavelength', 'HbO', 'HbR']).set_index('wavelength')
+
+
+def extinctions(wavelengths):
+    """
+    :return: Array (nWavelengths x 2) of HbO/HbR extinction in /mm/M, natural log base (as GetExtinctions/10).
+    """
+
+    wavelengths = np.asarray(wavelengths, dtype=np.float64).ravel()
+    e = np.column_stack([np.interp(wavelengths, EXTINCTION.index, EXTINCTION[c]) for c in ('HbO', 'HbR')])
+    return e * np.log(10) / 10
+
+
+def load_stage(source):
+    """
+    Opens a recording. 'd' is whatever the loader returns (a LufrRecording or np.memmap slices lazily).
+    """
+
+    d, SD, fs = load_recording(source)
+    return {'d': d, 'SD': SD, 'fs': fs}
+
+
+def od_stage(load, chunk_size=8192, folder=None):
+    """
+    Optical density relative to the channel means, as hmrIntensity2OD. The intensities are read twice in
+    chunks (once for the means), never as a whole, and the optical density is written chunk by chunk into
+    a memory-mapped dod.npy in folder. The sampling rate and probe are passed on with it, so a reader of
+    the cached optical density does not have to open the recording again.
+
+    :param folder: Folder for dod.npy (the stage's cache folder when run by a Pipeline); in memory if None.
+    """
+
+    d = load['d']
+    dm = np.zeros(d.shape[1])
+    for start in range(0, d.shape[0], chunk_size):
+        dm += np.abs(np.asarray(d[start:start + chunk_size], dtype=np.float64)).sum(axis=0)
+    dm /= d.shape[0]
+    if folder is None:
+        dod = np.empty(d.shape, dtype=np.float32)
+    else:
+        dod = np.lib.format.open_memmap(os.path.join(folder, 'dod.npy'), mode='w+', dtype=np.float32, shape=d.shape)
+    for start in range(0, d.shape[0], chunk_size):
+        dod[start:start + chunk_size] = -np.log(np.abs(d[start:start + chunk_size]) / dm)
+    return {'dod': dod, 'fs': load['fs'], 'SD': load['SD']}
+
+
+def prune_stage(load, dRange=(0, 1e11), SNRthresh=12, SDrange=(0, 100)):
+    SD, channel_stats = prune_channels(load['d'], load['SD'], load['fs'], dRange=dRange, SNRthresh=SNRthresh,
+                                       SDrange=SDrange)
+    return {'SD': SD, 'channel_stats': channel_stats}
+
+
+def conc_stage(od, prune, ppf=(6.0, 6.0)):
+    """
+    Haemoglobin concentration changes by the modified Beer-Lambert law, as hmrOD2Conc.
+
+    :return: 'dc' (nTpts x 3 x nPairs: HbO, HbR, HbT, in M) with pruned pairs and pairs that are missing a
+        wavelength set to NaN, and the source/detector index of each pair.
+    """
+
+    SD = prune['SD']
+    dod = od['dod']
+    meas_list = np.asarray(SD['MeasList']).astype(np.int64)
+    wavelengths = np.asarray(SD['Lambda']).ravel()
+    e = extinctions(wavelengths)
+    einv = np.linalg.pinv(e)  # 2 x nWavelengths
+    pairs, pair_index = np.unique(meas_list[:, :2], axis=0, return_inverse=True)
+    pair_index = pair_index.ravel()
+    rho = source_detector_distances(SD)
+
+    # Channels ordered as (pair, wavelength) so each pair is one (nTpts x nWavelengths) slab
+    columns = np.full((len(pairs), len(wavelengths)), -1)
+    columns[pair_index, meas_list[:, 3] - 1] = np.arange(len(meas_list))
+    # A pair without a channel at every wavelength cannot be converted; it reads channel 0 and is masked below
+    complete = (columns >= 0).all(axis=1)
+    columns[~complete] = 0
+    scale = rho[columns] * np.asarray(ppf, dtype=np.float64)[None, :len(wavelengths)]
+    dc = np.einsum('hw,tpw->thp', einv, dod[:, columns] / scale.astype(np.float32)).astype(np.float32)
+    dc = np.concatenate([dc, dc[:, :1] + dc[:, 1:2]], axis=1)
+    active = np.asarray(SD['MeasListAct']).ravel()[columns].all(axis=1) & complete
+    dc[:, :, ~active] = np.nan
+    return {'dc': dc, 'pairs': pairs}
+
+#%%%%%%%%%% Pipeline %%%%%%%%%%
+
+
+class Stage:
+    """
+    A pipeline step.
+
+    :param name: Stage name, also the name its output is passed under to downstream stages.
+    :param function: Called with the outputs (dicts) of the upstream stages, in order, and the parameters
+        as keyword arguments. Returns a dict of outputs. The root stage gets the source filename instead.
+    :param inputs: Names of the upstream stages (empty for the root).
+    :param params: Default parameters.
+    :param version: Bump when the function changes, to invalidate its cache.
+    :param cache: False for a stage that is cheaper to rerun than to store; it still has a key for its
+        downstream stages.
+    :param in_place: True for a cached stage that writes its arrays into its cache folder itself (as
+        memory-maps, for outputs too large to hold); it gets the folder as folder=.
+    """
+
+    def __init__(self, name, function, inputs=(), params=None, version=1, cache=True, in_place=False):
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.params = dict(params or {})
+        self.version = version
+        self.cache = cache
+        self.in_place = in_place
+
+
+STAGES = [Stage('load', load_stage, version=2, cache=False),
+          Stage('od', od_stage, inputs=('load',), version=2, in_place=True),
+          Stage('prune', prune_stage, inputs=('load',), params={'dRange': (0, 1e11), 'SNRthresh': 12,
+                                                               'SDrange': (0, 100)}),
+          Stage('conc', conc_stage, inputs=('od', 'prune'), params={'ppf': (6.0, 6.0)})]
+
+
+def content_hash(filename, folder, block_size=1 << 20):
+    """
+    Hash of a file's contents, remembered for as long as its size and mtime are unchanged.
+
+    :param filename: File to hash.
+    :param folder: Folder the hash is remembered in (the pipeline cache, not the participant folder).
+    """
+
+    stat = os.stat(filename)
+    name = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=16).hexdigest()
+    sidecar = os.path.join(folder, name + '.hash')
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            size, mtime, digest = f.read().split()
+        if int(size) == stat.st_size and float(mtime) == stat.st_mtime:
+            return digest
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    try:
+        os.makedirs(folder, exist_ok=True)
+        with open(sidecar + '.tmp%d' % os.getpid(), 'w') as f:
+            f.write('%d %r %s' % (stat.st_size, stat.st_mtime, digest))
+        os.replace(sidecar + '.tmp%d' % os.getpid(), sidecar)
+    except OSError:
+        pass
+    return digest
+
+
+class Pipeline:
+    """
+    Runs stages on demand and caches the outputs of every cached stage under <cache_dir>/<stage>/<key>/.
+
+    :param cache_dir: Cache folder.
+    :param stages: List of Stage (defaults to STAGES).
+    """
+
+    def __init__(self, cache_dir, stages=None):
+        self.cache_dir = cache_dir
+        self.stages = {stage.name: stage for stage in (stages or STAGES)}
+
+    def key(self, name, source, params=None):
+        """
+        Cache key of a stage for a recording, given per-stage parameter overrides.
+        """
+
+        params = params or {}
+        stage = self.stages[name]
+        upstream = ([self.key(i, source, params) for i in stage.inputs] if stage.inputs
+                    else [content_hash(source, os.path.join(self.cache_dir, 'hashes'))])
+        settings = dict(stage.params, **params.get(name, {}))
+        description = json.dumps([name, stage.version, sorted(settings.items()), upstream], default=repr)
+        return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def __load(self, folder):
+        outputs = {}
+        for filename in os.listdir(folder):
+            name, ext = os.path.splitext(filename)
+            if ext == '.npy':
+                outputs[name] = np.load(os.path.join(folder, filename), mmap_mode='r')
+            elif ext == '.pkl':
+                with open(os.path.join(folder, filename), 'rb') as f:
+                    outputs[name] = pickle.load(f)
+        return outputs
+
+    def __write(self, tmp, outputs):
+        os.makedirs(tmp, exist_ok=True)
+        for name, value in outputs.items():
+            filename = os.path.join(tmp, name + '.npy')
+            if isinstance(value, np.memmap) and os.path.abspath(value.filename) == os.path.abspath(filename):
+                # Written in place by the stage
+                value.flush()
+            elif isinstance(value, np.ndarray):
+                np.save(filename, value)
+            else:
+                with open(os.path.join(tmp, name + '.pkl'), 'wb') as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __commit(self, tmp, folder):
+        try:
+            os.rename(tmp, folder)
+        except OSError:
+            # Another worker finished the same stage first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def run(self, name, source, params=None, _memo=None):
+        """
+        Returns the outputs of a stage for a recording, computing only the stages whose cache is missing.
+
+        :param name: Stage name.
+        :param source: Recording filename.
+        :param params: Per-stage parameter overrides, e.g. {'prune': {'SNRthresh': 8}}.
+        :return: Dict of the stage's outputs.
+        """
+
+        params = params or {}
+        memo = {} if _memo is None else _memo
+        if name in memo:
+            return memo[name]
+        stage = self.stages[name]
+        folder = os.path.join(self.cache_dir, name, self.key(name, source, params))
+        if stage.cache and os.path.isdir(folder):
+            outputs = self.__load(folder)
+        else:
+            settings = dict(stage.params, **params.get(name, {}))
+            tmp = folder + '.tmp%d' % os.getpid()
+            if stage.cache and stage.in_place:
+                os.makedirs(tmp, exist_ok=True)
+                settings['folder'] = tmp
+            if stage.inputs:
+                outputs = stage.function(*[self.run(i, source, params, memo) for i in stage.inputs], **settings)
+            else:
+                outputs = stage.function(source, **settings)
+            if stage.cache:
+                self.__write(tmp, outputs)
+                if stage.in_place:
+                    # The memory-maps are closed before their folder is moved, then reopened from the cache
+                    del outputs
+                    self.__commit(tmp, folder)
+                    outputs = self.__load(folder)
+                else:
+                    self.__commit(tmp, folder)
+        memo[name] = outputs
+        return outputs
+
+
+def _run_one(cache_dir, name, source, params):
+    pipeline = Pipeline(cache_dir)
+    pipeline.run(name, source, params)
+    return {'file': source, 'stage': name, 'key': pipeline.key(name, source, params)}
+
+
+def run_study(fpath, name='conc', task=None, params=None, cache_dir=None, workers=None):
+    """
+    Runs a stage for every recording under a study folder, one participant per core.
+
+    :param fpath: Study folder, searched recursively for recordings registered in LOADERS.
+    :param name: Stage to compute.
+    :param task: Optional task name that filenames must contain.
+    :param params: Per-stage parameter overrides.
+    :param cache_dir: Cache folder (defaults to <fpath>/pipeline_cache).
+    :param workers: Number of worker processes.
+    :return: DataFrame of the cache key per recording, with the error message of the ones that failed.
+    """
+
+    cache_dir = cache_dir or os.path.join(fpath, 'pipeline_cache')
+    files = sorted(f for ext in LOADERS for f in glob.glob(os.path.join(fpath, '**', '*' + ext), recursive=True)
+                   if task is None or task in os.path.basename(f))
+    print(f'Running {name} on {len(files)} recordings...')
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_run_one, cache_dir, name, f, params) for f in files]
+        for f, future in zip(files, futures):
+            try:
+                rows.append(dict(future.result(), error=''))
+            except Exception as e:
+                print(f'{name} failed on {f}: {e}')
+                rows.append({'file': f, 'stage': name, 'key': None, 'error': str(e)})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memoized HD-DOT preprocessing')
+    parser.add_argument('fpath', help='study folder')
+    parser.add_argument('--task', default=None)
+    parser.add_argument('--target', default='conc', choices=[stage.name for stage in STAGES])
+    parser.add_argument('--snr', type=float, default=12)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--lufr', action='store_true', help='also read .lufr recordings (layout not yet checked '
+                        'against a LUMO recording)')
+    args = parser.parse_args()
+    if args.lufr:
+        enable_lufr()
+    print(run_study(args.fpath, args.target, args.task, {'prune': {'SNRthresh': args.snr}}, workers=args.workers))
@@ -0,0 +1,259 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Python port of utils/enPruneChannels.m. Channel statistics are reduced over time in chunks, so
+# recordings that do not fit in memory (np.memmap or any array that slices lazily) can be checked too.
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.io import loadmat
+
+from lufr_reader import load_lufr
+
+#%%%%%%%%%% Streaming reductions %%%%%%%%%%
+
+
+class ChannelStats:
+    """
+    Running per-channel mean and standard deviation, merged chunk by chunk (Chan et al.) so that the
+    result matches mean(d,1) and std(d,[],1) over the whole recording.
+    """
+
+    def __init__(self, n_channels):
+        self.n = 0
+        self.mean = np.zeros(n_channels)
+        self.m2 = np.zeros(n_channels)
+
+    def update(self, chunk):
+        m = chunk.shape[0]
+        if m == 0:
+            return
+        chunk_mean = chunk.mean(axis=0, dtype=np.float64)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        total = self.n + m
+        delta = chunk_mean - self.mean
+        self.mean += delta * (m / total)
+        self.m2 += chunk_m2 + delta ** 2 * (self.n * m / total)
+        self.n = total
+
+    @property
+    def std(self):
+        if self.n < 2:
+            return np.full_like(self.mean, np.nan)
+        return np.sqrt(self.m2 / (self.n - 1))
+
+
+class ChannelSpectra:
+    """
+    Welch-averaged power spectrum of a subset of channels, accumulated segment by segment.
+    """
+
+    def __init__(self, channels, fs, nperseg):
+        self.channels = channels
+        self.nperseg = nperseg
+        self.window = np.hanning(nperseg)
+        self.freqs = np.fft.rfftfreq(nperseg, 1 / fs)
+        self.power = np.zeros((self.freqs.size, channels.size))
+        self.n_segments = 0
+
+    def update(self, chunk):
+        n_seg = chunk.shape[0] // self.nperseg
+        if n_seg == 0 or self.channels.size == 0:
+            return
+        x = chunk[:n_seg * self.nperseg, self.channels].reshape(n_seg, self.nperseg, -1)
+        x = (x - x.mean(axis=1, keepdims=True)) * self.window[None, :, None]
+        self.power += (np.abs(np.fft.rfft(x, axis=1)) ** 2).sum(axis=0)
+        self.n_segments += n_seg
+
+#%%%%%%%%%% Pruning %%%%%%%%%%
+
+
+def source_detector_distances(SD):
+    """
+    Source-detector separation of every channel in SD.MeasList.
+
+    :param SD: Probe structure with 'MeasList', 'SrcPos' and 'DetPos' (1-based indices as in MATLAB).
+    :return: Array of distances, one per row of MeasList.
+    """
+
+    meas_list = np.asarray(SD['MeasList']).astype(np.int64)
+    src_pos = np.asarray(SD['SrcPos'], dtype=np.float64)
+    det_pos = np.asarray(SD['DetPos'], dtype=np.float64)
+    return np.linalg.norm(src_pos[meas_list[:, 0] - 1] - det_pos[meas_list[:, 1] - 1], axis=1)
+
+
+def prune_channels(d, SD, fs, tInc=None, dRange=(0, 1e11), SNRthresh=12, SDrange=(0, 100), reset=False,
+                   chunk_size=8192, short_sep=10, cardiac_band=(0.5, 2.0)):
+    """
+    Marks channels as inactive when their signal is too weak, too strong, too noisy or their
+    source-detector separation is out of range, as enPruneChannels.m does.
+
+    Short channels (separation < short_sep) are also pruned when the peak of their spectrum in the
+    cardiac band sits on a band edge, i.e. no pulse is visible. The band edges are inclusive here so
+    that this check can trigger; a channel pair is pruned at every wavelength if it fails at any.
+
+    :param d: Intensity data (nTpts x nChannels). A np.memmap is read chunk by chunk.
+    :param SD: Probe structure (dict) with 'MeasList', 'SrcPos', 'DetPos', 'Lambda'.
+    :param fs: Sampling frequency of the data.
+    :param tInc: Optional boolean vector of timepoints to include.
+    :param dRange: Channels with mean(d) outside this range are pruned.
+    :param SNRthresh: Channels with mean(d)/std(d) below this are pruned.
+    :param SDrange: Channels with a separation outside this range are pruned.
+    :param reset: Reset previously pruned channels.
+    :param chunk_size: Number of timepoints reduced at once.
+    :return: Copy of SD with 'MeasListAct' and 'MeasListActAuto' updated, and a DataFrame of channel stats.
+    """
+
+    meas_list = np.asarray(SD['MeasList']).astype(np.int64)
+    n_channels = meas_list.shape[0]
+    rho = source_detector_distances(SD)
+
+    nperseg = int(2 ** np.ceil(np.log2(fs * 20)))
+    chunk_size = max(nperseg, chunk_size // nperseg * nperseg)
+    stats = ChannelStats(n_channels)
+    spectra = ChannelSpectra(np.flatnonzero(rho < short_sep), fs, nperseg)
+
+    for start in range(0, d.shape[0], chunk_size):
+        chunk = np.asarray(d[start:start + chunk_size], dtype=np.float64)
+        if tInc is not None:
+            chunk = chunk[np.asarray(tInc[start:start + chunk_size], dtype=bool)]
+        stats.update(chunk)
+        spectra.update(chunk)
+
+    dmean = stats.mean
+    dstd = stats.std
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = dmean / dstd
+    keep = (dmean > dRange[0]) & (dmean < dRange[1]) & (snr > SNRthresh) & (rho >= SDrange[0]) & (rho <= SDrange[1])
+
+    if spectra.n_segments > 0:
+        band = np.flatnonzero((spectra.freqs >= cardiac_band[0]) & (spectra.freqs <= cardiac_band[1]))
+        peak = band[np.argmax(spectra.power[band], axis=0)]
+        keep[spectra.channels[(peak == band[0]) | (peak == band[-1])]] = False
+
+    # A source-detector pair is only kept if it passes at every wavelength
+    pair = np.unique(meas_list[:, :2], axis=0, return_inverse=True)[1].ravel()
+    pair_keep = np.ones(pair.max() + 1, dtype=bool)
+    np.logical_and.at(pair_keep, pair, keep)
+    keep = pair_keep[pair]
+
+    SD = dict(SD)
+    if reset or 'MeasListAct' not in SD:
+        SD['MeasListAct'] = np.ones(n_channels)
+    SD['MeasListActAuto'] = keep.astype(np.float64)
+    SD['MeasListAct'] = np.where(keep, np.asarray(SD['MeasListAct'], dtype=np.float64).ravel(), 0)
+
+    channel_stats = pd.DataFrame({'source': meas_list[:, 0], 'detector': meas_list[:, 1],
+                                  'wavelength': meas_list[:, 3], 'distance': rho, 'mean': dmean,
+                                  'std': dstd, 'snr': snr, 'active': keep})
+    return SD, channel_stats
+
+#%%%%%%%%%% Batch mode %%%%%%%%%%
+
+
+def load_nirs(filename):
+    """
+    Loads a .nirs file (as written by LumoData.write_NIRS) into (d, SD, fs).
+    """
+
+    nirs = loadmat(filename, squeeze_me=True, struct_as_record=False)
+    probe = nirs['SD3D'] if 'SD3D' in nirs else nirs['SD']
+    SD = {key: getattr(probe, key) for key in ('MeasList', 'SrcPos', 'DetPos', 'Lambda')}
+    fs = 1 / np.median(np.diff(nirs['t']))
+    return nirs['d'], SD, fs
+
+
+# .lufr reading is opt-in (--lufr, or LUMO_READ_LUFR=1) until the archive layout assumed in lufr_reader.py
+# has been checked against a recording from a LUMO system
+LOADERS = {'.nirs': load_nirs}
+
+
+def enable_lufr():
+    """
+    Registers the .lufr reader in LOADERS, here and in worker processes started afterwards.
+    """
+
+    os.environ['LUMO_READ_LUFR'] = '1'
+    LOADERS['.lufr'] = load_lufr
+
+
+if os.environ.get('LUMO_READ_LUFR') == '1':
+    enable_lufr()
+
+
+def load_recording(filename):
+    """
+    Loads a recording with the loader registered for its extension.
+
+    :return: (d, SD, fs).
+    """
+
+    extension = os.path.splitext(filename)[1]
+    if extension not in LOADERS:
+        hint = ' (pass --lufr to read .lufr recordings)' if extension == '.lufr' else ''
+        raise ValueError('%s: no loader for %s recordings%s' % (filename, extension or 'extensionless', hint))
+    return LOADERS[extension](filename)
+
+
+def qc_file(filename, **params):
+    """
+    Runs prune_channels on one recording and saves its channel table next to it.
+
+    :param filename: Recording with an extension registered in LOADERS.
+    :return: One-row summary dict.
+    """
+
+    d, SD, fs = load_recording(filename)
+    SD, channel_stats = prune_channels(d, SD, fs, **params)
+    channel_stats.to_csv(os.path.splitext(filename)[0] + '_channelQC.csv', header=True, index=False)
+    return {'file': filename, 'fs': fs, 'n_channels': len(channel_stats),
+            'n_active': int(channel_stats['active'].sum()),
+            'median_snr': float(np.nanmedian(channel_stats['snr']))}
+
+
+def qc_study(fpath, task=None, workers=None, **params):
+    """
+    Runs the channel QC on every recording found under a study folder, one file per core.
+
+    :param fpath: Study folder, searched recursively.
+    :param task: Optional task name that filenames must contain (as in dataQualityCheck.m).
+    :param workers: Number of worker processes (defaults to all cores).
+    :return: DataFrame with one row per recording, also saved as qc_summary.csv in fpath. Recordings that
+        failed have their error message in 'error'.
+    """
+
+    files = sorted(f for ext in LOADERS for f in glob.glob(os.path.join(fpath, '**', '*' + ext), recursive=True)
+                   if task is None or task in os.path.basename(f))
+    print(f'Running channel QC on {len(files)} recordings...')
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(qc_file, f, **params) for f in files]
+        for f, future in zip(files, futures):
+            # A recording that cannot be read is reported and skipped rather than stopping the batch
+            try:
+                rows.append(dict(future.result(), error=''))
+            except Exception as e:
+                print(f'Channel QC failed on {f}: {e}')
+                rows.append({'file': f, 'error': str(e)})
+    summary = pd.DataFrame(rows)
+    summary.to_csv(os.path.join(fpath, 'qc_summary.csv'), header=True, index=False)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HD-DOT channel quality pruning')
+    parser.add_argument('fpath', help='study folder')
+    parser.add_argument('--task', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--snr', type=float, default=12)
+    parser.add_argument('--lufr', action='store_true', help='also read .lufr recordings (layout not yet checked '
+                        'against a LUMO recording)')
+    args = parser.parse_args()
+    if args.lufr:
+        enable_lufr()
+    qc_study(args.fpath, task=args.task, workers=args.workers, SNRthresh=args.snr)
@@ -0,0 +1,167 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Image reconstruction of HD-DOT data from cached sensitivity (Jacobian) matrices.
+#
+# Jacobians are imported once from DOTHUB .jac files and stored as .npy per (layout, head model,
+# wavelength) under a store folder, then memory-mapped by every session that uses the same cap. The
+# Tikhonov-regularised inverse, J' (JJ' + lambda I)^-1 with lambda = alpha * max(eig(JJ')) as in
+# DOTHUB_invertJacobian, is cached next to it for each set of active channels. Reconstructing a session
+# is then one float32 matrix product per batch of frames, with batches spread over threads.
+#
+#   python reconstruction.py import <store> <file.jac> --layout <cap> --head-model <mesh>
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import glob
+import hashlib
+import os
+
+import numpy as np
+from scipy.io import loadmat
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from pipeline import extinctions
+
+#%%%%%%%%%% Jacobian store %%%%%%%%%%
+
+
+def load_jac(filename):
+    """
+    Reads the per-wavelength Jacobians of a DOTHUB .jac file (MATLAB v7 or v7.3).
+
+    :return: Dict of wavelength -> Jacobian (nChannels x nNodes) in the basis it was saved in.
+    """
+
+    try:
+        jac = loadmat(filename, squeeze_me=True, struct_as_record=False)
+        J = np.atleast_1d(jac['J'])
+        wavelengths = np.atleast_1d(jac['SD3D'].Lambda if 'SD3D' in jac else jac['SD'].Lambda)
+        return {float(w): np.asarray(j.basis if hasattr(j, 'basis') else j.vol, dtype=np.float32)
+                for w, j in zip(wavelengths, J)}
+    except NotImplementedError:
+        if h5py is None:
+            raise
+        with h5py.File(filename, 'r') as f:
+            probe = f['SD3D'] if 'SD3D' in f else f['SD']
+            wavelengths = np.ravel(probe['Lambda'][()])
+            matrices = {}
+            for w, ref in zip(wavelengths, np.ravel(f['J'][()])):
+                j = f[ref]
+                # MATLAB stores column-major, so the arrays come back transposed
+                matrices[float(w)] = np.asarray(j['basis' if 'basis' in j else 'vol'][()], dtype=np.float32).T
+            return matrices
+
+
+class JacobianStore:
+    """
+    Jacobians and their regularised inverses on disk, keyed by layout, head model and wavelength.
+
+    :param root: Store folder.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def __folder(self, layout, head_model, wavelength):
+        return os.path.join(self.root, layout, head_model, '%g' % wavelength)
+
+    def put(self, layout, head_model, wavelength, J):
+        """
+        Stores a Jacobian, replacing any earlier one and the inverses cached for it.
+        """
+
+        folder = self.__folder(layout, head_model, wavelength)
+        os.makedirs(folder, exist_ok=True)
+        for filename in glob.glob(os.path.join(folder, 'inverse_*.npy')):
+            os.remove(filename)
+        np.save(os.path.join(folder, 'J.npy'), np.asarray(J, dtype=np.float32))
+
+    def import_jac(self, filename, layout, head_model):
+        for wavelength, J in load_jac(filename).items():
+            self.put(layout, head_model, wavelength, J)
+
+    def jacobian(self, layout, head_model, wavelength):
+        return np.load(os.path.join(self.__folder(layout, head_model, wavelength), 'J.npy'), mmap_mode='r')
+
+    def inverse(self, layout, head_model, wavelength, active=None, alpha=0.01):
+        """
+        Regularised inverse for a set of active channels, computed on first use and memory-mapped after.
+
+        :param active: Boolean mask of the channels (rows of J) to use; all when None.
+        :param alpha: Regularisation relative to the largest eigenvalue of JJ'.
+        :return: Inverse (nNodes x nActive), float32.
+        """
+
+        J = self.jacobian(layout, head_model, wavelength)
+        active = np.ones(J.shape[0], dtype=bool) if active is None else np.asarray(active, dtype=bool)
+        # The key also covers the J.npy file itself, so an inverse is never reused for a Jacobian replaced outside put()
+        stat = os.stat(os.path.join(self.__folder(layout, head_model, wavelength), 'J.npy'))
+        key = hashlib.blake2b(np.packbits(active).tobytes() + repr((alpha, stat.st_size, stat.st_mtime_ns)).encode(),
+                              digest_size=8).hexdigest()
+        filename = os.path.join(self.__folder(layout, head_model, wavelength), 'inverse_%s.npy' % key)
+        if not os.path.exists(filename):
+            Ja = np.asarray(J[active], dtype=np.float64)
+            JJt = Ja @ Ja.T
+            lam = alpha * np.linalg.eigvalsh(JJt)[-1]
+            # Solving (JJ' + lambda I) X = J gives X' = J' (JJ' + lambda I)^-1 without forming the inverse
+            inverse = np.linalg.solve(JJt + lam * np.eye(JJt.shape[0]), Ja).T.astype(np.float32)
+            np.save(filename + '.tmp.npy', inverse)
+            os.replace(filename + '.tmp.npy', filename)
+        return np.load(filename, mmap_mode='r')
+
+#%%%%%%%%%% Reconstruction %%%%%%%%%%
+
+
+def reconstruct(dod, SD, store, layout, head_model, alpha=0.01, batch=1024, workers=4, out=None):
+    """
+    Reconstructs HbO and HbR images for every frame.
+
+    :param dod: Optical density (nTpts x nChannels), channels ordered as SD['MeasList'].
+    :param SD: Probe structure with 'MeasList', 'Lambda' and optionally 'MeasListAct'.
+    :param store: JacobianStore holding the Jacobians of this layout and head model.
+    :param alpha: Regularisation relative to the largest eigenvalue of JJ'.
+    :param batch: Frames per matrix product.
+    :param workers: Threads running the batches.
+    :param out: Optional (nTpts x 2 x nNodes) float32 array to fill, e.g. a np.memmap.
+    :return: Images (nTpts x 2 x nNodes): HbO and HbR changes in M.
+    """
+
+    meas_list = np.asarray(SD['MeasList']).astype(np.int64)
+    wavelengths = np.asarray(SD['Lambda'], dtype=np.float64).ravel()
+    act = np.asarray(SD.get('MeasListAct', np.ones(len(meas_list)))).ravel().astype(bool)
+    channels, inverses = [], []
+    for w, wavelength in enumerate(wavelengths):
+        rows = np.flatnonzero(meas_list[:, 3] == w + 1)
+        channels.append(rows[act[rows]])
+        inverses.append(store.inverse(layout, head_model, wavelength, act[rows], alpha))
+    n_nodes = inverses[0].shape[0]
+    # mua at each wavelength to HbO/HbR per node: one 2 x nWavelengths matrix
+    spectral = np.linalg.pinv(extinctions(wavelengths)).astype(np.float32)
+    if out is None:
+        out = np.empty((dod.shape[0], 2, n_nodes), dtype=np.float32)
+
+    def run(start):
+        mua = np.stack([np.asarray(dod[start:start + batch, c], dtype=np.float32) @ inverse.T
+                        for c, inverse in zip(channels, inverses)], axis=1)  # frames x wavelengths x nodes
+        out[start:start + batch] = np.einsum('hw,twn->thn', spectral, mua)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(run, range(0, dod.shape[0], batch)))
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Jacobian store for HD-DOT reconstruction')
+    parser.add_argument('command', choices=['import'])
+    parser.add_argument('store')
+    parser.add_argument('jac', help='DOTHUB .jac file')
+    parser.add_argument('--layout', required=True, help='cap name, as returned by LUMO_findLayout')
+    parser.add_argument('--head-model', required=True)
+    args = parser.parse_args()
+    JacobianStore(args.store).import_jac(args.jac, args.layout, args.head_model)
+    print(f'Imported {args.jac} into {args.store}')
@@ -0,0 +1,189 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Writes HD-DOT sessions to SNIRF (HDF5) instead of the flat .nirs files made for the DOTHUB quality
+# check. Intensity is stored chunked and compressed, the probe can take the registered optode
+# positions from optode_digitisation/register_layout.py, and the task event table becomes stim groups.
+#
+# Chunks are compressed on a thread pool (zlib releases the GIL) and written with write_direct_chunk,
+# so the HDF5 library only copies finished chunks to disk. The output is byte-for-byte what h5py
+# would write with shuffle=True, compression='gzip'.
+#
+#   python snirf_export.py recording.lufr --lufr --events <session>_events.csv --task visual --start-time 12.3
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import argparse
+import os
+import zlib
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from events import read_events
+from prune_channels import enable_lufr, load_recording
+
+#%%%%%%%%%% Chunks %%%%%%%%%%
+
+
+def chunk_shape(n_frames, n_channels, fs, epoch_seconds=30, channels_per_chunk=64):
+    """
+    Chunk layout of dataTimeSeries. A chunk spans about one epoch of a block of channels, so reading
+    one channel touches one chunk per epoch length and reading one epoch touches one chunk per
+    channel block.
+    """
+
+    return (int(max(1, min(n_frames, round(epoch_seconds * fs)))), int(max(1, min(n_channels, channels_per_chunk))))
+
+
+def _compress(block, level):
+    # HDF5 shuffle filter (byte planes) followed by deflate, padded to a full chunk
+    raw = np.ascontiguousarray(block).view(np.uint8).reshape(-1, block.dtype.itemsize)
+    return zlib.compress(raw.T.tobytes(), level)
+
+
+def write_time_series(group, d, chunks, level=4, workers=4):
+    """
+    Writes an (nTpts x nChannels) array, or any array that slices lazily, as a chunked dataset.
+
+    :param group: HDF5 group to create 'dataTimeSeries' in.
+    :param d: Intensity data.
+    :param chunks: Chunk shape (frames, channels).
+    :param level: Deflate level.
+    :param workers: Compression threads.
+    :return: The dataset.
+    """
+
+    dtype = np.dtype(d.dtype)
+    dset = group.create_dataset('dataTimeSeries', shape=d.shape, dtype=dtype, chunks=chunks, shuffle=True,
+                                compression='gzip', compression_opts=level)
+    n_frames, n_channels = d.shape
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, n_frames, chunks[0]):
+            rows = np.asarray(d[start:start + chunks[0]], dtype=dtype)
+            for column in range(0, n_channels, chunks[1]):
+                block = np.zeros(chunks, dtype=dtype)
+                part = rows[:, column:column + chunks[1]]
+                block[:part.shape[0], :part.shape[1]] = part
+                in_flight.append(((start, column), pool.submit(_compress, block, level)))
+            # Writes stay on this thread (h5py is not thread safe) and at most a few rows of chunks are held
+            while len(in_flight) > 2 * workers * max(1, n_channels // chunks[1]):
+                offset, future = in_flight.popleft()
+                dset.id.write_direct_chunk(offset, future.result())
+        while in_flight:
+            offset, future = in_flight.popleft()
+            dset.id.write_direct_chunk(offset, future.result())
+    return dset
+
+#%%%%%%%%%% SNIRF %%%%%%%%%%
+
+
+def _string(group, name, value):
+    group.create_dataset(name, data=np.bytes_(str(value)))
+
+
+def write_probe(nirs, SD, positions=None):
+    """
+    Writes /nirs/probe. Registered positions (a DataFrame indexed by optode name with X, Y, Z columns, as
+    written by register_layout.py) replace the template positions when SD carries optode names.
+    """
+
+    src_pos = np.asarray(SD['SrcPos'], dtype=np.float64)
+    det_pos = np.asarray(SD['DetPos'], dtype=np.float64)
+    if positions is not None and 'SrcNames' in SD:
+        src_pos = positions.loc[list(SD['SrcNames']), ['X', 'Y', 'Z']].to_numpy(dtype=np.float64)
+        det_pos = positions.loc[list(SD['DetNames']), ['X', 'Y', 'Z']].to_numpy(dtype=np.float64)
+    probe = nirs.create_group('probe')
+    probe.create_dataset('wavelengths', data=np.asarray(SD['Lambda'], dtype=np.float64).ravel())
+    probe.create_dataset('sourcePos3D', data=src_pos)
+    probe.create_dataset('detectorPos3D', data=det_pos)
+    if 'SrcNames' in SD:
+        probe.create_dataset('sourceLabels', data=np.array(SD['SrcNames'], dtype='S'))
+        probe.create_dataset('detectorLabels', data=np.array(SD['DetNames'], dtype='S'))
+
+
+def write_stims(nirs, events, start_time=0.0):
+    """
+    Writes one /nirs/stim group per event condition with [onset, duration, amplitude] rows.
+
+    :param events: Event table from events.read_events.
+    :param start_time: Time of the 'Z' marker in the recording, in seconds.
+    """
+
+    events = events[events['trigger'] != 'Z']
+    for i, (condition, rows) in enumerate(events.groupby('condition', sort=False)):
+        stim = nirs.create_group('stim%d' % (i + 1))
+        _string(stim, 'name', condition if condition else rows['trigger'].iloc[0])
+        stim.create_dataset('data', data=np.column_stack([rows['onset'].to_numpy() + start_time,
+                                                          rows['duration'].fillna(0).to_numpy(),
+                                                          np.ones(len(rows))]))
+        stim.create_dataset('dataLabels', data=np.array(['Onset', 'Duration', 'Amplitude'], dtype='S'))
+
+
+def export_snirf(filename, d, SD, fs, events=None, start_time=0.0, positions=None, subject='', level=4,
+                 workers=4):
+    """
+    Exports a session to SNIRF.
+
+    :param filename: Output .snirf file.
+    :param d: Intensity data (nTpts x nChannels), e.g. a LufrRecording.
+    :param SD: Probe structure (flat, as used by prune_channels).
+    :param fs: Sampling frequency in Hz.
+    :param events: Optional event table for the stim groups.
+    :param start_time: Time of the 'Z' marker in the recording, in seconds.
+    :param positions: Optional registered optode positions.
+    :param subject: SubjectID metadata tag.
+    :param level: Deflate level.
+    :param workers: Compression threads.
+    """
+
+    meas_list = np.asarray(SD['MeasList']).astype(np.int64)
+    with h5py.File(filename + '.tmp', 'w') as f:
+        _string(f, 'formatVersion', '1.1')
+        nirs = f.create_group('nirs')
+        tags = nirs.create_group('metaDataTags')
+        for name, value in (('SubjectID', subject), ('MeasurementDate', 'unknown'), ('MeasurementTime', 'unknown'),
+                            ('LengthUnit', 'mm'), ('TimeUnit', 's'), ('FrequencyUnit', 'Hz')):
+            _string(tags, name, value)
+
+        data = nirs.create_group('data1')
+        write_time_series(data, d, chunk_shape(d.shape[0], d.shape[1], fs), level, workers)
+        data.create_dataset('time', data=np.array([0.0, 1.0 / fs]))
+        for i, (source, detector, _, wavelength) in enumerate(meas_list[:, :4]):
+            ml = data.create_group('measurementList%d' % (i + 1))
+            ml.create_dataset('sourceIndex', data=np.int32(source))
+            ml.create_dataset('detectorIndex', data=np.int32(detector))
+            ml.create_dataset('wavelengthIndex', data=np.int32(wavelength))
+            ml.create_dataset('dataType', data=np.int32(1))
+            ml.create_dataset('dataTypeIndex', data=np.int32(1))
+
+        write_probe(nirs, SD, positions)
+        if events is not None:
+            write_stims(nirs, events, start_time)
+    os.replace(filename + '.tmp', filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports an HD-DOT recording to SNIRF')
+    parser.add_argument('recording', help='recording with an extension registered in prune_channels.LOADERS')
+    parser.add_argument('--events', default=None, help='*_events.csv written by the task')
+    parser.add_argument('--task', default=None)
+    parser.add_argument('--start-time', type=float, default=0.0, help="time of the 'Z' marker in the recording")
+    parser.add_argument('--positions', default=None, help='registered layout csv from register_layout.py')
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--lufr', action='store_true', help='also read .lufr recordings (layout not yet checked '
+                        'against a LUMO recording)')
+    args = parser.parse_args()
+    if args.lufr:
+        enable_lufr()
+
+    d, SD, fs = load_recording(args.recording)
+    events = read_events(args.events, args.task) if args.events else None
+    positions = pd.read_csv(args.positions, index_col='Location') if args.positions else None
+    out = args.out or os.path.splitext(args.recording)[0] + '.snirf'
+    export_snirf(out, d, SD, fs, events, args.start_time, positions,
+                 subject=os.path.basename(os.path.splitext(args.recording)[0]), workers=args.workers)
+    print(f'Wrote {out}')
@@ -0,0 +1,441 @@
+# Emilia Butters, University of Cambridge, October 2026
+
+# Synthetic participants for load testing the behavioural outputs and the preprocessing chain.
+#
+# Each task is simulated along the timeline of its experiment script with simple parametric response models
+# for the keypresses. The baseline and trial durations are read from the task scripts (the defaults of their
+# trial methods and the durations of their __baseline/__wait calls) and the triggers, condition labels and
+# trial counts from the condition tables the tasks load from --path, so the sessions follow the tasks as they
+# change. Session dates and wall times are drawn from the seed, so the same --seed writes the same files.
+# Every session gets, in the layout the real pipeline reads:
+#
+#   <out>/<task folder>/participant_data/P<id>_..._data<date>.csv    behavioural data, as the task writes it
+#   <out>/P<id>/events/P<id>_<task>_events.csv                      event table (events.py)
+#   <out>/P<id>/hddot/P<id>_<task>.lufr                              HD-DOT intensity (lufr_reader.py)
+#   <out>/recordings.csv                                             session, start_time, fs (events.join_recordings)
+#
+# The intensity holds a haemodynamic response (canonical double gamma, HbO up and HbR down) at every
+# stimulus trigger on a patch of channels, on top of cardiac, Mayer-wave and measurement noise.
+#
+#   python synthetic_sessions.py <out> --participants 200 --workers 8
+#
+# The preprocessing tools read the .lufr files when run with --lufr.
+
+#%%%%%%%%%% IMPORT LIBRARIES %%%%%%%%%%
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import argparse
+import ast
+import json
+import os
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+from scipy.stats import gamma
+
+from events import EVENT_DTYPES
+from pipeline import extinctions
+
+PATH = '/Users/emilia/Documents/Dementia task piloting/Lumo'
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'experiment_scripts')
+# Sessions are spread over a year from here, in office hours (UTC)
+STUDY_START = 1767603600  # 2026-01-05 09:00
+
+#%%%%%%%%%% Timeline %%%%%%%%%%
+
+
+class Timeline:
+    """
+    Clock of a simulated task. Onsets are relative to the 'Z' start trigger, as in the event tables.
+    """
+
+    def __init__(self, task, rng):
+        self.task = task
+        self.rng = rng
+        self.t = 0.0
+        self.rows = []
+
+    def wait(self, duration):
+        self.t += duration + self.rng.random() / 10
+
+    def baseline(self, duration):
+        self.t += duration + self.rng.random() / 10
+
+    def trigger(self, trigger, condition, duration=np.nan):
+        self.rows.append({'task': self.task, 'onset': self.t, 'trigger': trigger, 'code': ord(trigger),
+                          'condition': condition, 'duration': duration})
+
+    def events(self, flip_start, wall_start, ptb_offset):
+        events = pd.DataFrame(self.rows, columns=['task', 'onset', 'trigger', 'code', 'condition', 'duration'])
+        events.insert(2, 'flip_time', flip_start + events['onset'])
+        events['wall_time'] = wall_start + events['onset']
+        events['ptb_time'] = events['flip_time'] + ptb_offset
+        events['audio_time'] = np.nan
+        return events[list(EVENT_DTYPES)]
+
+
+def reaction_times(rng, n, mu=-0.4, sigma=0.35, limit=np.inf):
+    """
+    Log-normal reaction times (median exp(mu) s); responses slower than limit are missed (NaN).
+    """
+
+    rt = rng.lognormal(mu, sigma, n)
+    return np.where(rt < limit, rt, np.nan)
+
+#%%%%%%%%%% Task scripts %%%%%%%%%%
+
+
+@lru_cache(maxsize=None)
+def script_timings(script):
+    """
+    Timings of the Experiment methods of a task script, read from its source (the scripts need PsychoPy to
+    import): for each method, the defaults of its arguments and the durations passed to its __baseline and
+    __wait calls, in the order they appear.
+
+    :param script: File name of the script in experiment_scripts.
+    :return: Dict of method name (without the leading underscores) to {'defaults': {...}, 'baseline': [...],
+             'wait': [...]}.
+    """
+
+    with open(os.path.join(SCRIPTS, script)) as f:
+        tree = ast.parse(f.read(), script)
+    experiment = next(node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == 'Experiment')
+    methods = {}
+    for node in experiment.body:
+        if isinstance(node, ast.FunctionDef):
+            args = node.args.args[len(node.args.args) - len(node.args.defaults):]
+            defaults = {a.arg: d for a, d in zip(args, node.args.defaults) if isinstance(d, ast.Constant)}
+            methods[node.name.lstrip('_')] = {'node': node, 'defaults': {a: d.value for a, d in defaults.items()}}
+
+    found = {}
+    for name, method in methods.items():
+        calls = {'baseline': [], 'wait': []}
+        nodes = sorted((node for node in ast.walk(method['node']) if isinstance(node, ast.Call)),
+                       key=lambda node: (node.lineno, node.col_offset))
+        for node in nodes:
+            if isinstance(node.func, ast.Attribute) and node.func.attr in ('__baseline', '__wait'):
+                callee = node.func.attr.lstrip('_')
+                keywords = {k.arg: k.value for k in node.keywords}
+                value = node.args[0] if node.args else keywords.get('duration')
+                if value is None:
+                    duration = methods[callee]['defaults']['duration']
+                elif isinstance(value, ast.Constant):
+                    duration = value.value
+                else:
+                    # A duration passed through from an argument takes that argument's default
+                    duration = method['defaults'].get(getattr(value, 'id', None))
+                calls[callee].append(duration)
+        found[name] = {'defaults': method['defaults'], **calls}
+    return found
+
+
+def timings(script, method, **expected):
+    """
+    Timings of one task method, checking that it makes as many __baseline/__wait calls as the simulation
+    follows, so a change to the script stops the simulation rather than silently leaving it behind.
+
+    :param expected: Number of calls expected, e.g. baseline=2.
+    """
+
+    found = script_timings(script)[method]
+    for callee, n in expected.items():
+        if len(found[callee]) != n:
+            raise ValueError('%s: %s makes %d __%s calls, the simulation follows %d; update synthetic_sessions.py'
+                             % (script, method, len(found[callee]), callee, n))
+    return found
+
+#%%%%%%%%%% Tasks %%%%%%%%%%
+
+
+def simulate_resting(rng, path):
+    task = timings('frontal_tasks.py', 'resting_state', wait=1)
+    timeline = Timeline('resting', rng)
+    timeline.trigger('Z', 'start')
+    timeline.wait(task['wait'][0])
+    rest = task['defaults']['duration'] * 60 + 2 + rng.random() / 10
+    timeline.trigger('G', 'rest', rest)
+    timeline.t += rest
+    timeline.trigger('H', 'rest_end')
+    return timeline, None
+
+
+def simulate_visual(rng, path, p_detect=0.9):
+    task = timings('visual_stim.py', 'visual_stimulation', baseline=2, wait=1)
+    duration = timings('visual_stim.py', 'flicker_trial')['defaults']['duration']
+    conditions = pd.read_csv(path + '/visual_stimulation/visual_stimulation_stimuli.csv')
+    before, after = task['baseline']
+    timeline = Timeline('visual', rng)
+    timeline.trigger('Z', 'start')
+    timeline.wait(task['wait'][0])
+    rows = []
+    for frequency, trigger, side in zip(conditions['frequency'], conditions['trigger'], conditions['side']):
+        timeline.baseline(before)
+        timeline.trigger(trigger, side, float(duration))
+        timeline.t += duration
+        timeline.baseline(after)
+        rows.append({'frequency': frequency, 'side': side, 'detected': int(rng.random() < p_detect)})
+    return timeline, ('visual_stimulation', '_visual_stim_data', pd.DataFrame(rows))
+
+
+def simulate_memory(rng, path, p_correct=0.8):
+    task = timings('frontal_tasks.py', 'memory_task', baseline=2, wait=3)
+    trial = timings('frontal_tasks.py', 'memory_trial')['defaults']
+    duration, image_time = trial['duration'], trial['image_time']
+    recall = pd.read_csv(path + '/memory_task/official_stimuli/stimuli/recall.csv')
+    recall = recall.iloc[rng.permutation(len(recall))].reset_index(drop=True)
+    # The first __baseline is the practice fixation, before the start trigger
+    block_baseline = task['baseline'][1]
+    timeline = Timeline('imt', rng)
+    timeline.trigger('Z', 'start')
+    timeline.wait(task['wait'][1])
+    rows = []
+    # The task loop runs the recall phase for both of its phases, in blocks of two trials
+    for phase_number in range(2):
+        for block_number, start in enumerate(range(0, len(recall), 2)):
+            block = recall.iloc[start:start + 2]
+            timeline.baseline(block_baseline)
+            timeline.trigger('L', 'recall', float(duration * len(block)))
+            for j, (_, row) in enumerate(block.iterrows()):
+                correct = row['corr_ans']
+                rt_img = reaction_times(rng, 1, limit=image_time)[0]
+                rt_text = reaction_times(rng, 1, limit=duration - image_time)[0]
+                hit_img, hit_text = rng.random() < p_correct, rng.random() < p_correct
+                other = 'right' if correct == 'left' else 'left'
+                key_img = np.nan if np.isnan(rt_img) else (correct if hit_img else other)
+                key_text = np.nan if np.isnan(rt_text) else (correct if hit_text else other)
+                rows.append({'phase': 'recall', 'stimulus': 'Old or new?',
+                             'condition_setting': row['condition_setting'],
+                             'condition_memory': row['condition_memory'], 'trial_number': start + j,
+                             'reaction_time_img': rt_img,
+                             'response_img': np.nan if np.isnan(rt_img) else int(hit_img),
+                             'reaction_time_text': rt_text,
+                             'response_text': np.nan if np.isnan(rt_text) else int(hit_text),
+                             'correct_answer': correct, 'key_pressed_img': key_img, 'key_pressed_text': key_text})
+            timeline.t += duration * len(block)
+    return timeline, ('memory_task', '_memory_task_data_', pd.DataFrame(rows))
+
+
+def simulate_motor(rng, path, repeats=3):
+    task = timings('NM_task.py', 'naturalistic_motor_task', baseline=1, wait=2)
+    trial = timings('NM_task.py', 'motor_trial')['defaults']
+    stimuli = pd.read_csv(path + '/naturalistic_motor_task/naturalistic_motor_task_stimuli.csv')
+    # The first __wait comes before the start trigger, the second follows every trial
+    (baseline,), after = task['baseline'], task['wait'][1]
+    timeline = Timeline('motor', rng)
+    timeline.trigger('Z', 'start')
+    rows = []
+    for k in range(repeats):
+        for stimulus, trigger, end_trigger in zip(stimuli['stimulus'], stimuli['trigger'], stimuli['end_trigger']):
+            timeline.baseline(baseline)
+            # 'C' trials run for rest_duration; the others end on a keypress
+            if trigger == 'C':
+                duration = float(trial['rest_duration'])
+            else:
+                duration = float(np.clip(rng.normal(8, 2), 2, 20))
+            timeline.trigger(trigger, stimulus, duration)
+            timeline.t += duration
+            timeline.trigger(end_trigger, stimulus)
+            timeline.wait(after)
+            rows.append({'Stimulus': stimulus, 'Duration': np.nan if trigger == 'C' else duration, 'Trial': k})
+    return timeline, ('naturalistic_motor_task', '_naturalistic_motor_task_data', pd.DataFrame(rows))
+
+
+def simulate_mmn(rng, path):
+    task = timings('MMN_task.py', 'mismatched_negativity', wait=1)
+    # The task drops the first row of the table and plays the rest over the movie (one pass is simulated)
+    tones = pd.read_csv(path + '/mismatched_negativity_task/fixed_stims.csv')[1:].reset_index(drop=True)
+    timeline = Timeline('mmn', rng)
+    timeline.trigger('Z', 'start')
+    timeline.wait(task['wait'][0])
+    for trigger, condition, timing in zip(tones['Trigger'], tones['Condition'], tones['Timing']):
+        timeline.trigger(trigger, condition, float(timing))
+        timeline.t += timing
+    rows = pd.DataFrame({'condition': tones['Condition'], 'sound': tones['Sound']})
+    return timeline, ('mismatched_negativity_task', '_mismatched_negativity_task_data', rows)
+
+
+TASKS = {'resting': simulate_resting, 'visual': simulate_visual, 'imt': simulate_memory, 'motor': simulate_motor,
+         'mmn': simulate_mmn}
+
+#%%%%%%%%%% HD-DOT signal %%%%%%%%%%
+
+
+def synthetic_layout(n_docks=6, spacing=30.0):
+    """
+    LUMO-style layout: docks on a grid, each with sources A-C and detectors 1-4.
+    """
+
+    source_offsets = {'A': (-6, 6), 'B': (6, 6), 'C': (0, -7)}
+    detector_offsets = {'1': (-9, -2), '2': (9, -2), '3': (0, 11), '4': (0, -1)}
+    columns = int(np.ceil(np.sqrt(n_docks)))
+    docks = []
+    for i in range(n_docks):
+        x0, y0 = spacing * (i % columns), spacing * (i // columns)
+        optodes = [{'optode_id': 'optode_' + name, 'coordinates_3d': {'x': x0 + dx, 'y': y0 + dy, 'z': 0.0}}
+                   for name, (dx, dy) in list(source_offsets.items()) + list(detector_offsets.items())]
+        docks.append({'dock_id': 'dock_%d' % (i + 1), 'optodes': optodes})
+    return {'docks': docks}
+
+
+def synthetic_channels(layout, max_distance=45.0, wavelengths=(735, 850)):
+    sources, detectors = [], []
+    for dock in layout['docks']:
+        node = dock['dock_id'].split('_')[-1]
+        for optode in dock['optodes']:
+            name = optode['optode_id'].split('_')[-1]
+            c = optode['coordinates_3d']
+            (sources if name.isalpha() else detectors).append((node, name, np.array([c['x'], c['y'], c['z']])))
+    channels = []
+    for src_node, src_optode, src_pos in sources:
+        for det_node, det_optode, det_pos in detectors:
+            rho = float(np.linalg.norm(src_pos - det_pos))
+            if rho <= max_distance:
+                for wavelength in wavelengths:
+                    channels.append({'src_node': int(src_node), 'src_optode': src_optode, 'det_node': int(det_node),
+                                     'det_optode': det_optode, 'wavelength': wavelength, 'distance': rho,
+                                     'x': (src_pos[0] + det_pos[0]) / 2, 'y': (src_pos[1] + det_pos[1]) / 2})
+    return pd.DataFrame(channels)
+
+
+def hrf(fs, length=30.0):
+    t = np.arange(0, length, 1 / fs)
+    h = gamma.pdf(t, 6) - gamma.pdf(t, 16) / 6
+    return h / h.max()
+
+
+def synthetic_intensity(rng, events, channels, fs, n_frames, start_time, amplitude=1e-6, ppf=6.0):
+    """
+    Intensity (nFrames x nChannels, float32) with an evoked response at every stimulus trigger.
+
+    :param amplitude: Peak HbO change of the response, in M (HbR changes by -0.3 times this).
+    """
+
+    stims = events[events['duration'].notna() & (events['trigger'] != 'Z')]
+    boxcar = np.zeros(n_frames)
+    for onset, duration in zip(stims['onset'], stims['duration']):
+        start = int(round((onset + start_time) * fs))
+        boxcar[start:start + max(1, int(round(duration * fs)))] = 1
+    response = np.convolve(boxcar, hrf(fs))[:n_frames]
+    response /= max(response.max(), 1e-12)
+
+    # A patch of channels around a random centre responds
+    centre = channels[['x', 'y']].to_numpy()[rng.integers(len(channels))]
+    weight = np.exp(-np.sum((channels[['x', 'y']].to_numpy() - centre) ** 2, axis=1) / (2 * 20.0 ** 2))
+    weight *= (channels['distance'].to_numpy() > 10)
+    e = extinctions(channels['wavelength'].to_numpy())
+    dod = np.outer(response, amplitude * (e[:, 0] - 0.3 * e[:, 1]) * channels['distance'].to_numpy() * ppf * weight)
+
+    t = np.arange(n_frames) / fs
+    physiology = (0.004 * np.sin(2 * np.pi * rng.uniform(1.0, 1.4) * t)
+                  + 0.006 * np.sin(2 * np.pi * 0.1 * t + rng.uniform(0, 2 * np.pi)))
+    dod += physiology[:, None] * rng.uniform(0.5, 1.5, len(channels))[None, :]
+    dod += rng.normal(0, 0.002, dod.shape)
+    i0 = 1e7 * np.exp(-0.15 * channels['distance'].to_numpy())
+    return (i0[None, :] * np.exp(-dod)).astype('<f4')
+
+
+def write_lufr(filename, intensity, channels, layout, fs, wall, chunk_frames=600):
+    """
+    Writes a recording in the layout read by lufr_reader.py (frame chunks stored uncompressed).
+
+    :param wall: Wall time of the recording, stamped on the archive members so the file depends only on the seed.
+    """
+
+    toml = '[recording]\nchn_fps = %r\nn_chans = %d\n' % (float(fs), intensity.shape[1])
+    for _, c in channels.iterrows():
+        toml += ("\n[[channels]]\nsrc_node = %d\nsrc_optode = '%s'\ndet_node = %d\ndet_optode = '%s'\n"
+                 "wavelength = %d\n" % (c['src_node'], c['src_optode'], c['det_node'], c['det_optode'],
+                                         c['wavelength']))
+    date_time = time.gmtime(wall)[:6]
+    with zipfile.ZipFile(filename + '.tmp', 'w', zipfile.ZIP_STORED) as archive:
+        def member(name, content):
+            archive.writestr(zipfile.ZipInfo(name, date_time), content)
+        member('metadata.toml', "file_version = '0.5.0'\nsynthetic = true\n")
+        member('recording.toml', toml)
+        member('layout.json', json.dumps(layout))
+        for i, start in enumerate(range(0, intensity.shape[0], chunk_frames)):
+            member('data/%06d.bin' % i, intensity[start:start + chunk_frames].tobytes())
+    os.replace(filename + '.tmp', filename)
+
+#%%%%%%%%%% Sessions %%%%%%%%%%
+
+
+def simulate_participant(out, participant, seed, tasks=tuple(TASKS), fs=10.0, n_docks=6, path=PATH):
+    """
+    Simulates every task for one participant and writes its files.
+
+    :param path: Task folder with the condition tables, as in the task scripts.
+    :return: List of recording rows (session, start_time, fs).
+    """
+
+    rng = np.random.default_rng(seed)
+    name = 'P%03d' % participant
+    wall = STUDY_START + 86400 * rng.integers(365) + rng.uniform(0, 8 * 3600)
+    date = time.strftime('%Y-%m-%d_%Hh%M.%S.000', time.gmtime(wall))
+    layout = synthetic_layout(n_docks)
+    channels = synthetic_channels(layout)
+    for folder in ('events', 'hddot'):
+        os.makedirs(os.path.join(out, name, folder), exist_ok=True)
+
+    recordings = []
+    for task in tasks:
+        timeline, behaviour = TASKS[task](rng, path)
+        events = timeline.events(flip_start=rng.uniform(20, 60), wall_start=wall, ptb_offset=rng.uniform(1e3, 1e5))
+        session = '%s_%s' % (name, task)
+        events.to_csv(os.path.join(out, name, 'events', session + '_events.csv'), header=True, index=False,
+                      float_format='%.6f')
+        if behaviour is not None:
+            folder, suffix, data = behaviour
+            os.makedirs(os.path.join(out, folder, 'participant_data'), exist_ok=True)
+            data.to_csv(os.path.join(out, folder, 'participant_data', 'P%d%s%s.csv' % (participant, suffix, date)),
+                        header=True, index=False)
+
+        # The recording starts a little before the task and runs on after its last event
+        start_time = rng.uniform(5, 15)
+        end = (events['onset'] + events['duration'].fillna(0)).max()
+        n_frames = int(np.ceil((start_time + end + 30) * fs))
+        intensity = synthetic_intensity(rng, events, channels, fs, n_frames, start_time)
+        write_lufr(os.path.join(out, name, 'hddot', session + '.lufr'), intensity, channels, layout, fs,
+                   wall - start_time)
+        recordings.append({'session': session, 'start_time': start_time, 'fs': fs})
+        # The next task starts a few minutes after this one ends
+        wall += end + rng.uniform(60, 300)
+    return recordings
+
+
+def simulate_study(out, n_participants, tasks=tuple(TASKS), seed=0, workers=None, **params):
+    """
+    Simulates a study, one participant per worker process.
+
+    :param out: Output folder.
+    :param n_participants: Number of participants.
+    :param tasks: Tasks to simulate (keys of TASKS).
+    :param seed: Seed of the study; each participant gets an independent stream derived from it.
+    :return: DataFrame of the recordings, also saved as recordings.csv.
+    """
+
+    seeds = np.random.SeedSequence(seed).spawn(n_participants)
+    print(f'Simulating {n_participants} participants...')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(simulate_participant, out, i + 1, seeds[i], tasks, **params)
+                   for i in range(n_participants)]
+        recordings = pd.DataFrame([row for future in futures for row in future.result()])
+    recordings.to_csv(os.path.join(out, 'recordings.csv'), header=True, index=False)
+    return recordings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic participants for pipeline load testing')
+    parser.add_argument('out', help='output folder')
+    parser.add_argument('--participants', type=int, default=10)
+    parser.add_argument('--tasks', nargs='+', default=list(TASKS), choices=list(TASKS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fs', type=float, default=10.0)
+    parser.add_argument('--docks', type=int, default=6)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--path', default=PATH, help='task folder with the condition tables')
+    args = parser.parse_args()
+    simulate_study(args.out, args.participants, tuple(args.tasks), args.seed, args.workers, fs=args.fs,
+                   n_docks=args.docks, path=args.path)
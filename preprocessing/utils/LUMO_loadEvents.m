@@ -0,0 +1,30 @@
+function events = LUMO_loadEvents(participant, task, eventsPath)
+
+% Loads the event tables written by the experiment scripts for a participant
+% and task. The scripts write one table per session to experiment_scripts/data
+% (<participant>_<experiment>_<date>_<script>_events.csv), with one row per
+% trigger: the onset (s, relative to the 'Z' start trigger), trigger code,
+% condition and duration, and the task the trigger belongs to.
+% eventsPath defaults to experiment_scripts/data in this repository.
+% EB, October 2026
+
+if nargin < 3 || isempty(eventsPath)
+    eventsPath = fullfile(fileparts(mfilename('fullpath')),'..','..','experiment_scripts','data');
+end
+
+files = dir(fullfile(eventsPath,[char(participant),'_*_events.csv']));
+events = table();
+for kk=1:length(files)
+    filename = fullfile(eventsPath,files(kk).name);
+    opts = detectImportOptions(filename);
+    opts = setvartype(opts,{'task','trigger','condition'},'string');
+    tbl = readtable(filename, opts);
+    tbl = tbl(tbl.task == string(task),:);
+    tbl.session = repmat(string(files(kk).name(1:end-length('_events.csv'))),height(tbl),1);
+    events = [events; tbl];
+end
+
+if isempty(events)
+    INFO(['No event table found for ', char(participant), ' ', char(task), ' in ', eventsPath]);
+end
+end